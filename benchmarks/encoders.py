@@ -0,0 +1,77 @@
+"""Compare the time taken by encoders of tile images
+
+Usage: python benchmarks/encoders.py [INPUT] [ZOOM]
+
+Tiles of the input dataset at the zoom level are warped once and then
+encoded by each encoder in each format. The mean time per tile and the
+mean size of the images are reported.
+"""
+
+import sys
+import time
+import warnings
+
+import mercantile
+import numpy as np
+import rasterio
+from rasterio.warp import transform_bounds
+
+from mbtiles.encoders import ENCODERS, get_encoder
+import mbtiles.worker
+
+FORMATS = ["JPEG", "PNG", "WEBP"]
+REPEAT = 5
+
+
+def warped_tiles(path, zoom, count):
+    """Warp the non-empty tiles of a dataset at a zoom level"""
+    profile = {
+        "driver": "PNG",
+        "dtype": "uint8",
+        "nodata": 0,
+        "height": 256,
+        "width": 256,
+        "count": count,
+        "crs": "EPSG:3857",
+    }
+    mbtiles.worker.init_worker(path, profile, "bilinear")
+
+    with rasterio.open(path) as src:
+        bounds = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+
+        arrays = []
+        for tile in mercantile.tiles(*bounds, zooms=[zoom]):
+            if not mbtiles.worker._tile_has_data(src, tile):
+                continue
+            kwds, warp_kwds = mbtiles.worker._tile_kwds(src, tile)
+            arrays.append((mbtiles.worker._warp(src, kwds, **warp_kwds).copy(), kwds))
+
+    mbtiles.worker.close_source()
+    return arrays
+
+
+def main(path="tests/data/RGB.byte.tif", zoom=10):
+    warnings.simplefilter("ignore")
+    zoom = int(zoom)
+    for count in (3, 4):
+        tiles = warped_tiles(path, zoom, count)
+        for img_format in FORMATS:
+            if img_format == "JPEG" and count == 4:
+                continue
+            for name in ENCODERS:
+                encode = get_encoder(name)
+                sizes = []
+                start = time.time()
+                for i in range(REPEAT):
+                    for data, kwds in tiles:
+                        sizes.append(len(encode(data, dict(kwds, driver=img_format))))
+                elapsed = (time.time() - start) / (REPEAT * len(tiles))
+                print(
+                    "{:>4} bands {:>4} {:>6}: {:7.2f} ms/tile {:8.0f} bytes/tile".format(
+                        count, img_format, name, elapsed * 1000, np.mean(sizes)
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,128 @@
+"""Compact sets of the tiles of a zoom level"""
+
+from collections import namedtuple
+
+import numpy as np
+
+TileBitmap = namedtuple("TileBitmap", ["col_off", "row_off", "width", "height", "bits"])
+TileBitmap.__doc__ = """Set of tiles of a rectangle of a zoom level
+
+Each tile of a rectangle of width x height tiles, starting at col_off
+and row_off, is one bit of the bits array, in row major order.
+"""
+
+TileKeys = namedtuple("TileKeys", ["col_off", "row_off", "width", "height", "keys"])
+TileKeys.__doc__ = """Set of tiles of a rectangle of a zoom level too large for a bitmap
+
+The keys array holds the sorted row major indexes of the tiles in the
+rectangle of width x height tiles, starting at col_off and row_off.
+"""
+
+# Largest bitmap, in bytes. Tiles spread over larger rectangles are
+# kept as sorted keys.
+MAX_BITMAP_BYTES = 1 << 26
+
+
+def bitmap_nbytes(col_min, col_max, row_min, row_max):
+    """Find the size of the bitmap of a rectangle of tiles
+
+    Parameters
+    ----------
+    col_min, col_max, row_min, row_max : int
+        Inclusive bounds of the rectangle.
+
+    Returns
+    -------
+    int
+
+    """
+    return -(-((col_max - col_min + 1) * (row_max - row_min + 1)) // 8)
+
+
+def empty_bitmap(col_min, col_max, row_min, row_max):
+    """Make a bitmap of a rectangle of tiles without any tile
+
+    Parameters
+    ----------
+    col_min, col_max, row_min, row_max : int
+        Inclusive bounds of the rectangle.
+
+    Returns
+    -------
+    TileBitmap
+
+    """
+    width = col_max - col_min + 1
+    height = row_max - row_min + 1
+    bits = np.zeros(bitmap_nbytes(col_min, col_max, row_min, row_max), dtype="uint8")
+    return TileBitmap(col_min, row_min, width, height, bits)
+
+
+def sparse_bitmap(col_min, col_max, row_min, row_max, cols, rows):
+    """Make a set of tiles of a rectangle from their keys
+
+    Parameters
+    ----------
+    col_min, col_max, row_min, row_max : int
+        Inclusive bounds of the rectangle.
+    cols, rows : array_like of int
+        Columns and rows of the tiles, which must be within the
+        rectangle.
+
+    Returns
+    -------
+    TileKeys
+
+    """
+    width = col_max - col_min + 1
+    height = row_max - row_min + 1
+    cols = np.asarray(cols, dtype="int64")
+    rows = np.asarray(rows, dtype="int64")
+    keys = np.unique((rows - row_min) * width + (cols - col_min))
+    return TileKeys(col_min, row_min, width, height, keys)
+
+
+def add_tiles(bitmap, cols, rows):
+    """Add tiles to a bitmap
+
+    Parameters
+    ----------
+    bitmap : TileBitmap
+    cols, rows : array_like of int
+        Columns and rows of the tiles, which must be within the
+        bitmap's rectangle.
+
+    Returns
+    -------
+    None
+
+    """
+    cols = np.asarray(cols, dtype="int64")
+    rows = np.asarray(rows, dtype="int64")
+    index = (rows - bitmap.row_off) * bitmap.width + (cols - bitmap.col_off)
+    masks = np.right_shift(128, index & 7).astype("uint8")
+    np.bitwise_or.at(bitmap.bits, index >> 3, masks)
+
+
+def has_tile(bitmap, col, row):
+    """Determine whether a tile is in a bitmap
+
+    Parameters
+    ----------
+    bitmap : TileBitmap or TileKeys
+    col, row : int
+
+    Returns
+    -------
+    bool
+
+    """
+    col -= bitmap.col_off
+    row -= bitmap.row_off
+    if not (0 <= col < bitmap.width and 0 <= row < bitmap.height):
+        return False
+    index = row * bitmap.width + col
+    if isinstance(bitmap, TileKeys):
+        pos = np.searchsorted(bitmap.keys, index)
+        return bool(pos < len(bitmap.keys) and bitmap.keys[pos] == index)
+    return bool(bitmap.bits[index >> 3] & (128 >> (index & 7)))
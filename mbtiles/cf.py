@@ -1,16 +1,141 @@
 """concurrent.futures implementation"""
 
+from collections import deque
 import concurrent.futures
-from itertools import islice
 import logging
+import math
+import os
+import queue
+import threading
+import time
 
-from mbtiles.worker import init_worker, process_tile
+from mbtiles.order import metatiles
+from mbtiles.worker import (
+    DATASET_CACHE_SIZE,
+    init_worker,
+    process_tiles_batch,
+    SharedImage,
+)
 
 BATCH_SIZE = 100
 
+# Bounds and initial value of the number of tiles submitted per task.
+MIN_CHUNK_SIZE = 1
+MAX_CHUNK_SIZE = 64
+INITIAL_CHUNK_SIZE = 4
+
+# Chunk sizes are adapted so that tasks take about this many seconds.
+TARGET_TASK_SECONDS = 0.25
+
+# Weight of the latest task in the estimated time per tile.
+TILE_SECONDS_WEIGHT = 0.2
+
+# Number of tasks submitted per worker process, initially and at most.
+# More tasks are queued when results take longer to come back.
+TASKS_PER_WORKER = 2
+MAX_TASKS_PER_WORKER = 8
+
+# Number of recent tasks whose delays, from their completion to the
+# submission of more tasks, are used to estimate the latency of tasks.
+LATENCY_WINDOW = 16
+
+# Number of upcoming tiles among which the most costly are submitted
+# first.
+LOOKAHEAD_TILES = 1024
+
+# Room for encoded images that are larger than the raw pixels.
+SLOT_OVERHEAD = 65536
+
+# Maximum number of groups of results waiting for the writer thread.
+WRITER_QUEUE_SIZE = 10
+
 log = logging.getLogger(__name__)
 
 
+def chunk_size(tile_seconds):
+    """Number of tiles per task
+
+    Parameters
+    ----------
+    tile_seconds : float or None
+        Estimated time to process one tile. None if not yet known.
+
+    Returns
+    -------
+    int
+
+    """
+    if tile_seconds is None:
+        return INITIAL_CHUNK_SIZE
+    elif tile_seconds <= 0:
+        return MAX_CHUNK_SIZE
+    else:
+        return max(
+            MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, int(TARGET_TASK_SECONDS / tile_seconds))
+        )
+
+
+def tasks_per_worker(latency, task_seconds):
+    """Number of tasks to submit per worker
+
+    Workers are kept busy while the results of their tasks are handled
+    and more tasks are submitted if enough tasks are queued to cover
+    that latency.
+
+    Parameters
+    ----------
+    latency : float or None
+        Estimated time between the end of a task and the submission of
+        more tasks. None if not yet known.
+    task_seconds : float or None
+        Estimated time to process a task. None if not yet known.
+
+    Returns
+    -------
+    int
+
+    """
+    if latency is None or task_seconds is None:
+        return TASKS_PER_WORKER
+    elif task_seconds <= 0:
+        return MAX_TASKS_PER_WORKER
+    else:
+        queued = max(1, int(math.ceil(latency / task_seconds)))
+        return min(MAX_TASKS_PER_WORKER, max(TASKS_PER_WORKER, 1 + queued))
+
+
+def front_load(units, zoom_seconds):
+    """Order units of tiles so that the most costly are first
+
+    Units of the same estimated cost, such as those of a zoom level,
+    keep their order. Units of zoom levels whose cost is not yet known
+    are first, since the cost of tiles generally decreases with zoom.
+
+    Parameters
+    ----------
+    units : list of list of mercantile.Tile
+        Units of tiles of the same zoom level.
+    zoom_seconds : dict
+        Estimated time to process one tile, by zoom level.
+
+    Returns
+    -------
+    list of list of mercantile.Tile
+
+    """
+    return sorted(
+        units, key=lambda unit: -zoom_seconds.get(unit[0].z, float("inf"))
+    )
+
+
+def update_estimate(estimate, value):
+    """Update an exponentially weighted moving average"""
+    if estimate is None:
+        return value
+    else:
+        return estimate + TILE_SECONDS_WEIGHT * (value - estimate)
+
+
 def process_tiles(
     tiles,
     init_mbtiles,
@@ -27,46 +152,306 @@ def process_tiles(
     warp_options=None,
     creation_options=None,
     exclude_empty_tiles=True,
+    transport="pickle",
+    pyramid_source=None,
+    pyramid_resampling=None,
+    hash_images=False,
+    coverage=None,
+    metatile_size=1,
+    encoder="gdal",
+    overview_plan=None,
+    overview_source=None,
+    sources=None,
+    dataset_cache_size=DATASET_CACHE_SIZE,
+    shard_dir=None,
 ):
     """Warp imagery into tiles and commit to mbtiles database.
+
+    Tiles are submitted to workers in chunks of adjacent tiles. The
+    size of chunks is adapted to the time taken by earlier tiles of
+    the same zoom level so that each task amortizes the cost of
+    submission without leaving workers idle. Among the next
+    LOOKAHEAD_TILES tiles, those of the most costly zoom levels are
+    submitted first, and once all tiles have been generated, chunks
+    shrink so that the last tiles are shared by all workers. The number
+    of tasks queued per worker grows with the observed latency of
+    tasks.
+
+    Results are written to the database by a dedicated thread, which
+    calls init_mbtiles, insert_results, and commit_mbtiles, so that
+    submission of tiles to workers does not wait on the database.
+
+    With the "shared-memory" transport, workers write tile images into
+    slots of a shared memory buffer and return only the location of the
+    image, sparing the cost of pickling images and pushing them through
+    the executor's result pipe.
+
+    If pyramid_source, the path of an MBTiles file, is given, tiles are
+    built by downsampling their children in that file instead of being
+    warped from the input file. If hash_images is True, workers
+    identify each image by a hash of its content. A coverage of the
+    input file, if given, lets workers skip empty tiles without reading
+    the input file's mask.
+
+    If metatile_size is greater than 1, consecutive tiles of the same
+    block of metatile_size x metatile_size tiles are submitted together
+    and warped at once. Tile images are encoded by the named encoder,
+    see mbtiles.encoders. An overview plan, a dict of overview levels
+    by zoom level, lets workers warp from overviews of the input file,
+    or of the overview_source dataset if given. If sources, a list of
+    mbtiles.sources.Source, is given, tiles are warped from the sources
+    that intersect them instead of the input file, and each worker
+    keeps up to dataset_cache_size of them open.
+
+    If shard_dir, a directory, is given, each worker writes the images
+    of its tiles to its own MBTiles shard in that directory and returns
+    only their sizes. The shards are left to the caller to merge.
     """
-    with concurrent.futures.ProcessPoolExecutor(
-        max_workers=num_workers,
-        initializer=init_worker,
-        initargs=(
-            inputfile,
-            base_kwds,
-            resampling,
-            open_options,
-            warp_options,
-            creation_options,
-            exclude_empty_tiles,
-        ),
-    ) as executor:
-        group = islice(tiles, BATCH_SIZE)
-        futures = {executor.submit(process_tile, tile) for tile in group}
-
-        init_mbtiles()
-
-        count = 0
-        while futures:
-            done, futures = concurrent.futures.wait(
-                futures, return_when=concurrent.futures.FIRST_COMPLETED
+    # Tiles are submitted in units that are never split between tasks.
+    if metatile_size > 1:
+        units = metatiles(tiles, metatile_size)
+    else:
+        units = ([tile] for tile in tiles)
+    lookahead = deque()
+    workers = num_workers or os.cpu_count() or 1
+    shared = None
+    slot_size = None
+
+    # Each worker's queued tasks may hold a full chunk of tiles.
+    slot_count = workers * MAX_TASKS_PER_WORKER * MAX_CHUNK_SIZE
+
+    if transport == "shared-memory":
+        from multiprocessing import shared_memory
+
+        slot_size = (
+            base_kwds["width"] * base_kwds["height"] * base_kwds["count"]
+            + SLOT_OVERHEAD
+        )
+        shared = shared_memory.SharedMemory(create=True, size=slot_count * slot_size)
+        log.debug(
+            "Created shared memory buffer: name=%r, size=%r", shared.name, shared.size
+        )
+
+    # Slots freed last are used first, so that only the pages of the
+    # slots of the tiles in flight are touched.
+    free_slots = list(range(slot_count))
+    future_slots = {}
+    done_times = {}
+    delays = deque(maxlen=LATENCY_WINDOW)
+    timing = {"tile_seconds": None, "task_seconds": None}
+    zoom_seconds = {}
+    generated = {"done": False, "buffered": 0}
+
+    def fill_lookahead():
+        """Generate units of tiles and order them by cost"""
+        if generated["done"] or generated["buffered"] >= LOOKAHEAD_TILES // 2:
+            return
+        added = []
+        while generated["buffered"] < LOOKAHEAD_TILES:
+            unit = next(units, None)
+            if unit is None:
+                generated["done"] = True
+                break
+            added.append(unit)
+            generated["buffered"] += len(unit)
+        if added:
+            ordered = front_load(list(lookahead) + added, zoom_seconds)
+            lookahead.clear()
+            lookahead.extend(ordered)
+
+    def take_chunk(size, limit=None):
+        """Take whole units of about size tiles and at most limit tiles"""
+        chunk = []
+        while lookahead:
+            if chunk and len(chunk) + len(lookahead[0]) > size:
+                break
+            if limit is not None and len(chunk) + len(lookahead[0]) > limit:
+                break
+            chunk.extend(lookahead.popleft())
+        generated["buffered"] -= len(chunk)
+        return chunk
+
+    def next_chunk_size():
+        """Size of the next chunk, from the cost of its zoom level"""
+        size = chunk_size(
+            zoom_seconds.get(lookahead[0][0].z, timing["tile_seconds"])
+        )
+        # The last tiles are spread over all workers.
+        if generated["done"]:
+            remaining = generated["buffered"]
+            size = min(size, max(MIN_CHUNK_SIZE, -(-remaining // workers)))
+        return size
+
+    def submit(executor, futures):
+        """Submit chunks of tiles until enough tasks are pending"""
+        latency = max(delays) if delays else None
+        max_tasks = workers * tasks_per_worker(latency, timing["task_seconds"])
+
+        while len(futures) < max_tasks:
+            fill_lookahead()
+            if not lookahead:
+                return
+
+            size = next_chunk_size()
+            if shared is None:
+                chunk = take_chunk(size)
+            else:
+                chunk = take_chunk(size, limit=len(free_slots))
+
+            if not chunk:
+                return
+
+            if shared is None:
+                future = executor.submit(process_tiles_batch, chunk)
+            else:
+                slots = [free_slots.pop() for tile in chunk]
+                future = executor.submit(process_tiles_batch, chunk, slots)
+                future_slots[future] = slots
+
+            future.add_done_callback(record_done_time)
+            futures.add(future)
+
+    def record_done_time(future):
+        done_times[future] = time.time()
+
+    def receive(future):
+        results, elapsed = future.result()
+
+        timing["task_seconds"] = update_estimate(timing["task_seconds"], elapsed)
+        tile_seconds = elapsed / len(results)
+        timing["tile_seconds"] = update_estimate(timing["tile_seconds"], tile_seconds)
+        for zoom in set(result[0].z for result in results):
+            zoom_seconds[zoom] = update_estimate(zoom_seconds.get(zoom), tile_seconds)
+
+        if shared is not None:
+            slots = future_slots.pop(future)
+            for i, (result, slot) in enumerate(zip(results, slots)):
+                tile, contents = result[:2]
+                if isinstance(contents, SharedImage):
+                    offset = slot * slot_size
+                    contents = bytes(shared.buf[offset : offset + contents.size])
+                    results[i] = (tile, contents) + result[2:]
+            free_slots.extend(slots)
+
+        return results
+
+    results_queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+    writer_errors = []
+
+    def write_results():
+        try:
+            init_mbtiles()
+
+            count = 0
+            while True:
+                results = results_queue.get()
+                if results is None:
+                    break
+
+                for result in results:
+                    insert_results(*result, img_ext=img_ext, image_dump=image_dump)
+
+                count += len(results)
+                if count > BATCH_SIZE:
+                    commit_mbtiles()
+                    count = 0
+
+                if progress_bar is not None:
+                    if progress_bar.n + len(results) < progress_bar.total:
+                        progress_bar.update(len(results))
+
+        except Exception as exc:
+            log.exception("Writer thread failed")
+            writer_errors.append(exc)
+
+    def put_results(results):
+        while writer.is_alive():
+            try:
+                results_queue.put(results, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+        if writer_errors:
+            raise writer_errors[0]
+
+    writer = threading.Thread(target=write_results, name="mbtiles-writer")
+    writer.daemon = True
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=init_worker,
+            initargs=(
+                inputfile,
+                base_kwds,
+                resampling,
+                open_options,
+                warp_options,
+                creation_options,
+                exclude_empty_tiles,
+                shared.name if shared is not None else None,
+                slot_size,
+                pyramid_source,
+                pyramid_resampling,
+                hash_images,
+                coverage,
+                metatile_size,
+                encoder,
+                overview_plan,
+                overview_source,
+                sources,
+                dataset_cache_size,
+                shard_dir,
+            ),
+        ) as executor:
+            futures = set()
+            submit(executor, futures)
+
+            writer.start()
+
+            while futures:
+                done, futures = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+
+                results = []
+                for future in done:
+                    results.extend(receive(future))
+
+                submit(executor, futures)
+
+                # Tasks that were done while results were being handled
+                # waited this long for more tasks to be submitted.
+                now = time.time()
+                for future in done:
+                    delays.append(now - done_times.pop(future, now))
+
+                put_results(results)
+
+            log.debug(
+                "Scheduled tiles: zoom_seconds=%r, latency=%r",
+                zoom_seconds,
+                max(delays) if delays else None,
             )
 
-            group = islice(tiles, len(done))
-            for tile in group:
-                futures.add(executor.submit(process_tile, tile))
+            put_results(None)
+            writer.join()
 
-            for future in done:
-                tile, contents = future.result()
-                insert_results(tile, contents, img_ext=img_ext, image_dump=image_dump)
+            if writer_errors:
+                raise writer_errors[0]
 
-            count += len(done)
-            if count > BATCH_SIZE:
-                commit_mbtiles()
-                count = 0
+    finally:
+        if writer.is_alive():
+            # Stop the writer without waiting on a full queue.
+            while not results_queue.empty():
+                try:
+                    results_queue.get_nowait()
+                except queue.Empty:
+                    break
+            results_queue.put(None)
+            writer.join()
 
-            if progress_bar is not None:
-                if progress_bar.n + len(done) < progress_bar.total:
-                    progress_bar.update(len(done))
+        if shared is not None:
+            shared.close()
+            shared.unlink()
@@ -0,0 +1,208 @@
+"""Regions of a dataset that changed between versions"""
+
+import logging
+import math
+
+import mercantile
+import numpy as np
+from rasterio.warp import transform, transform_bounds, transform_geom
+from shapely.geometry import box, mapping, shape
+from shapely.ops import unary_union
+import supermercado.burntiles
+
+log = logging.getLogger(__name__)
+
+# Radii of resampling kernels, in pixels of the coarser of the source
+# and the tiles. Other methods read the source pixels that each pixel
+# of a tile covers, and one more.
+RESAMPLING_RADII = {
+    "nearest": 0,
+    "bilinear": 1,
+    "cubic": 2,
+    "cubic_spline": 2,
+    "lanczos": 3,
+}
+
+# Width of the Web Mercator projection, in meters.
+MERCATOR_WIDTH = 2 * math.pi * 6378137.0
+
+
+def changed_region(old, new):
+    """Find the region in which two versions of a dataset differ
+
+    The datasets are compared block by block. Versions must have the
+    same shape, number of bands, and georeferencing.
+
+    Parameters
+    ----------
+    old, new : DatasetReader
+
+    Returns
+    -------
+    Polygon, MultiPolygon, or GeometryCollection
+        The union of the bounds of the changed blocks, in decimal
+        degrees. Empty if no block changed.
+
+    Raises
+    ------
+    ValueError
+        If the versions can't be compared.
+
+    """
+    if (
+        old.shape != new.shape
+        or old.count != new.count
+        or old.transform != new.transform
+        or old.crs != new.crs
+    ):
+        raise ValueError(
+            "Versions of a dataset must have the same shape, bands, and georeferencing"
+        )
+
+    boxes = []
+    for _, window in new.block_windows(1):
+        same_data = np.array_equal(old.read(window=window), new.read(window=window))
+        same_masks = np.array_equal(
+            old.read_masks(window=window), new.read_masks(window=window)
+        )
+        if not (same_data and same_masks):
+            bounds = transform_bounds(new.crs, "EPSG:4326", *new.window_bounds(window))
+            boxes.append(box(*bounds))
+
+    log.debug("Changed blocks: name=%r, count=%r", new.name, len(boxes))
+    return unary_union(boxes)
+
+
+def polygon_features(region):
+    """Make GeoJSON features of the polygons of a region
+
+    Supermercado burns polygons, but not collections of them.
+
+    Parameters
+    ----------
+    region : Polygon, MultiPolygon, or GeometryCollection
+
+    Returns
+    -------
+    list of dict
+        One feature per non-empty polygon.
+
+    """
+    if hasattr(region, "geoms"):
+        polygons = [geom for geom in region.geoms if geom.geom_type == "Polygon"]
+        polygons.extend(
+            part
+            for geom in region.geoms
+            if geom.geom_type == "MultiPolygon"
+            for part in geom.geoms
+        )
+    elif region.geom_type == "Polygon":
+        polygons = [region]
+    else:
+        polygons = []
+
+    return [
+        {"type": "Feature", "properties": {}, "geometry": mapping(polygon)}
+        for polygon in polygons
+        if not polygon.is_empty
+    ]
+
+
+def region_tiles(region, zoom):
+    """Find the tiles of a zoom level that intersect a region
+
+    Parameters
+    ----------
+    region : Polygon, MultiPolygon, or GeometryCollection
+        A region in decimal degrees.
+    zoom : int
+
+    Returns
+    -------
+    list of mercantile.Tile
+
+    """
+    features = polygon_features(region)
+    if not features:
+        return []
+
+    # Supermercado's numpy scalars must be cast to ints.
+    return [
+        mercantile.Tile(*(int(v) for v in arr))
+        for arr in supermercado.burntiles.burn(features, zoom)
+    ]
+
+
+def mercator_pixel_size(src):
+    """Find the size of the central pixel of a dataset in Web Mercator
+
+    Parameters
+    ----------
+    src : DatasetReader
+
+    Returns
+    -------
+    float
+        The larger of the pixel's width and height, in meters.
+
+    """
+    col, row = src.width // 2, src.height // 2
+    x0, y0 = src.transform * (col, row)
+    x1, y1 = src.transform * (col + 1, row + 1)
+    xs, ys = transform(src.crs, "EPSG:3857", [x0, x1], [y0, y1])
+    return max(abs(xs[1] - xs[0]), abs(ys[1] - ys[0]))
+
+
+def pad_distance(zoom, tile_size, pixel_size, resampling="nearest"):
+    """Find the distance from a region within which tiles read its pixels
+
+    The window of a tile is padded by a source pixel, and a tile's
+    pixels are resampled from source pixels within the radius of the
+    resampling kernel, scaled to the tile's pixels if they are coarser.
+
+    Parameters
+    ----------
+    zoom : int
+    tile_size : int
+        Width and height of tiles, in pixels.
+    pixel_size : float
+        Size of the source's pixels, in Web Mercator meters.
+    resampling : str, optional
+        Name of the resampling method.
+
+    Returns
+    -------
+    float
+        Distance in Web Mercator meters.
+
+    """
+    tile_pixel_size = MERCATOR_WIDTH / (tile_size * 2 ** zoom)
+    radius = RESAMPLING_RADII.get(resampling, 1)
+    return pixel_size + radius * max(pixel_size, tile_pixel_size)
+
+
+def pad_region(region, distance):
+    """Buffer a region by a distance in Web Mercator
+
+    Parameters
+    ----------
+    region : Polygon, MultiPolygon, or GeometryCollection
+        A region in decimal degrees, within the latitudes of Web
+        Mercator.
+    distance : float
+        Distance in Web Mercator meters.
+
+    Returns
+    -------
+    Polygon, MultiPolygon, or GeometryCollection
+        The buffered region in decimal degrees.
+
+    """
+    if region.is_empty or distance <= 0:
+        return region
+    region_mercator = shape(transform_geom("OGC:CRS84", "EPSG:3857", mapping(region)))
+    return shape(
+        transform_geom(
+            "EPSG:3857", "OGC:CRS84", mapping(region_mercator.buffer(distance))
+        )
+    )
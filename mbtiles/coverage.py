@@ -0,0 +1,121 @@
+"""Low resolution coverage of a dataset's valid data"""
+
+from collections import namedtuple
+import logging
+import math
+
+import numpy as np
+from rasterio.windows import Window
+
+log = logging.getLogger(__name__)
+
+# Maximum number of cells in a coverage grid.
+MAX_CELLS = 1024 * 1024
+
+# Maximum number of mask pixels read at once.
+MAX_READ_PIXELS = 16 * 1024 * 1024
+
+Coverage = namedtuple("Coverage", ["mask", "factor", "height", "width"])
+Coverage.__doc__ = """Grid of cells of a dataset that contain valid data
+
+Each cell of the boolean mask covers factor x factor pixels of a
+dataset that is height pixels high and width pixels wide.
+"""
+
+
+def build_coverage(src, max_cells=MAX_CELLS):
+    """Compute the coverage of a dataset
+
+    The dataset's mask is read once, in strips, and reduced to a grid
+    of no more than max_cells cells.
+
+    Parameters
+    ----------
+    src : DatasetReader
+    max_cells : int, optional
+
+    Returns
+    -------
+    Coverage
+
+    """
+    factor = max(
+        1, int(math.ceil(math.sqrt(src.width * src.height / float(max_cells))))
+    )
+    rows = -(-src.height // factor)
+    cols = -(-src.width // factor)
+    mask = np.zeros((rows, cols), dtype="bool")
+
+    log.debug(
+        "Computing coverage: name=%r, factor=%r, shape=%r", src.name, factor, mask.shape
+    )
+
+    rows_per_read = max(1, MAX_READ_PIXELS // (factor * factor * cols))
+    for row in range(0, rows, rows_per_read):
+        num_rows = min(rows_per_read, rows - row)
+        window = Window(
+            0,
+            row * factor,
+            src.width,
+            min(num_rows * factor, src.height - row * factor),
+        )
+        strip = np.zeros((num_rows * factor, cols * factor), dtype="bool")
+        data = src.read_masks(1, window=window)
+        strip[: data.shape[0], : data.shape[1]] = data
+        mask[row : row + num_rows] = strip.reshape(
+            num_rows, factor, cols, factor
+        ).any(axis=(1, 3))
+
+    return Coverage(mask, factor, src.height, src.width)
+
+
+def window_has_data(coverage, window):
+    """Determine whether a window of a dataset contains valid data
+
+    Parameters
+    ----------
+    coverage : Coverage
+    window : Window
+        A window of the full resolution dataset with integer offsets
+        and shape. It may extend beyond the dataset.
+
+    Returns
+    -------
+    bool or None
+        None if the coverage is too coarse to decide. In that case the
+        dataset's mask must be read.
+
+    """
+    col_start = max(int(window.col_off), 0)
+    col_stop = min(int(window.col_off + window.width), coverage.width)
+    row_start = max(int(window.row_off), 0)
+    row_stop = min(int(window.row_off + window.height), coverage.height)
+
+    if col_start >= col_stop or row_start >= row_stop:
+        return False
+
+    factor = coverage.factor
+
+    # Cells that intersect the window.
+    outer = coverage.mask[
+        row_start // factor : -(-row_stop // factor),
+        col_start // factor : -(-col_stop // factor),
+    ]
+    if not outer.any():
+        return False
+
+    # Cells that lie entirely within the window. Cells at the edges of
+    # the dataset may be partial.
+    rows, cols = coverage.mask.shape
+    inner = coverage.mask[
+        -(-row_start // factor) : (
+            row_stop // factor if row_stop < coverage.height else rows
+        ),
+        -(-col_start // factor) : (
+            col_stop // factor if col_stop < coverage.width else cols
+        ),
+    ]
+    if inner.any():
+        return True
+
+    return None
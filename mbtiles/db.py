@@ -0,0 +1,404 @@
+"""SQLite helpers"""
+
+import logging
+import re
+import sqlite3
+
+import numpy as np
+
+from mbtiles.bitmaps import (
+    MAX_BITMAP_BYTES,
+    add_tiles,
+    bitmap_nbytes,
+    empty_bitmap,
+    sparse_bitmap,
+)
+
+log = logging.getLogger(__name__)
+
+# Settings of the "bulk" profile that do not depend on the output.
+BULK_PRAGMAS = [
+    ("synchronous", "OFF"),
+    ("cache_size", "-262144"),
+    ("mmap_size", "268435456"),
+    ("temp_store", "MEMORY"),
+]
+
+PRAGMA_NAME_RE = re.compile(r"^[a-z_]+$")
+PRAGMA_VALUE_RE = re.compile(r"^-?[A-Za-z0-9_]+$")
+
+
+def bulk_pragmas(tile_bytes=None, appending=False):
+    """Pragmas for fast loading of many tiles
+
+    Parameters
+    ----------
+    tile_bytes : int, optional
+        Expected size of a tile image. The page size of a new database
+        is chosen to hold such an image in a few pages.
+    appending : bool
+        Whether tiles are appended to an existing database. If so, a
+        write-ahead log is used to protect the existing tiles.
+        Otherwise, there is no journal at all.
+
+    Returns
+    -------
+    list of (str, str)
+
+    """
+    pragmas = []
+
+    if not appending and tile_bytes:
+        page_size = 4096
+        while page_size < tile_bytes and page_size < 65536:
+            page_size *= 2
+        pragmas.append(("page_size", str(page_size)))
+
+    pragmas.append(("journal_mode", "WAL" if appending else "OFF"))
+    pragmas.extend(BULK_PRAGMAS)
+    return pragmas
+
+
+def apply_pragmas(conn, pragmas):
+    """Set pragmas on a connection
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    pragmas : list of (str, str)
+        Names and values of pragmas, in the order they are set.
+
+    Returns
+    -------
+    list of (str, str)
+        Names and previous values of the pragmas that were set, in the
+        order they may be restored.
+
+    Raises
+    ------
+    ValueError
+        If a pragma's name or value is not valid.
+
+    """
+    previous = []
+    for name, value in pragmas:
+        name = name.lower()
+        if not PRAGMA_NAME_RE.match(name) or not PRAGMA_VALUE_RE.match(str(value)):
+            raise ValueError("Invalid pragma: {}={}".format(name, value))
+
+        row = conn.execute("PRAGMA {};".format(name)).fetchone()
+        # The page size of an existing database can't be restored.
+        if row is not None and name != "page_size":
+            previous.insert(0, (name, str(row[0])))
+
+        row = conn.execute("PRAGMA {} = {};".format(name, value)).fetchone()
+        log.debug("Set pragma: name=%r, value=%r, result=%r", name, value, row)
+
+    return previous
+
+
+def restore_pragmas(conn, previous):
+    """Restore pragmas to the values returned by apply_pragmas
+
+    Pending changes are committed first because the journal mode can't
+    be changed within a transaction.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    previous : list of (str, str)
+
+    Returns
+    -------
+    None
+
+    """
+    conn.commit()
+    for name, value in previous:
+        conn.execute("PRAGMA {} = {};".format(name, value))
+        log.debug("Restored pragma: name=%r, value=%r", name, value)
+
+
+def has_tile_map(conn):
+    """Determine whether a database stores tiles in map and images tables
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+
+    Returns
+    -------
+    bool
+
+    """
+    return bool(
+        conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'map';"
+        ).fetchall()
+    )
+
+
+def read_metadata(conn):
+    """Read the metadata of a database
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+
+    Returns
+    -------
+    dict
+        Values by name.
+
+    """
+    return dict(conn.execute("SELECT name, value FROM metadata;").fetchall())
+
+
+def create_tile_tables(conn, deduplicate=False, index=True):
+    """Create the tables (and view) that store tiles
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    deduplicate : bool
+        If True, tiles are stored in map and images tables and read
+        through a tiles view. Otherwise they are stored in a tiles
+        table.
+    index : bool
+        Whether to create the unique index of tile keys now. It may
+        instead be created by create_tile_index after tiles are
+        loaded, which is faster for large numbers of tiles.
+
+    Returns
+    -------
+    None
+
+    """
+    cur = conn.cursor()
+    if deduplicate:
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS map "
+            "(zoom_level integer, tile_column integer, "
+            "tile_row integer, tile_id text);"
+        )
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS images (tile_data blob, tile_id text);"
+        )
+        # Deduplication of images relies on this index.
+        cur.execute("CREATE UNIQUE INDEX images_id ON images (tile_id);")
+        cur.execute(
+            "CREATE VIEW tiles AS SELECT "
+            "map.zoom_level AS zoom_level, "
+            "map.tile_column AS tile_column, "
+            "map.tile_row AS tile_row, "
+            "images.tile_data AS tile_data "
+            "FROM map JOIN images ON images.tile_id = map.tile_id;"
+        )
+    else:
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS tiles "
+            "(zoom_level integer, tile_column integer, "
+            "tile_row integer, tile_data blob);"
+        )
+
+    if index:
+        create_tile_index(conn, deduplicate=deduplicate)
+
+
+def create_tile_index(conn, deduplicate=False):
+    """Create the unique index of tile keys, if it does not exist
+
+    If tiles were loaded without the index and a tile was inserted more
+    than once, only its last insertion is kept.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    deduplicate : bool
+        Whether tiles are stored in map and images tables.
+
+    Returns
+    -------
+    None
+
+    """
+    table, index = ("map", "map_index") if deduplicate else ("tiles", "idx_zcr")
+    sql = (
+        "CREATE UNIQUE INDEX IF NOT EXISTS {} "
+        "ON {} (zoom_level, tile_column, tile_row);".format(index, table)
+    )
+    try:
+        conn.execute(sql)
+    except sqlite3.IntegrityError:
+        log.warning("Removing duplicate tiles before creating index %r", index)
+        conn.execute(
+            "DELETE FROM {0} WHERE rowid NOT IN "
+            "(SELECT max(rowid) FROM {0} "
+            "GROUP BY zoom_level, tile_column, tile_row);".format(table)
+        )
+        conn.execute(sql)
+
+
+def read_tile_bitmaps(conn, deduplicate=False, chunk_size=100000):
+    """Read the keys of the stored tiles into bitmaps
+
+    A bitmap of a zoom level spans the stored tiles of the zoom level
+    and takes one bit per tile, much less than a set of keys. The
+    tiles of a zoom level that are spread too far apart for a bitmap
+    are kept as sorted keys instead.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    deduplicate : bool
+        Whether tiles are stored in map and images tables.
+    chunk_size : int, optional
+        Number of keys read at once.
+
+    Returns
+    -------
+    dict
+        TileBitmap or TileKeys by zoom level. Columns and rows are those of the
+        MBTiles file, with rows counted from the south.
+
+    """
+    table = "map" if deduplicate else "tiles"
+    extents = conn.execute(
+        "SELECT zoom_level, min(tile_column), max(tile_column), "
+        "min(tile_row), max(tile_row) FROM {} GROUP BY zoom_level;".format(table)
+    ).fetchall()
+
+    bitmaps = {}
+    for zoom, col_min, col_max, row_min, row_max in extents:
+        sparse = bitmap_nbytes(col_min, col_max, row_min, row_max) > MAX_BITMAP_BYTES
+        if sparse:
+            chunks = []
+        else:
+            bitmap = empty_bitmap(col_min, col_max, row_min, row_max)
+        cur = conn.execute(
+            "SELECT tile_column, tile_row FROM {} WHERE zoom_level = ?;".format(table),
+            (zoom,),
+        )
+        while True:
+            keys = cur.fetchmany(chunk_size)
+            if not keys:
+                break
+            cols, rows = zip(*keys)
+            if sparse:
+                chunks.append(
+                    (np.array(cols, dtype="int64"), np.array(rows, dtype="int64"))
+                )
+            else:
+                add_tiles(bitmap, cols, rows)
+
+        if sparse:
+            cols, rows = zip(*chunks)
+            bitmap = sparse_bitmap(
+                col_min,
+                col_max,
+                row_min,
+                row_max,
+                np.concatenate(cols),
+                np.concatenate(rows),
+            )
+
+        log.debug(
+            "Read tile bitmap: zoom=%r, width=%r, height=%r, sparse=%r",
+            zoom,
+            bitmap.width,
+            bitmap.height,
+            sparse,
+        )
+        bitmaps[zoom] = bitmap
+
+    return bitmaps
+
+
+def delete_tiles(conn, keys, deduplicate=False):
+    """Delete tiles by key
+
+    Images of deduplicated tiles are not deleted, even if no longer
+    used.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    keys : iterable of (int, int, int)
+        Zoom levels, columns, and rows of the tiles, as stored.
+    deduplicate : bool
+        Whether tiles are stored in map and images tables.
+
+    Returns
+    -------
+    int
+        The number of deleted tiles.
+
+    """
+    table = "map" if deduplicate else "tiles"
+    cur = conn.executemany(
+        "DELETE FROM {} "
+        "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;".format(table),
+        keys,
+    )
+    return cur.rowcount
+
+
+def merge_shards(conn, paths, deduplicate=False):
+    """Merge the tiles of shards into a database
+
+    Each shard is attached to the connection and its tiles are copied
+    with a single INSERT ... SELECT statement, replacing tiles of the
+    same key. Pending changes are committed first because databases
+    can't be attached within a transaction, and each shard is committed
+    after it is copied.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    paths : list of str
+        Paths of MBTiles files with the same layout as the database,
+        see create_tile_tables.
+    deduplicate : bool
+        Whether tiles are stored in map and images tables.
+
+    Returns
+    -------
+    int
+        The number of merged tiles.
+
+    """
+    conn.commit()
+    count = 0
+    for path in paths:
+        conn.execute("ATTACH DATABASE ? AS shard;", (path,))
+        try:
+            if deduplicate:
+                conn.execute(
+                    "INSERT OR IGNORE INTO main.images (tile_data, tile_id) "
+                    "SELECT tile_data, tile_id FROM shard.images;"
+                )
+                cur = conn.execute(
+                    "INSERT OR REPLACE INTO main.map "
+                    "(zoom_level, tile_column, tile_row, tile_id) "
+                    "SELECT zoom_level, tile_column, tile_row, tile_id "
+                    "FROM shard.map;"
+                )
+            else:
+                cur = conn.execute(
+                    "INSERT OR REPLACE INTO main.tiles "
+                    "(zoom_level, tile_column, tile_row, tile_data) "
+                    "SELECT zoom_level, tile_column, tile_row, tile_data "
+                    "FROM shard.tiles;"
+                )
+            conn.commit()
+        except Exception:
+            # A shard can't be detached within a transaction.
+            conn.rollback()
+            raise
+        finally:
+            conn.execute("DETACH DATABASE shard;")
+
+        log.debug("Merged shard: path=%r, count=%r", path, cur.rowcount)
+        count += cur.rowcount
+
+    return count
@@ -0,0 +1,175 @@
+"""Encoders of tile images
+
+An encoder turns a warped array into the bytes of a tile image. The
+"gdal" encoder uses GDAL's image drivers and accepts any creation
+option. The "pillow" encoder requires Pillow and avoids the creation of
+a GDAL dataset for every image. It accepts the creation options that
+are documented for the command and makes the same images as GDAL,
+except for the details of compression.
+"""
+
+import io
+
+from rasterio.io import MemoryFile
+
+ENCODERS = ["gdal", "pillow"]
+
+# Numbers of bands that Pillow can encode.
+PILLOW_COUNTS = [1, 2, 3, 4]
+
+# Creation options that describe the dataset instead of its encoding.
+DATASET_KEYS = [
+    "driver",
+    "dtype",
+    "nodata",
+    "width",
+    "height",
+    "count",
+    "crs",
+    "transform",
+]
+
+# Values of boolean creation options.
+TRUE_VALUES = ["TRUE", "YES", "ON", "1"]
+
+
+def encode_gdal(data, kwds):
+    """Encode an array as an image using a GDAL driver
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Bands, rows, and columns of the image.
+    kwds : dict
+        Creation options of the image, including the driver.
+
+    Returns
+    -------
+    bytes
+
+    """
+    with MemoryFile() as memfile:
+        with memfile.open(**kwds) as dst:
+            dst.write(data)
+        return memfile.read()
+
+
+def pillow_options(driver, count, creation_options):
+    """Translate GDAL creation options to Pillow save options
+
+    Parameters
+    ----------
+    driver : str
+        JPEG, PNG, or WEBP.
+    count : int
+        Number of bands of the image.
+    creation_options : dict
+        GDAL creation options of the image.
+
+    Returns
+    -------
+    dict
+
+    Raises
+    ------
+    ValueError
+        If the image or an option can't be encoded by Pillow.
+
+    """
+    driver = driver.upper()
+    if count not in PILLOW_COUNTS or (driver == "JPEG" and count not in (1, 3)):
+        raise ValueError(
+            "Pillow can't encode {} images of {} bands".format(driver, count)
+        )
+
+    # Defaults of GDAL's drivers, where they differ from Pillow's.
+    options = {"quality": 75} if driver == "WEBP" else {}
+
+    for key, value in creation_options.items():
+        key = key.upper()
+        if key == "QUALITY" and driver in ("JPEG", "WEBP"):
+            options["quality"] = int(float(value))
+        elif key == "ZLEVEL" and driver == "PNG":
+            options["compress_level"] = int(value)
+        elif key == "LOSSLESS" and driver == "WEBP":
+            options["lossless"] = str(value).upper() in TRUE_VALUES
+        else:
+            raise ValueError(
+                "Creation option {}={} is not supported by the pillow encoder".format(
+                    key, value
+                )
+            )
+
+    return options
+
+
+def encode_pillow(data, kwds):
+    """Encode an array as an image using Pillow
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Bands, rows, and columns of the image.
+    kwds : dict
+        Creation options of the image, including the driver. Options
+        that describe the dataset, such as its transform, are ignored.
+
+    Returns
+    -------
+    bytes
+
+    """
+    from PIL import Image
+
+    driver = kwds["driver"].upper()
+    count = data.shape[0]
+    creation_options = {
+        key: value for key, value in kwds.items() if key.lower() not in DATASET_KEYS
+    }
+    options = pillow_options(driver, count, creation_options)
+
+    # Like GDAL's PNG driver, mark nodata pixels of images without
+    # alpha as transparent.
+    nodata = kwds.get("nodata")
+    if driver == "PNG" and nodata is not None and count in (1, 3):
+        options["transparency"] = int(nodata) if count == 1 else (int(nodata),) * 3
+
+    # The image mode follows from the shape of the pixels.
+    pixels = data[0] if count == 1 else data.transpose(1, 2, 0)
+    image = Image.fromarray(pixels)
+
+    buf = io.BytesIO()
+    image.save(buf, format=driver, **options)
+    return buf.getvalue()
+
+
+def get_encoder(name):
+    """Get an encoder by name
+
+    Parameters
+    ----------
+    name : str
+        One of ENCODERS.
+
+    Returns
+    -------
+    function
+        A function of an array and creation options that returns the
+        bytes of an image.
+
+    Raises
+    ------
+    ValueError
+        If the encoder is unknown or can't be used.
+
+    """
+    if name == "gdal":
+        return encode_gdal
+    elif name == "pillow":
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            raise ValueError("The pillow encoder requires Pillow")
+        return encode_pillow
+    else:
+        raise ValueError("Unknown encoder: {}".format(name))
@@ -4,7 +4,7 @@ from multiprocessing import Pool
 import warnings
 
 from mbtiles.compat import zip_longest
-from mbtiles.worker import init_worker, process_tile
+from mbtiles.worker import DATASET_CACHE_SIZE, init_worker, process_tile
 
 BATCH_SIZE = 100
 
@@ -31,9 +31,43 @@ def process_tiles(
     warp_options=None,
     creation_options=None,
     exclude_empty_tiles=True,
+    transport="pickle",
+    pyramid_source=None,
+    pyramid_resampling=None,
+    hash_images=False,
+    coverage=None,
+    metatile_size=1,
+    encoder="gdal",
+    overview_plan=None,
+    overview_source=None,
+    sources=None,
+    dataset_cache_size=DATASET_CACHE_SIZE,
+    shard_dir=None,
 ):
     """Warp raster into tiles and commit tiles to mbtiles database.
+
+    Only the "pickle" transport of results and metatiles of 1 tile are
+    supported. If pyramid_source, the path of an MBTiles file, is
+    given, tiles are built by downsampling their children in that file
+    instead of being warped from the input file. If hash_images is
+    True, workers identify each image by a hash of its content. A
+    coverage of the input file, if given, lets workers skip empty tiles
+    without reading the input file's mask. Tile images are encoded by
+    the named encoder, see mbtiles.encoders. An overview plan, a dict
+    of overview levels by zoom level, lets workers warp from overviews
+    of the input file, or of the overview_source dataset if given. If
+    sources, a list of mbtiles.sources.Source, is given, tiles are
+    warped from the sources that intersect them instead of the input
+    file, and each worker keeps up to dataset_cache_size of them open.
+    Sharded output is not supported.
     """
+    if transport != "pickle":
+        raise ValueError("Unsupported transport: {}".format(transport))
+    if shard_dir is not None:
+        raise ValueError("Unsupported shard directory: {}".format(shard_dir))
+    if metatile_size != 1:
+        raise ValueError("Unsupported metatile size: {}".format(metatile_size))
+
     pool = Pool(
         num_workers,
         init_worker,
@@ -45,6 +79,19 @@ def process_tiles(
             warp_options,
             creation_options,
             exclude_empty_tiles,
+            None,
+            None,
+            pyramid_source,
+            pyramid_resampling,
+            hash_images,
+            coverage,
+            metatile_size,
+            encoder,
+            overview_plan,
+            overview_source,
+            sources,
+            dataset_cache_size,
+            None,
         ),
         100 * BATCH_SIZE,
     )
@@ -61,8 +108,7 @@ def process_tiles(
         for group_n, item in enumerate(group, start=1):
             if item is None:
                 break
-            tile, contents = item
-            insert_results(tile, contents, img_ext=img_ext, image_dump=image_dump)
+            insert_results(*item, img_ext=img_ext, image_dump=image_dump)
 
         commit_mbtiles()
 
@@ -71,3 +117,4 @@ def process_tiles(
                 progress_bar.update(group_n)
 
     pool.close()
+    pool.join()
@@ -0,0 +1,161 @@
+"""Spatially coherent orders of tiles"""
+
+from collections import OrderedDict
+
+import mercantile
+from mercantile import Tile
+
+# Limits of latitude used by mercantile.tiles.
+MAX_LAT = 85.051129
+
+
+def _rotate(size, x, y, rx, ry):
+    """Rotate or flip a quadrant of a Hilbert curve"""
+    if ry == 0:
+        if rx == 1:
+            x = size - 1 - x
+            y = size - 1 - y
+        x, y = y, x
+    return x, y
+
+
+def hilbert_index(tile):
+    """Position of a tile along the Hilbert curve of its zoom level
+
+    Parameters
+    ----------
+    tile : mercantile.Tile
+
+    Returns
+    -------
+    int
+
+    """
+    size = 2 ** tile.z
+    x, y = tile.x, tile.y
+    index = 0
+    s = size // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        index += s * s * ((3 * rx) ^ ry)
+        x, y = _rotate(size, x, y, rx, ry)
+        s //= 2
+    return index
+
+
+def _hilbert_xy(size, index):
+    """Column and row of the tile at an index of a Hilbert curve"""
+    x = y = 0
+    s = 1
+    while s < size:
+        rx = 1 & (index // 2)
+        ry = 1 & (index ^ rx)
+        x, y = _rotate(s, x, y, rx, ry)
+        x += s * rx
+        y += s * ry
+        index //= 4
+        s *= 2
+    return x, y
+
+
+def _hilbert_rectangle(zoom, xmin, ymin, xmax, ymax):
+    """Tiles of a rectangle of a zoom level, in Hilbert order
+
+    The curve is traversed depth first, skipping quadrants that do not
+    intersect the rectangle, so tiles are generated one at a time.
+    """
+    size = 2 ** zoom
+    stack = [(0, zoom)]
+    while stack:
+        start, level = stack.pop()
+        side = 1 << level
+        x, y = _hilbert_xy(size, start)
+        x -= x % side
+        y -= y % side
+
+        if x > xmax or x + side - 1 < xmin or y > ymax or y + side - 1 < ymin:
+            continue
+        elif level == 0:
+            yield Tile(x, y, zoom)
+        else:
+            quarter = 1 << (2 * (level - 1))
+            for i in (3, 2, 1, 0):
+                stack.append((start + i * quarter, level - 1))
+
+
+def hilbert_tiles(west, south, east, north, zooms):
+    """Get the tiles overlapped by a bounding box, in Hilbert order
+
+    The tiles are the same as those of mercantile.tiles.
+
+    Parameters
+    ----------
+    west, south, east, north : float
+        Bounding values in decimal degrees.
+    zooms : int or sequence of int
+        One or more zoom levels.
+
+    Yields
+    ------
+    Tile
+
+    """
+    if west > east:
+        bboxes = [(-180.0, south, east, north), (west, south, 180.0, north)]
+    else:
+        bboxes = [(west, south, east, north)]
+
+    if isinstance(zooms, int):
+        zooms = [zooms]
+
+    for zoom in zooms:
+        for w, s, e, n in bboxes:
+            w = max(-180.0, w)
+            s = max(-MAX_LAT, s)
+            e = min(180.0, e)
+            n = min(MAX_LAT, n)
+
+            ul_tile = mercantile.tile(w, n, zoom)
+            lr_tile = mercantile.tile(
+                e - mercantile.LL_EPSILON, s + mercantile.LL_EPSILON, zoom
+            )
+            for tile in _hilbert_rectangle(
+                zoom, ul_tile.x, ul_tile.y, lr_tile.x, lr_tile.y
+            ):
+                yield tile
+
+
+def metatiles(tiles, size):
+    """Group tiles of the same metatile
+
+    A metatile of a given size is a block of size x size tiles of a zoom
+    level. Consecutive tiles of the same band of size columns, such as
+    those of mercantile.tiles, which yields tiles column by column, are
+    buffered and grouped by metatile, in the order of their first tiles.
+    Tiles in Hilbert order are grouped completely if the size is a power
+    of two.
+
+    Parameters
+    ----------
+    tiles : iterable of mercantile.Tile
+    size : int
+
+    Yields
+    ------
+    list of mercantile.Tile
+
+    """
+    band = OrderedDict()
+    band_key = None
+    for tile in tiles:
+        tile_band_key = (tile.z, tile.x // size)
+        if band and tile_band_key != band_key:
+            for group in band.values():
+                yield group
+            band = OrderedDict()
+        band_key = tile_band_key
+        band.setdefault((tile.z, tile.x // size, tile.y // size), []).append(tile)
+
+    for group in band.values():
+        yield group
@@ -0,0 +1,192 @@
+"""Selection of source overviews for zoom levels"""
+
+import logging
+import os
+
+import mercantile
+import rasterio
+from rasterio.enums import Resampling
+import rasterio.shutil
+
+from mbtiles.worker import source_window
+
+log = logging.getLogger(__name__)
+
+# Resampling methods that GDAL can use to build overviews.
+OVERVIEW_RESAMPLING = [
+    "nearest",
+    "bilinear",
+    "cubic",
+    "cubic_spline",
+    "lanczos",
+    "average",
+    "mode",
+    "gauss",
+    "rms",
+]
+
+
+def overview_level(factors, ratio):
+    """Choose the coarsest overview that is not coarser than needed
+
+    Parameters
+    ----------
+    factors : list of int
+        Decimation factors of a dataset's overviews, in order.
+    ratio : float
+        Number of source pixels per tile pixel.
+
+    Returns
+    -------
+    int or None
+        The index of the overview, as used by GDAL's OVERVIEW_LEVEL open
+        option, or None if the full resolution dataset is needed.
+
+    """
+    level = None
+    for i, factor in enumerate(factors):
+        if factor <= ratio:
+            level = i
+    return level
+
+
+def zoom_ratios(src, zooms, tile_size, west, south, east, north):
+    """Compute the number of source pixels per tile pixel of zoom levels
+
+    The ratio varies over a zoom level. It is sampled at the center and
+    corners of the bounds, and the smallest value is kept, so that no
+    part of a zoom level is made from an overview that is too coarse.
+
+    Parameters
+    ----------
+    src : DatasetReader
+    zooms : iterable of int
+    tile_size : int
+    west, south, east, north : float
+        Bounds of the export, in decimal degrees.
+
+    Returns
+    -------
+    dict
+        Ratio by zoom level.
+
+    """
+    points = [
+        ((west + east) / 2.0, (south + north) / 2.0),
+        (west, north),
+        (east, north),
+        (west, south),
+        (east, south),
+    ]
+
+    ratios = {}
+    for zoom in zooms:
+        samples = []
+        for lng, lat in points:
+            tile = mercantile.tile(lng, lat, zoom)
+            try:
+                window = source_window(tile, src.crs, src.transform)
+            except ValueError:
+                continue
+            # The window is padded by one pixel on each side.
+            samples.append(
+                min(window.width - 2, window.height - 2) / float(tile_size)
+            )
+
+        if samples:
+            ratios[zoom] = min(samples)
+
+    return ratios
+
+
+def plan_overviews(src, zooms, tile_size, west, south, east, north):
+    """Choose overviews of a dataset for zoom levels
+
+    Parameters
+    ----------
+    src : DatasetReader
+    zooms : iterable of int
+    tile_size : int
+    west, south, east, north : float
+        Bounds of the export, in decimal degrees.
+
+    Returns
+    -------
+    dict
+        Overview level, or None, by zoom level. Empty if the dataset
+        has no overviews.
+
+    """
+    factors = src.overviews(1)
+    if not factors:
+        return {}
+
+    ratios = zoom_ratios(src, zooms, tile_size, west, south, east, north)
+    plan = {zoom: overview_level(factors, ratio) for zoom, ratio in ratios.items()}
+
+    log.debug("Overview plan: factors=%r, plan=%r", factors, plan)
+    return plan
+
+
+def overview_factors(ratios):
+    """Choose decimation factors of overviews for zoom levels
+
+    Parameters
+    ----------
+    ratios : iterable of float
+        Numbers of source pixels per tile pixel, see zoom_ratios.
+
+    Returns
+    -------
+    list of int
+        Powers of two, up to the largest ratio. Empty if no zoom level
+        is coarser than half the resolution of the source.
+
+    """
+    largest = max(ratios) if ratios else 0
+    factors = []
+    factor = 2
+    while factor <= largest:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def build_temporary_overviews(src, directory, factors, resampling="nearest"):
+    """Build overviews of a dataset outside of the dataset
+
+    A VRT of the dataset is written in the directory and its overviews
+    are built there, leaving the dataset untouched. The full resolution
+    dataset is read once. Removing the directory removes the overviews.
+
+    Parameters
+    ----------
+    src : DatasetReader
+    directory : str
+        A scratch directory.
+    factors : list of int
+        Decimation factors of the overviews.
+    resampling : str, optional
+        Resampling method. Methods that GDAL can't use for overviews
+        are replaced by nearest.
+
+    Returns
+    -------
+    str
+        Path of the VRT, which has the overviews.
+
+    """
+    if resampling not in OVERVIEW_RESAMPLING:
+        resampling = "nearest"
+
+    path = os.path.join(directory, "overviews.vrt")
+    log.info(
+        "Building temporary overviews: path=%r, factors=%r, resampling=%r",
+        path,
+        factors,
+        resampling,
+    )
+    rasterio.shutil.copy(src, path, driver="VRT")
+    with rasterio.open(path, "r+") as dst:
+        dst.build_overviews(factors, Resampling[resampling])
+    return path
@@ -0,0 +1,253 @@
+"""Partitions of an export by quadkey"""
+
+import functools
+import logging
+import math
+
+import mercantile
+from rasterio.warp import transform_geom
+from shapely.geometry import box, mapping, shape
+from shapely.ops import unary_union
+import supermercado.burntiles
+
+from mbtiles.changes import polygon_features
+from mbtiles.order import hilbert_index
+
+log = logging.getLogger(__name__)
+
+# Partitions are made of at least this many quadkeys each, when there
+# are enough, so that their estimated numbers of tiles can be balanced.
+QUADKEYS_PER_PARTITION = 16
+
+# Latitude limits of the Web Mercator projection.
+MAX_LATITUDE = 85.051129
+
+
+def estimate_tile_count(west, south, east, north, minzoom, maxzoom, cutline=None):
+    """Estimate the number of tiles of an export
+
+    Tiles of low zoom levels are counted until a zoom level has about
+    16 times more tiles than the bounds would fill. The tiles of higher
+    zoom levels are estimated from the area of the bounds, or of the
+    cutline.
+
+    Parameters
+    ----------
+    west, south, east, north : float
+        Bounds of the export, in decimal degrees.
+    minzoom, maxzoom : int
+    cutline : list of GeoJSON features, optional
+        Polygons in decimal degrees.
+
+    Returns
+    -------
+    int
+
+    """
+    west_merc, south_merc = mercantile.xy(west, south)
+    east_merc, north_merc = mercantile.xy(east, north)
+    raster_area = (east_merc - west_merc) * (north_merc - south_merc)
+
+    est_num_tiles = 0
+    zoom = minzoom
+
+    (
+        minz_west_merc,
+        minz_south_merc,
+        minz_east_merc,
+        minz_north_merc,
+    ) = mercantile.xy_bounds(mercantile.tile(0, 0, zoom))
+    minzoom_tile_area = (minz_east_merc - minz_west_merc) * (
+        minz_north_merc - minz_south_merc
+    )
+    ratio = min_ratio = raster_area / minzoom_tile_area
+
+    # If given a cutline, we use its mercator area and the
+    # supermercado module to help estimate the number of output
+    # tiles.
+    if cutline:
+        geoms = [shape(f["geometry"]) for f in cutline]
+        union = unary_union(geoms)
+        cutline_mercator = transform_geom("OGC:CRS84", "EPSG:3857", mapping(union))
+        min_ratio *= shape(cutline_mercator).area / raster_area
+        ratio = min_ratio
+        estimator = functools.partial(supermercado.burntiles.burn, cutline)
+    else:
+        estimator = functools.partial(mercantile.tiles, west, south, east, north)
+
+    est_num_tiles = len(list(estimator(zoom)))
+    ratio *= 4.0
+
+    while zoom < maxzoom and ratio < 16:
+        zoom += 1
+        est_num_tiles += len(list(estimator(zoom)))
+        ratio *= 4.0
+    else:
+        zoom += 1
+
+    est_num_tiles += int(
+        sum(
+            math.ceil(math.pow(4.0, z - minzoom) * min_ratio)
+            for z in range(zoom, maxzoom + 1)
+        )
+    )
+
+    return est_num_tiles
+
+
+def in_covers(tile, covers):
+    """Determine whether a tile is within, or contains, a quadkey's tile
+
+    Parameters
+    ----------
+    tile : mercantile.Tile
+    covers : list of mercantile.Tile
+        The tiles of quadkeys.
+
+    Returns
+    -------
+    bool
+
+    """
+    for cover in covers:
+        if tile.z >= cover.z:
+            shift = tile.z - cover.z
+            if (tile.x >> shift, tile.y >> shift) == (cover.x, cover.y):
+                return True
+        else:
+            shift = cover.z - tile.z
+            if (cover.x >> shift, cover.y >> shift) == (tile.x, tile.y):
+                return True
+    return False
+
+
+def partition_quadkeys(
+    west, south, east, north, minzoom, maxzoom, partitions, cutline=None
+):
+    """Divide an export into partitions of about the same number of tiles
+
+    The export is divided into the tiles of the lowest zoom level that
+    has enough of them, and these are split into runs along a Hilbert
+    curve, so that each partition covers a compact region. Tiles of
+    lower zoom levels that contain the quadkeys of more than one
+    partition are made by each of them.
+
+    Parameters
+    ----------
+    west, south, east, north : float
+        Bounds of the export, in decimal degrees.
+    minzoom, maxzoom : int
+    partitions : int
+        Number of partitions.
+    cutline : list of GeoJSON features, optional
+        Polygons in decimal degrees.
+
+    Returns
+    -------
+    list of (list of str, int)
+        Quadkeys and estimated number of tiles of the partitions.
+        There are fewer partitions than requested if the maximum zoom
+        level has too few tiles.
+
+    """
+    west = max(-180.0, west)
+    south = max(-MAX_LATITUDE, south)
+    east = min(180.0, east)
+    north = min(MAX_LATITUDE, north)
+    bounds = box(west, south, east, north)
+
+    if cutline:
+        region = unary_union([shape(f["geometry"]) for f in cutline])
+
+        def zoom_tiles(zoom):
+            return [
+                mercantile.Tile(*(int(v) for v in arr))
+                for arr in supermercado.burntiles.burn(cutline, zoom)
+            ]
+
+    else:
+        region = None
+
+        def zoom_tiles(zoom):
+            return list(mercantile.tiles(west, south, east, north, [zoom]))
+
+    zoom = 0
+    tiles = zoom_tiles(zoom)
+    while zoom < maxzoom and len(tiles) < QUADKEYS_PER_PARTITION * partitions:
+        zoom += 1
+        tiles = zoom_tiles(zoom)
+
+    tiles.sort(key=hilbert_index)
+
+    weights = []
+    for tile in tiles:
+        area = bounds.intersection(box(*mercantile.bounds(tile)))
+        if area.is_empty:
+            weights.append(0)
+            continue
+        if region is not None:
+            features = polygon_features(region.intersection(area))
+            if not features:
+                weights.append(0)
+                continue
+        else:
+            features = None
+        area_west, area_south, area_east, area_north = area.bounds
+        weights.append(
+            estimate_tile_count(
+                area_west,
+                area_south,
+                area_east,
+                area_north,
+                minzoom,
+                maxzoom,
+                cutline=features,
+            )
+        )
+
+    log.debug(
+        "Partition quadkeys: zoom=%r, count=%r, tiles=%r", zoom, len(tiles), sum(weights)
+    )
+
+    # Runs end where the cumulative number of tiles passes a multiple of
+    # a partition's share. Quadkeys without tiles are left out.
+    total = float(sum(weights))
+    result = []
+    quadkeys = []
+    count = cumulative = 0
+    for tile, weight in zip(tiles, weights):
+        if not weight:
+            continue
+        quadkeys.append(mercantile.quadkey(tile))
+        count += weight
+        cumulative += weight
+        if (
+            len(result) < partitions - 1
+            and cumulative >= total * (len(result) + 1) / partitions
+        ):
+            result.append((quadkeys, count))
+            quadkeys = []
+            count = 0
+    if quadkeys:
+        result.append((quadkeys, count))
+
+    return result
+
+
+def union_bounds(values):
+    """Find the union of the bounds of MBTiles files
+
+    Parameters
+    ----------
+    values : list of str
+        Values of the bounds metadata of the files.
+
+    Returns
+    -------
+    str
+        The value of the bounds metadata of the union.
+
+    """
+    bounds = [[float(v) for v in value.split(",")] for value in values]
+    west, south, east, north = zip(*bounds)
+    return "%f,%f,%f,%f" % (min(west), min(south), max(east), max(north))
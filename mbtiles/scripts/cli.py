@@ -1,11 +1,16 @@
 """mbtiles CLI"""
 
 import functools
+import glob
+import itertools
+import json
 import logging
 import math
 import os
+import shutil
 import sqlite3
 import sys
+import tempfile
 
 import click
 from cligj.features import iter_features
@@ -13,21 +18,72 @@ import mercantile
 import rasterio
 from rasterio.enums import Resampling
 from rasterio.rio.options import creation_options, output_opt, _cb_key_val
-from rasterio.warp import transform, transform_geom
-import shapely.affinity
-from shapely.geometry import mapping, shape
+from rasterio.warp import transform
+from shapely.geometry import box, shape
 from shapely.ops import unary_union
-import shapely.wkt
 import supermercado.burntiles
 from tqdm import tqdm
 
 from mbtiles import __version__ as mbtiles_version
+from mbtiles.bitmaps import has_tile
+from mbtiles.changes import (
+    changed_region as find_changed_region,
+    mercator_pixel_size,
+    pad_distance,
+    pad_region,
+    region_tiles,
+)
+from mbtiles.coverage import build_coverage, window_has_data
+from mbtiles.db import (
+    apply_pragmas,
+    bulk_pragmas,
+    create_tile_index,
+    create_tile_tables,
+    delete_tiles,
+    has_tile_map,
+    merge_shards,
+    read_metadata,
+    read_tile_bitmaps,
+    restore_pragmas,
+    PRAGMA_NAME_RE,
+    PRAGMA_VALUE_RE,
+)
+from mbtiles.encoders import ENCODERS, get_encoder, pillow_options
+from mbtiles.order import hilbert_index, hilbert_tiles
+from mbtiles.overviews import (
+    build_temporary_overviews,
+    overview_factors,
+    plan_overviews,
+    zoom_ratios,
+)
+from mbtiles.partitions import (
+    estimate_tile_count,
+    in_covers,
+    partition_quadkeys,
+    union_bounds,
+)
+from mbtiles.sources import (
+    build_source_index,
+    pixel_cutline,
+    query_sources,
+    read_sources,
+)
+from mbtiles.worker import (
+    DATASET_CACHE_SIZE,
+    image_id,
+    ShardedImage,
+    source_windows,
+)
 
 
 DEFAULT_NUM_WORKERS = None
 RESAMPLING_METHODS = [method.name for method in Resampling]
 TILES_CRS = "EPSG:3857"
 
+# Number of candidate tiles whose windows are computed at once when
+# pruning tiles.
+PRUNE_CHUNK_SIZE = 1024
+
 log = logging.getLogger(__name__)
 
 
@@ -93,13 +149,21 @@ def extract_features(ctx, param, value):
         return None
 
 
+def extract_pragmas(ctx, param, value):
+    pragmas = _cb_key_val(ctx, param, value)
+    for name, val in pragmas.items():
+        if not PRAGMA_NAME_RE.match(name) or not PRAGMA_VALUE_RE.match(val):
+            raise click.BadParameter("Invalid pragma: {}={}".format(name, val))
+    return pragmas
+
+
 @click.command(short_help="Export a dataset to MBTiles.")
 @click.argument(
     "files",
     nargs=-1,
     type=click.Path(resolve_path=True),
     required=True,
-    metavar="INPUT [OUTPUT]",
+    metavar="INPUT... [OUTPUT]",
 )
 @output_opt
 @click.option(
@@ -108,6 +172,12 @@ def extract_features(ctx, param, value):
     is_flag=True,
     help="Append tiles to an existing file or overwrite.",
 )
+@click.option(
+    "--resume",
+    default=False,
+    is_flag=True,
+    help="Skip the tiles that are already in the output file, such as those written by an interrupted run of the same command. Requires --append.",
+)
 @click.option("--title", help="MBTiles dataset title.")
 @click.option("--description", help="MBTiles dataset description.")
 @click.option(
@@ -177,6 +247,84 @@ def extract_features(ctx, param, value):
     show_default=True,
     help="Resampling method to use.",
 )
+@click.option(
+    "--overviews/--no-overviews",
+    default=True,
+    show_default=True,
+    help="Warp each zoom level from the coarsest overview of the input dataset that is at least as fine as its tiles. Not used if an OVERVIEW_LEVEL open option is given.",
+)
+@click.option(
+    "--temporary-overviews",
+    default=False,
+    is_flag=True,
+    help="If the input dataset has no overviews, build overviews in a scratch directory before tiling, warp low zoom levels from them, and delete them afterwards.",
+)
+@click.option(
+    "--pyramid",
+    default=False,
+    is_flag=True,
+    help="Warp only the maximum zoom level from the input dataset and make the tiles of each lower zoom level by downsampling the four tiles below them. Can't be combined with --covers or --partitions.",
+)
+@click.option(
+    "--pyramid-resampling",
+    type=click.Choice(RESAMPLING_METHODS),
+    default="average",
+    show_default=True,
+    help="Resampling method to use when downsampling tiles to make a pyramid.",
+)
+@click.option(
+    "--deduplicate",
+    default=False,
+    is_flag=True,
+    help="Store each distinct tile image only once, using separate map and images tables and a tiles view. When appending, the layout of the existing output file is kept.",
+)
+@click.option(
+    "--insert-batch-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="Maximum number of tiles to insert into the output file at once.",
+)
+@click.option(
+    "--insert-batch-bytes",
+    type=click.IntRange(min=1),
+    default=32 * 1024 * 1024,
+    show_default=True,
+    help="Maximum number of image bytes to insert into the output file at once.",
+)
+@click.option(
+    "--single-transaction",
+    default=False,
+    is_flag=True,
+    help="Commit tiles to the output file only at the end of the export (or at the end of each zoom level with --pyramid) instead of periodically.",
+)
+@click.option(
+    "--sqlite-profile",
+    type=click.Choice(["default", "bulk"]),
+    default="default",
+    show_default=True,
+    help="SQLite settings used while writing tiles. The bulk profile turns off syncing and journaling (or uses a write-ahead log when appending) and uses large caches.",
+)
+@click.option(
+    "--sqlite-pragma",
+    "sqlite_pragmas",
+    metavar="NAME=VALUE",
+    multiple=True,
+    callback=extract_pragmas,
+    help="SQLite pragma to set while writing tiles, overriding the profile's value. Settings other than the page size are restored after writing.",
+)
+@click.option(
+    "--defer-index",
+    default=False,
+    is_flag=True,
+    help="Create the unique index of tiles after loading them instead of before. This is faster for large numbers of tiles and applies only to new output files.",
+)
+@click.option(
+    "--sharded-output",
+    default=False,
+    is_flag=True,
+    help="Workers write tiles to their own temporary MBTiles shards, which are merged into the output file after each pass, instead of sending them to the main process. Requires the concurrent.futures implementation and the pickle transport.",
+)
 @click.version_option(version=mbtiles_version, message="%(version)s")
 @click.option(
     "--rgba", default=False, is_flag=True, help="Select RGBA output. For PNG or WEBP only."
@@ -188,10 +336,27 @@ def extract_features(ctx, param, value):
     default=None,
     help="Concurrency implementation. Use concurrent.futures (cf) or multiprocessing (mp).",
 )
+@click.option(
+    "--result-transport",
+    type=click.Choice(["pickle", "shared-memory"]),
+    default="pickle",
+    show_default=True,
+    help="How workers pass tile images back to the main process. The shared-memory transport requires the concurrent.futures implementation and python>=3.8.",
+)
 @click.option(
     "--progress-bar", "-#", default=False, is_flag=True, help="Display progress bar."
 )
-@click.option("--covers", help="Restrict mbtiles output to cover a quadkey")
+@click.option(
+    "--covers",
+    multiple=True,
+    help="Restrict mbtiles output to cover a quadkey. May be given more than once.",
+)
+@click.option(
+    "--partitions",
+    type=click.IntRange(1, None),
+    default=None,
+    help="Print JSON job specs of N partitions of the export instead of exporting. Each has the quadkeys for --covers and the zoom levels of a job, which make about the same estimated number of tiles. The outputs of the jobs can be combined by the mbtiles-merge command.",
+)
 @click.option(
     "--cutline",
     type=click.Path(exists=True),
@@ -199,6 +364,19 @@ def extract_features(ctx, param, value):
     default=None,
     help="Path to a GeoJSON FeatureCollection to be used as a cutline. Only source pixels within the cutline features will be exported.",
 )
+@click.option(
+    "--changed-region",
+    type=click.Path(exists=True),
+    callback=extract_features,
+    default=None,
+    help="Path to a GeoJSON FeatureCollection of the region in which the input dataset changed. Only the tiles that intersect it, or read its pixels when resampled, are made, replacing those in the output file. Tiles of the region that are now empty are deleted. Requires --append.",
+)
+@click.option(
+    "--changed-since",
+    type=click.Path(exists=True),
+    default=None,
+    help="Path to the previous version of the input dataset. The versions are compared block by block and the region of the changed blocks is used like --changed-region.",
+)
 @click.option(
     "--oo",
     "open_options",
@@ -222,12 +400,53 @@ def extract_features(ctx, param, value):
     is_flag=True,
     help="Whether to exclude or include empty tiles from the output.",
 )
+@click.option(
+    "--coverage-index",
+    default=False,
+    is_flag=True,
+    help="Read the input dataset's mask once before tiling to make a low resolution index of its coverage, which lets workers skip empty tiles without reading the mask.",
+)
+@click.option(
+    "--prune-tiles",
+    default=False,
+    is_flag=True,
+    help="Send to workers only the tiles that the coverage index does not show to be empty. Implies --coverage-index.",
+)
+@click.option(
+    "--tile-order",
+    type=click.Choice(["rows", "hilbert"]),
+    default="rows",
+    show_default=True,
+    help="Order in which tiles of a zoom level are processed. Tiles that are close along a Hilbert curve are close on the map, so workers given runs of them reuse more of the input dataset's cached blocks.",
+)
+@click.option(
+    "--metatile-size",
+    type=click.IntRange(1, 8),
+    default=1,
+    show_default=True,
+    help="Warp blocks of N x N tiles at once and cut them into tiles. Requires the concurrent.futures implementation. Blocks are kept whole with --tile-order rows, or with --tile-order hilbert and a power of two.",
+)
+@click.option(
+    "--encoder",
+    type=click.Choice(ENCODERS),
+    default="gdal",
+    show_default=True,
+    help="Encoder of tile images. The pillow encoder requires Pillow and supports only the QUALITY, ZLEVEL, and LOSSLESS creation options.",
+)
+@click.option(
+    "--dataset-cache-size",
+    type=click.IntRange(1, None),
+    default=DATASET_CACHE_SIZE,
+    show_default=True,
+    help="Maximum number of the input datasets of a mosaic that each worker keeps open. The least recently used dataset is closed first.",
+)
 @click.pass_context
 def mbtiles(
     ctx,
     files,
     output,
     append,
+    resume,
     title,
     description,
     layer_type,
@@ -239,15 +458,37 @@ def mbtiles(
     src_nodata,
     dst_nodata,
     resampling,
+    pyramid,
+    pyramid_resampling,
+    deduplicate,
+    insert_batch_size,
+    insert_batch_bytes,
+    single_transaction,
+    sqlite_profile,
+    sqlite_pragmas,
+    defer_index,
+    sharded_output,
     rgba,
     implementation,
+    result_transport,
     progress_bar,
     covers,
+    partitions,
     cutline,
+    changed_region,
+    changed_since,
     open_options,
     creation_options,
     warp_options,
     exclude_empty_tiles,
+    coverage_index,
+    prune_tiles,
+    tile_order,
+    metatile_size,
+    encoder,
+    overviews,
+    temporary_overviews,
+    dataset_cache_size,
 ):
     """Export a dataset to MBTiles (version 1.3) in a SQLite file.
 
@@ -255,6 +496,11 @@ def mbtiles(
     have at least three bands, which will be become the red, blue, and
     green bands of the output image tiles.
 
+    Many input datasets with the same number of bands may be given.
+    They are mosaicked, later inputs over earlier ones, and each tile is
+    warped only from the inputs whose footprints intersect it. Overviews
+    and coverage indexes are not used for mosaics.
+
     An optional fourth alpha band may be copied to the output tiles by
     using the --rgba option in combination with the PNG or WEBP formats.
     This option requires that the input dataset has at least 4 bands.
@@ -273,6 +519,20 @@ def mbtiles(
     If a title or description for the output file are not provided,
     they will be taken from the input dataset's filename.
 
+    With the --deduplicate option, identical tile images, such as those
+    of large uniform areas, are stored only once.
+
+    With the --pyramid option, only tiles of the maximum zoom level are
+    warped from the input dataset. Tiles of lower zoom levels are made
+    from the tiles already written to the output file, one zoom level
+    at a time, which greatly reduces the reading of the input dataset
+    for deep pyramids.
+
+    Low zoom levels are warped from the input dataset's overviews, if
+    it has any. With the --temporary-overviews option, overviews of an
+    input dataset without them are built in a scratch directory, which
+    is deleted when the export is done.
+
     This command is suited for small to medium (~1 GB) sized sources.
 
     Python package: rio-mbtiles (https://github.com/mapbox/rio-mbtiles).
@@ -281,9 +541,37 @@ def mbtiles(
     log = logging.getLogger(__name__)
 
     output, files = resolve_inout(
-        files=files, output=output, overwrite=not (append), append=append, num_inputs=1,
+        files=files, output=output, overwrite=not (append), append=append,
     )
+    if not files:
+        raise click.BadParameter("Insufficient inputs")
+    if resume and not append:
+        raise click.BadParameter("--resume requires --append")
     inputfile = files[0]
+    mosaic = len(files) > 1
+
+    if mosaic and (coverage_index or prune_tiles):
+        raise click.BadParameter("coverage indexes require a single input dataset")
+    elif mosaic and metatile_size > 1:
+        raise click.BadParameter("metatiles require a single input dataset")
+
+    changes = changed_region is not None or changed_since is not None
+    if changes and not append:
+        raise click.BadParameter("changed regions require --append")
+    elif changes and resume:
+        raise click.BadParameter("changed regions can't be combined with --resume")
+    elif changed_since is not None and mosaic:
+        raise click.BadParameter("--changed-since requires a single input dataset")
+
+    if partitions is not None and covers:
+        raise click.BadParameter("--partitions can't be combined with --covers")
+
+    # Tiles containing the quadkeys would be made from only some of the
+    # tiles below them.
+    if pyramid and (covers or partitions is not None):
+        raise click.BadParameter(
+            "--pyramid can't be combined with --covers or --partitions"
+        )
 
     if implementation == "cf" and sys.version_info < (3, 7):
         raise click.BadParameter(
@@ -291,6 +579,20 @@ def mbtiles(
         )
     elif implementation == "cf":
         from mbtiles.cf import process_tiles
+    elif implementation == "mp" and result_transport != "pickle":
+        raise click.BadParameter(
+            "{} transport requires the concurrent.futures implementation".format(
+                result_transport
+            )
+        )
+    elif implementation == "mp" and metatile_size > 1:
+        raise click.BadParameter(
+            "metatiles require the concurrent.futures implementation"
+        )
+    elif implementation == "mp" and sharded_output:
+        raise click.BadParameter(
+            "sharded output requires the concurrent.futures implementation"
+        )
     elif implementation == "mp":
         from mbtiles.mp import process_tiles
     elif sys.version_info >= (3, 7):
@@ -298,6 +600,18 @@ def mbtiles(
     else:
         from mbtiles.mp import process_tiles
 
+    if result_transport == "shared-memory" and sys.version_info < (3, 8):
+        raise click.BadParameter("shared-memory transport requires python>=3.8")
+
+    if sharded_output and result_transport != "pickle":
+        raise click.BadParameter(
+            "sharded output can't be combined with the {} transport".format(
+                result_transport
+            )
+        )
+    elif sharded_output and image_dump:
+        raise click.BadParameter("sharded output can't be combined with --image-dump")
+
     with ctx.obj["env"]:
 
         # Read metadata from the source dataset.
@@ -317,6 +631,19 @@ def mbtiles(
             if dst_nodata is not None:
                 base_kwds.update(nodata=dst_nodata)
 
+            # Precompute the coverage of valid data.
+            if (coverage_index or prune_tiles) and exclude_empty_tiles:
+                coverage = build_coverage(src)
+            else:
+                coverage = None
+
+            src_crs = src.crs
+            src_transform = src.transform
+
+            # Changed regions are padded by a number of source pixels.
+            if changes:
+                pixel_size = mercator_pixel_size(src)
+
             # Name and description.
             title = title or os.path.basename(src.name)
             description = description or src.name
@@ -334,26 +661,35 @@ def mbtiles(
                 if union.geom_type not in ("MultiPolygon", "Polygon"):
                     raise click.ClickException("Unexpected cutline geometry type")
                 west, south, east, north = union.bounds
-                cutline_src = shape(
-                    transform_geom("OGC:CRS84", src.crs, mapping(union))
-                )
-                invtransform = ~src.transform
-                shapely_matrix = (
-                    invtransform.a,
-                    invtransform.b,
-                    invtransform.d,
-                    invtransform.e,
-                    invtransform.xoff,
-                    invtransform.yoff,
-                )
-                cutline_rev = shapely.affinity.affine_transform(
-                    cutline_src, shapely_matrix
+                if not mosaic:
+                    warp_options["cutline"] = pixel_cutline(union, src)
+
+        # Index the footprints of the inputs of a mosaic.
+        if mosaic:
+            try:
+                sources = read_sources(
+                    files, open_options, union if cutline is not None else None
                 )
-                warp_options["cutline"] = shapely.wkt.dumps(cutline_rev)
-
-        if covers is not None:
-            covers_tile = mercantile.quadkey_to_tile(covers)
-            west, south, east, north = mercantile.bounds(covers_tile)
+            except ValueError as exc:
+                raise click.BadParameter(str(exc))
+
+            if not sources:
+                raise click.ClickException("No input intersects the cutline")
+            elif cutline is None:
+                west, south, east, north = unary_union(
+                    [source.footprint for source in sources]
+                ).bounds
+        else:
+            sources = None
+
+        # Only the tiles within, or containing, the quadkeys are made.
+        if covers:
+            covers_tiles = [mercantile.quadkey_to_tile(qk) for qk in covers]
+            west, south, east, north = unary_union(
+                [box(*mercantile.bounds(tile)) for tile in covers_tiles]
+            ).bounds
+        else:
+            covers_tiles = None
 
         # Resolve the minimum and maximum zoom levels for export.
         if zoom_levels:
@@ -366,6 +702,56 @@ def mbtiles(
 
         log.debug("Zoom range: %d..%d", minzoom, maxzoom)
 
+        # Job specs of partitions are printed instead of exporting.
+        if partitions is not None:
+            stem, ext = os.path.splitext(output)
+            for i, (quadkeys, count) in enumerate(
+                partition_quadkeys(
+                    west, south, east, north, minzoom, maxzoom, partitions, cutline
+                )
+            ):
+                click.echo(
+                    json.dumps(
+                        {
+                            "partition": i,
+                            "covers": quadkeys,
+                            "zoom_levels": "{}..{}".format(minzoom, maxzoom),
+                            "estimated_tiles": count,
+                            "output": "{}-{}{}".format(stem, i, ext),
+                        }
+                    )
+                )
+            return
+
+        # Choose overviews of the input dataset for the zoom levels.
+        overview_plan = {}
+        overview_source = None
+        if overviews and not mosaic and "overview_level" not in open_options:
+            with rasterio.open(inputfile, **open_options) as src:
+                zooms = range(minzoom, maxzoom + 1)
+                overview_plan = plan_overviews(
+                    src, zooms, tile_size, west, south, east, north
+                )
+
+                # Build temporary overviews if the dataset has none.
+                if temporary_overviews and not src.overviews(1):
+                    ratios = zoom_ratios(
+                        src, zooms, tile_size, west, south, east, north
+                    )
+                    factors = overview_factors(list(ratios.values()))
+                    if factors:
+                        scratch_dir = tempfile.mkdtemp(prefix="rio-mbtiles-")
+                        ctx.call_on_close(
+                            functools.partial(shutil.rmtree, scratch_dir, True)
+                        )
+                        overview_source = build_temporary_overviews(
+                            src, scratch_dir, factors, resampling
+                        )
+                        with rasterio.open(overview_source) as vrt:
+                            overview_plan = plan_overviews(
+                                vrt, zooms, tile_size, west, south, east, north
+                            )
+
         if rgba:
             if img_format == "JPEG":
                 raise click.BadParameter(
@@ -391,6 +777,14 @@ def mbtiles(
 
         img_ext = "jpg" if img_format.lower() == "jpeg" else img_format.lower()
 
+        # Check that the encoder can make the tile images.
+        try:
+            get_encoder(encoder)
+            if encoder == "pillow":
+                pillow_options(img_format, count, creation_options)
+        except ValueError as exc:
+            raise click.BadParameter(str(exc), param_hint="--encoder")
+
         # Constrain bounds.
         EPS = 1.0e-10
         west = max(-180 + EPS, west)
@@ -398,62 +792,62 @@ def mbtiles(
         east = min(180 - EPS, east)
         north = min(85.051129, north)
 
-        if progress_bar:
-            # Estimate total number of tiles.
-            west_merc, south_merc = mercantile.xy(west, south)
-            east_merc, north_merc = mercantile.xy(east, north)
-            raster_area = (east_merc - west_merc) * (north_merc - south_merc)
-
-            est_num_tiles = 0
-            zoom = minzoom
-
-            (
-                minz_west_merc,
-                minz_south_merc,
-                minz_east_merc,
-                minz_north_merc,
-            ) = mercantile.xy_bounds(mercantile.tile(0, 0, zoom))
-            minzoom_tile_area = (minz_east_merc - minz_west_merc) * (
-                minz_north_merc - minz_south_merc
-            )
-            ratio = min_ratio = raster_area / minzoom_tile_area
-
-            # If given a cutline, we use its mercator area and the
-            # supermercado module to help estimate the number of output
-            # tiles.
-            if cutline:
-                geoms = [shape(f["geometry"]) for f in cutline]
-                union = unary_union(geoms)
-                cutline_mercator = transform_geom(
-                    "OGC:CRS84", "EPSG:3857", mapping(union)
-                )
-                min_ratio *= shape(cutline_mercator).area / raster_area
-                ratio = min_ratio
-                estimator = functools.partial(supermercado.burntiles.burn, cutline)
-            else:
-                estimator = functools.partial(
-                    mercantile.tiles, west, south, east, north
+        # Only the tiles of a changed region are made.
+        if changes:
+            parts = []
+            if changed_region is not None:
+                parts.extend(shape(f["geometry"]) for f in changed_region)
+            if changed_since is not None:
+                with rasterio.open(changed_since, **open_options) as old:
+                    with rasterio.open(inputfile, **open_options) as src:
+                        try:
+                            parts.append(find_changed_region(old, src))
+                        except ValueError as exc:
+                            raise click.BadParameter(
+                                str(exc), param_hint="--changed-since"
+                            )
+
+            region = unary_union(parts)
+            extent = box(west, south, east, north)
+            if cutline is not None:
+                extent = extent.intersection(
+                    unary_union([shape(f["geometry"]) for f in cutline])
                 )
 
-            est_num_tiles = len(list(estimator(zoom)))
-            ratio *= 4.0
+            # Tiles near the region read its pixels through their padded
+            # windows and resampling kernels. Tiles of lower zoom levels
+            # of a pyramid are made from those of the maximum zoom level.
+            # The bounds of several quadkeys may contain tiles of none
+            # of them, which must be neither made nor deleted.
+            changed_tiles = {}
+            for zk in range(minzoom, maxzoom + 1):
+                distance = pad_distance(
+                    maxzoom if pyramid else zk, tile_size, pixel_size, resampling
+                )
+                changed_tiles[zk] = [
+                    tile
+                    for tile in region_tiles(
+                        pad_region(region, distance).intersection(extent), zk
+                    )
+                    if covers_tiles is None or in_covers(tile, covers_tiles)
+                ]
+            log.info(
+                "Changed tiles: count=%r",
+                sum(len(tiles) for tiles in changed_tiles.values()),
+            )
+        else:
+            changed_tiles = None
 
-            while zoom < maxzoom and ratio < 16:
-                zoom += 1
-                est_num_tiles += len(list(estimator(zoom)))
-                ratio *= 4.0
-            else:
-                zoom += 1
+        if progress_bar and changed_tiles is not None:
+            pbar = tqdm(total=sum(len(tiles) for tiles in changed_tiles.values()))
 
-            est_num_tiles += int(
-                sum(
-                    math.ceil(math.pow(4.0, z - minzoom) * min_ratio)
-                    for z in range(zoom, maxzoom + 1)
+        elif progress_bar:
+            pbar = tqdm(
+                total=estimate_tile_count(
+                    west, south, east, north, minzoom, maxzoom, cutline=cutline
                 )
             )
 
-            pbar = tqdm(total=est_num_tiles)
-
         else:
             pbar = None
 
@@ -468,13 +862,48 @@ def mbtiles(
 
         # workaround for bug here: https://bugs.python.org/issue27126
         sqlite3.connect(":memory:").close()
-        conn = sqlite3.connect(output)
+        # The connection is handed over to the writer thread of the
+        # concurrent.futures implementation and back. It is never used
+        # by two threads at once.
+        conn = sqlite3.connect(output, check_same_thread=False)
+
+        # An existing output file's layout takes precedence.
+        if appending:
+            deduplicate = has_tile_map(conn)
+
+        # The index of an existing file is never dropped.
+        defer_index = defer_index and not appending
+
+        # SQLite settings of the profile, overridden by the user's.
+        if sqlite_profile == "bulk":
+            pragmas = bulk_pragmas(
+                tile_bytes=tile_size * tile_size * count // 8, appending=appending
+            )
+        else:
+            pragmas = []
+        profile_names = [name for name, _ in pragmas]
+        pragmas = [(name, sqlite_pragmas.get(name, val)) for name, val in pragmas]
+        pragmas.extend(
+            sorted(
+                (name, val)
+                for name, val in sqlite_pragmas.items()
+                if name not in profile_names
+            )
+        )
+        previous_pragmas = []
 
         def init_mbtiles():
             """Note: this closes over other local variables of the command function."""
+            previous_pragmas.extend(apply_pragmas(conn, pragmas))
+
             cur = conn.cursor()
 
             if appending:
+                # An interrupted load with a deferred index leaves a file
+                # without the index, into which tiles would be inserted
+                # again instead of being replaced.
+                create_tile_index(conn, deduplicate=deduplicate)
+
                 cur.execute("SELECT * FROM metadata WHERE name = 'bounds';")
                 (
                     _,
@@ -494,13 +923,8 @@ def mbtiles(
                     ("%f,%f,%f,%f" % (new_west, new_south, new_east, new_north),),
                 )
             else:
-                cur.execute(
-                    "CREATE TABLE IF NOT EXISTS tiles "
-                    "(zoom_level integer, tile_column integer, "
-                    "tile_row integer, tile_data blob);"
-                )
-                cur.execute(
-                    "CREATE UNIQUE INDEX idx_zcr ON tiles (zoom_level, tile_column, tile_row);"
+                create_tile_tables(
+                    conn, deduplicate=deduplicate, index=not defer_index
                 )
                 cur.execute(
                     "CREATE TABLE IF NOT EXISTS metadata (name text, value text);"
@@ -531,13 +955,27 @@ def mbtiles(
                 )
             conn.commit()
 
-        def insert_results(tile, contents, img_ext=None, image_dump=None):
+        # Tiles are inserted in batches using executemany.
+        pending = {"rows": [], "images": [], "nbytes": 0}
+
+        # Tiles of a changed region that were written.
+        written = set()
+
+        def insert_results(
+            tile, contents, tile_id=None, img_ext=None, image_dump=None
+        ):
             """Also a closure."""
-            cursor = conn.cursor()
             if contents is None:
                 log.info("Tile %r is empty and will be skipped", tile)
                 return
 
+            if changed_tiles is not None:
+                written.add(tile)
+
+            # The worker has written the image to its shard.
+            if isinstance(contents, ShardedImage):
+                return
+
             # MBTiles have a different origin than Mercantile/tilebelt.
             tiley = int(math.pow(2, tile.z)) - tile.y - 1
 
@@ -548,53 +986,314 @@ def mbtiles(
                 with open(img_path, "wb") as img:
                     img.write(contents)
 
-            # Insert tile into db.
+            # Queue tile for insertion into db.
             log.info("Inserting tile: tile=%r", tile)
 
-            cursor.execute(
-                "INSERT OR REPLACE INTO tiles "
-                "(zoom_level, tile_column, tile_row, tile_data) "
-                "VALUES (?, ?, ?, ?);",
-                (tile.z, tile.x, tiley, sqlite3.Binary(contents)),
-            )
+            if deduplicate:
+                if tile_id is None:
+                    tile_id = image_id(contents)
+                pending["images"].append((sqlite3.Binary(contents), tile_id))
+                pending["rows"].append((tile.z, tile.x, tiley, tile_id))
+            else:
+                pending["rows"].append(
+                    (tile.z, tile.x, tiley, sqlite3.Binary(contents))
+                )
+            pending["nbytes"] += len(contents)
+
+            if (
+                len(pending["rows"]) >= insert_batch_size
+                or pending["nbytes"] >= insert_batch_bytes
+            ):
+                flush_mbtiles()
+
+        def flush_mbtiles():
+            """Insert the queued tiles into the db."""
+            cursor = conn.cursor()
+            if deduplicate:
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?);",
+                    pending["images"],
+                )
+                cursor.executemany(
+                    "INSERT OR REPLACE INTO map "
+                    "(zoom_level, tile_column, tile_row, tile_id) "
+                    "VALUES (?, ?, ?, ?);",
+                    pending["rows"],
+                )
+            else:
+                cursor.executemany(
+                    "INSERT OR REPLACE INTO tiles "
+                    "(zoom_level, tile_column, tile_row, tile_data) "
+                    "VALUES (?, ?, ?, ?);",
+                    pending["rows"],
+                )
+            pending.update(rows=[], images=[], nbytes=0)
 
         def commit_mbtiles():
-            conn.commit()
+            """Commit the inserted tiles, unless in a single transaction."""
+            if not single_transaction:
+                conn.commit()
+
+        def gen_candidate_tiles(zooms):
+            for zk in zooms:
+                if changed_tiles is not None:
+                    tiles = changed_tiles[zk]
+                    if tile_order == "hilbert":
+                        tiles = sorted(tiles, key=hilbert_index)
+                elif cutline:
+                    # Supermercado's numpy scalars must be cast to
+                    # ints.  Python's sqlite module does not do this
+                    # for us.
+                    tiles = (
+                        mercantile.Tile(*(int(v) for v in arr))
+                        for arr in supermercado.burntiles.burn(cutline, zk)
+                    )
+                    if tile_order == "hilbert":
+                        tiles = sorted(tiles, key=hilbert_index)
+                elif tile_order == "hilbert":
+                    tiles = hilbert_tiles(west, south, east, north, [zk])
+                else:
+                    tiles = mercantile.tiles(west, south, east, north, [zk])
+
+                for tile in tiles:
+                    if covers_tiles is None or in_covers(tile, covers_tiles):
+                        yield tile
+
+        def tiles_with_data(tiles):
+            # Tiles are pruned only if the coverage shows that they are
+            # empty. Workers make the same decision using the same
+            # window of the input dataset.
+            windows = source_windows(tiles, src_crs, src_transform)
+            for tile, window in zip(tiles, windows):
+                if window is None or window_has_data(coverage, window) is not False:
+                    yield tile
+
+        if mosaic and exclude_empty_tiles:
+            source_index = build_source_index(source.footprint for source in sources)
+
+            # Tiles that no input intersects are empty.
+            def gen_tiles(zooms):
+                for tile in gen_candidate_tiles(zooms):
+                    if query_sources(source_index, *mercantile.bounds(tile)):
+                        yield tile
+
+        elif prune_tiles and coverage is not None:
+
+            def gen_tiles(zooms):
+                tiles = gen_candidate_tiles(zooms)
+                while True:
+                    chunk = list(itertools.islice(tiles, PRUNE_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    for tile in tiles_with_data(chunk):
+                        yield tile
 
-        if cutline:
+        else:
+            gen_tiles = gen_candidate_tiles
+
+        # Tiles that are already stored are skipped when resuming.
+        if resume and appending:
+            bitmaps = read_tile_bitmaps(conn, deduplicate=deduplicate)
+            gen_stored_tiles = gen_tiles
+
+            def gen_tiles(zooms):
+                for tile in gen_stored_tiles(zooms):
+                    bitmap = bitmaps.get(tile.z)
+                    # MBTiles rows are counted from the south.
+                    row = (1 << tile.z) - 1 - tile.y
+                    if bitmap is None or not has_tile(bitmap, tile.x, row):
+                        yield tile
+
+        # In pyramid mode the maximum zoom level is processed first and
+        # each lower zoom level is made from the one above it, after the
+        # tiles of the latter have been committed.
+        if pyramid:
+            passes = [[zk] for zk in range(maxzoom, minzoom - 1, -1)]
+        else:
+            passes = [range(minzoom, maxzoom + 1)]
 
-            def gen_tiles():
-                for zk in range(minzoom, maxzoom + 1):
-                    for arr in supermercado.burntiles.burn(cutline, zk):
-                        # Supermercado's numpy scalars must be cast to
-                        # ints.  Python's sqlite module does not do this
-                        # for us.
-                        yield mercantile.Tile(*(int(v) for v in arr))
+        def skip_init_mbtiles():
+            pass
 
-            tiles = gen_tiles()
+        # Workers may write tiles to shards in a scratch directory.
+        if sharded_output:
+            shard_dir = tempfile.mkdtemp(prefix="rio-mbtiles-")
+            ctx.call_on_close(functools.partial(shutil.rmtree, shard_dir, True))
         else:
-            tiles = mercantile.tiles(
-                west, south, east, north, range(minzoom, maxzoom + 1)
+            shard_dir = None
+
+        # The tuned pragmas are not left in the output file, even if the
+        # export fails.
+        try:
+            with conn:
+                for i, zooms in enumerate(passes):
+                    process_tiles(
+                        gen_tiles(zooms),
+                        init_mbtiles if i == 0 else skip_init_mbtiles,
+                        insert_results,
+                        commit_mbtiles,
+                        num_workers=num_workers,
+                        inputfile=inputfile,
+                        base_kwds=base_kwds,
+                        resampling=resampling,
+                        img_ext=img_ext,
+                        image_dump=image_dump,
+                        progress_bar=pbar,
+                        open_options=open_options,
+                        creation_options=creation_options,
+                        warp_options=warp_options,
+                        exclude_empty_tiles=exclude_empty_tiles,
+                        transport=result_transport,
+                        pyramid_source=output if pyramid and i > 0 else None,
+                        pyramid_resampling=pyramid_resampling,
+                        hash_images=deduplicate,
+                        coverage=coverage,
+                        metatile_size=metatile_size,
+                        encoder=encoder,
+                        overview_plan=overview_plan,
+                        overview_source=overview_source,
+                        sources=sources,
+                        dataset_cache_size=dataset_cache_size,
+                        shard_dir=shard_dir,
+                    )
+                    flush_mbtiles()
+
+                    # Shards of a pass are merged before the next pass reads
+                    # their tiles.
+                    if shard_dir is not None:
+                        paths = sorted(glob.glob(os.path.join(shard_dir, "*.mbtiles")))
+                        merged = merge_shards(conn, paths, deduplicate=deduplicate)
+                        log.info(
+                            "Merged shards: count=%r, tiles=%r", len(paths), merged
+                        )
+                        for path in paths:
+                            os.remove(path)
+
+                    # Tiles of the changed region that were not written are
+                    # now empty.
+                    if changed_tiles is not None:
+                        stale = [
+                            (tile.z, tile.x, (1 << tile.z) - 1 - tile.y)
+                            for zk in zooms
+                            for tile in changed_tiles[zk]
+                            if tile not in written
+                        ]
+                        deleted = delete_tiles(conn, stale, deduplicate=deduplicate)
+                        log.info("Deleted empty tiles: count=%r", deleted)
+
+                    # Tiles of later passes are written and read by key.
+                    if defer_index:
+                        create_tile_index(conn, deduplicate=deduplicate)
+
+                    conn.commit()
+
+                # Replaced and deleted tiles may leave images that are no
+                # longer used.
+                if deduplicate and appending:
+                    conn.execute(
+                        "DELETE FROM images "
+                        "WHERE tile_id NOT IN (SELECT tile_id FROM map);"
+                    )
+
+                if pbar is not None:
+                    pbar.update(pbar.total - pbar.n)
+        finally:
+            restore_pragmas(conn, previous_pragmas)
+            conn.close()
+
+
+@click.command("mbtiles-merge", short_help="Merge MBTiles files.")
+@click.argument(
+    "files",
+    nargs=-1,
+    type=click.Path(resolve_path=True),
+    required=True,
+    metavar="INPUT... [OUTPUT]",
+)
+@output_opt
+@click.option(
+    "--append/--overwrite",
+    default=True,
+    is_flag=True,
+    help="Append tiles to an existing file or overwrite.",
+)
+@click.pass_context
+def merge(ctx, files, output, append):
+    """Merge MBTiles files, such as the outputs of partitions of an export.
+
+    Tiles are copied from the inputs in order, replacing tiles of the
+    same zoom level, column, and row. The inputs must have the same
+    image format and the same layout, with or without --deduplicate.
+
+    The bounds of the output are the union of the bounds of the inputs
+    (and of the output, when appending). Other metadata are taken from
+    the first input, unless the output exists.
+
+    """
+    log = logging.getLogger(__name__)
+
+    output, files = resolve_inout(files=files, output=output)
+    if not files:
+        raise click.BadParameter("Insufficient inputs")
+
+    # The layout and metadata of each input.
+    inputs = []
+    for path in files:
+        if not os.path.exists(path):
+            raise click.BadParameter("Input does not exist: {}".format(path))
+        src = sqlite3.connect(path)
+        try:
+            inputs.append((has_tile_map(src), read_metadata(src)))
+        finally:
+            src.close()
+
+    output_exists = os.path.exists(output)
+    if append:
+        appending = output_exists
+    elif output_exists:
+        appending = False
+        log.info("Overwrite mode chosen, unlinking output file.")
+        os.unlink(output)
+
+    if appending:
+        conn = sqlite3.connect(output)
+        deduplicate = has_tile_map(conn)
+        metadata = read_metadata(conn)
+        conn.close()
+    else:
+        deduplicate, metadata = inputs[0]
+
+    for path, (layout, values) in zip(files, inputs):
+        if layout != deduplicate:
+            raise click.BadParameter(
+                "Inputs must have the same layout: {} {} deduplicated".format(
+                    path, "is" if layout else "is not"
+                )
+            )
+        elif values.get("format") != metadata.get("format"):
+            raise click.BadParameter(
+                "Inputs must have the same format: {} has {}, not {}".format(
+                    path, values.get("format"), metadata.get("format")
+                )
             )
 
-        with conn:
-            process_tiles(
-                tiles,
-                init_mbtiles,
-                insert_results,
-                commit_mbtiles,
-                num_workers=num_workers,
-                inputfile=inputfile,
-                base_kwds=base_kwds,
-                resampling=resampling,
-                img_ext=img_ext,
-                image_dump=image_dump,
-                progress_bar=pbar,
-                open_options=open_options,
-                creation_options=creation_options,
-                warp_options=warp_options,
-                exclude_empty_tiles=exclude_empty_tiles,
+    bounds = union_bounds(
+        [values["bounds"] for _, values in inputs if "bounds" in values]
+        + ([metadata["bounds"]] if appending and "bounds" in metadata else [])
+    )
+
+    conn = sqlite3.connect(output)
+    with conn:
+        if not appending:
+            create_tile_tables(conn, deduplicate=deduplicate)
+            conn.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text);")
+            conn.executemany(
+                "INSERT INTO metadata (name, value) VALUES (?, ?);",
+                sorted(metadata.items()),
             )
+        conn.execute("UPDATE metadata SET value = ? WHERE name = 'bounds';", (bounds,))
+
+        count = merge_shards(conn, files, deduplicate=deduplicate)
+        log.info("Merged files: count=%r, tiles=%r", len(files), count)
 
-            if pbar is not None:
-                pbar.update(pbar.total - pbar.n)
+    conn.close()
@@ -0,0 +1,175 @@
+"""Spatial index of the footprints of many input datasets"""
+
+from collections import namedtuple
+import logging
+
+import rasterio
+from rasterio.warp import transform_bounds, transform_geom
+import shapely.affinity
+from shapely.geometry import box, mapping, shape
+from shapely.ops import unary_union
+from shapely.strtree import STRtree
+import shapely.wkt
+
+log = logging.getLogger(__name__)
+
+Source = namedtuple("Source", ["path", "footprint", "cutline"])
+Source.__doc__ = """An input dataset of a mosaic
+
+The footprint is a shapely geometry of the dataset's bounds in decimal
+degrees. The cutline, if not None, is the WKT of a polygon in the
+dataset's pixel coordinates.
+"""
+
+SourceIndex = namedtuple("SourceIndex", ["tree", "footprints", "positions"])
+SourceIndex.__doc__ = """STRtree of the footprints of input datasets
+
+Positions map the ids of the footprints to their order, for versions
+of shapely whose queries return geometries instead of indexes.
+"""
+
+
+def source_footprint(src):
+    """Compute the geographic footprint of a dataset
+
+    Parameters
+    ----------
+    src : DatasetReader
+
+    Returns
+    -------
+    Polygon or MultiPolygon
+        The dataset's bounds in decimal degrees, split at the
+        antimeridian if the dataset crosses it.
+
+    """
+    west, south, east, north = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+    if west > east:
+        return unary_union(
+            [box(-180.0, south, east, north), box(west, south, 180.0, north)]
+        )
+    else:
+        return box(west, south, east, north)
+
+
+def pixel_cutline(geom, src):
+    """Transform a cutline to the pixel coordinates of a dataset
+
+    Parameters
+    ----------
+    geom : Polygon or MultiPolygon
+        A cutline in decimal degrees.
+    src : DatasetReader
+
+    Returns
+    -------
+    str
+        WKT of the cutline, as required by GDAL's warper.
+
+    """
+    cutline_src = shape(transform_geom("OGC:CRS84", src.crs, mapping(geom)))
+    invtransform = ~src.transform
+    shapely_matrix = (
+        invtransform.a,
+        invtransform.b,
+        invtransform.d,
+        invtransform.e,
+        invtransform.xoff,
+        invtransform.yoff,
+    )
+    cutline_rev = shapely.affinity.affine_transform(cutline_src, shapely_matrix)
+    return shapely.wkt.dumps(cutline_rev)
+
+
+def read_sources(paths, open_options=None, cutline=None):
+    """Read the footprints of the input datasets of a mosaic
+
+    Each dataset is opened once. Datasets that do not intersect the
+    cutline are left out.
+
+    Parameters
+    ----------
+    paths : list of str
+    open_options : dict, optional
+    cutline : Polygon or MultiPolygon, optional
+        A cutline in decimal degrees.
+
+    Returns
+    -------
+    list of Source
+        In the order of the paths.
+
+    Raises
+    ------
+    ValueError
+        If the datasets do not have the same number of bands.
+
+    """
+    open_options = open_options or {}
+    sources = []
+    count = None
+
+    for path in paths:
+        with rasterio.open(path, **open_options) as src:
+            if count is None:
+                count = src.count
+            elif src.count != count:
+                raise ValueError(
+                    "Inputs must have the same number of bands: {!r} has {}, not {}".format(
+                        path, src.count, count
+                    )
+                )
+
+            footprint = source_footprint(src)
+            if cutline is None:
+                sources.append(Source(path, footprint, None))
+            elif footprint.intersects(cutline):
+                sources.append(Source(path, footprint, pixel_cutline(cutline, src)))
+            else:
+                log.info("Input does not intersect the cutline: path=%r", path)
+
+    return sources
+
+
+def build_source_index(footprints):
+    """Index the footprints of input datasets
+
+    Parameters
+    ----------
+    footprints : list of shapely geometries
+
+    Returns
+    -------
+    SourceIndex
+
+    """
+    footprints = list(footprints)
+    positions = {id(geom): i for i, geom in enumerate(footprints)}
+    return SourceIndex(STRtree(footprints), footprints, positions)
+
+
+def query_sources(index, west, south, east, north):
+    """Find the input datasets that intersect a bounding box
+
+    Parameters
+    ----------
+    index : SourceIndex
+    west, south, east, north : float
+        Bounding values in decimal degrees.
+
+    Returns
+    -------
+    list of int
+        Positions of the datasets, in their order. Later datasets are
+        drawn over earlier ones.
+
+    """
+    area = box(west, south, east, north)
+    hits = index.tree.query(area)
+
+    # Shapely 2 returns indexes, shapely 1.7 returns the geometries.
+    positions = [
+        index.positions[id(hit)] if hasattr(hit, "geom_type") else int(hit)
+        for hit in hits
+    ]
+    return sorted(i for i in positions if index.footprints[i].intersects(area))
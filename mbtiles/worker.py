@@ -1,21 +1,90 @@
 """rio-mbtiles processing worker"""
 
+from collections import namedtuple, OrderedDict
+import hashlib
 import logging
+import math
+from multiprocessing.util import Finalize
+import os
+import sqlite3
+import tempfile
+import time
 import warnings
 
+from rasterio._err import CPLE_BaseError
+from rasterio.crs import CRS
 from rasterio.enums import Resampling
+from rasterio.errors import RasterioIOError
 from rasterio.io import MemoryFile
 from rasterio.transform import from_bounds as transform_from_bounds
 from rasterio.warp import reproject, transform_bounds
+from rasterio.warp import transform as transform_coords
 from rasterio.windows import Window
 from rasterio.windows import from_bounds as window_from_bounds
 import mercantile
+import numpy as np
 import rasterio
+import shapely.affinity
+import shapely.wkt
+
+from mbtiles.coverage import window_has_data
+from mbtiles.db import apply_pragmas, create_tile_tables
+from mbtiles.encoders import encode_gdal, get_encoder
+from mbtiles.order import metatiles
+from mbtiles.sources import build_source_index, query_sources
 
 TILES_CRS = "EPSG:3857"
 
+# Default number of mosaic datasets kept open by a worker.
+DATASET_CACHE_SIZE = 64
+
+# Tiles of lower zoom levels may extend beyond the domain of a source's
+# projection and their windows are computed one at a time.
+WINDOWS_MIN_ZOOM = 4
+
 log = logging.getLogger(__name__)
 
+src_dataset = None
+overview_datasets = {}
+overview_plan = {}
+overview_path = None
+
+# Cutlines in the pixel coordinates of overviews, by overview shape.
+overview_cutlines = {}
+mosaic_sources = []
+mosaic_index = None
+
+# Open mosaic datasets by path and open options, least recently used
+# first, and statistics of their use.
+dataset_cache = OrderedDict()
+dataset_cache_size = DATASET_CACHE_SIZE
+dataset_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+shared_buffer = None
+shared_slot_size = None
+pyramid_path = None
+pyramid_conn = None
+shard_directory = None
+shard_conn = None
+hash_images = False
+coverage = None
+metatile_size = 1
+encode = encode_gdal
+
+# Reusable warp destinations, by data type.
+warp_buffers = {}
+
+# Windows of the tiles of the current batch, by source name and tile.
+window_cache = {}
+
+SharedImage = namedtuple("SharedImage", ["slot", "size"])
+SharedImage.__doc__ = """Location of a tile image in the shared memory buffer"""
+
+ShardedImage = namedtuple("ShardedImage", ["size"])
+ShardedImage.__doc__ = """Size of a tile image written to the worker's shard"""
+
+# Settings of shards, which are temporary and need no durability.
+SHARD_PRAGMAS = [("journal_mode", "OFF"), ("synchronous", "OFF")]
+
 
 def init_worker(
     path,
@@ -25,8 +94,21 @@ def init_worker(
     warp_opts=None,
     creation_opts=None,
     exclude_empties=True,
+    shared_name=None,
+    slot_size=None,
+    pyramid_source=None,
+    pyramid_resampling_method=None,
+    hash_contents=False,
+    source_coverage=None,
+    metatile=1,
+    encoder="gdal",
+    overview_levels=None,
+    overview_source=None,
+    sources=None,
+    cache_size=DATASET_CACHE_SIZE,
+    shard_dir=None,
 ):
-    global base_kwds, filename, resampling, open_options, warp_options, creation_options, exclude_empty_tiles
+    global base_kwds, filename, resampling, open_options, warp_options, creation_options, exclude_empty_tiles, shared_buffer, shared_slot_size, pyramid_path, pyramid_resampling, hash_images, coverage, metatile_size, encode, overview_plan, overview_path, mosaic_sources, mosaic_index, dataset_cache_size, shard_directory
     resampling = Resampling[resampling_method]
     base_kwds = profile.copy()
     filename = path
@@ -34,16 +116,608 @@ def init_worker(
     warp_options = warp_opts.copy() if warp_opts is not None else {}
     creation_options = creation_opts.copy() if creation_opts is not None else {}
     exclude_empty_tiles = exclude_empties
+    hash_images = hash_contents
+    coverage = source_coverage
+    metatile_size = metatile
+    encode = get_encoder(encoder)
+    overview_plan = overview_levels or {}
+    overview_path = overview_source
+    overview_cutlines.clear()
+
+    # The inputs of a mosaic are indexed by their footprints and opened
+    # only when a tile intersects them.
+    mosaic_sources = list(sources or [])
+    if mosaic_sources:
+        mosaic_index = build_source_index(source.footprint for source in mosaic_sources)
+    else:
+        mosaic_index = None
+    dataset_cache_size = cache_size
+
+    # The source dataset is opened once per worker and is closed when
+    # the worker process exits.
+    close_source()
+    if not mosaic_sources:
+        open_source()
+    Finalize(None, close_source, exitpriority=10)
+
+    # Tile images may be passed back to the parent process through a
+    # shared memory buffer instead of being pickled.
+    if shared_name is not None:
+        from multiprocessing import shared_memory
+
+        shared_buffer = shared_memory.SharedMemory(name=shared_name)
+        shared_slot_size = slot_size
+        Finalize(None, close_shared_buffer, exitpriority=10)
+
+    # Tiles may be built from their children in an MBTiles file instead
+    # of being warped from the source.
+    close_pyramid()
+    pyramid_path = pyramid_source
+    if pyramid_path is not None:
+        pyramid_resampling = Resampling[pyramid_resampling_method or "average"]
+        Finalize(None, close_pyramid, exitpriority=10)
+
+    # Tile images may be written to a shard of the output, one per
+    # worker, instead of being passed back to the parent process.
+    close_shard()
+    shard_directory = shard_dir
+    if shard_directory is not None:
+        Finalize(None, close_shard, exitpriority=10)
+
+
+def open_source():
+    """Open the worker's source dataset, if it is not already open
+
+    Returns
+    -------
+    DatasetReader
+
+    """
+    global src_dataset, filename, open_options
+
+    if src_dataset is None or src_dataset.closed:
+        log.debug("Opening source dataset: filename=%r", filename)
+        src_dataset = rasterio.open(filename, **open_options)
+    return src_dataset
+
+
+def open_overview(zoom):
+    """Open the source overview planned for a zoom level
+
+    Overviews are opened once, like the source dataset. They belong to
+    the source dataset, or to a dataset of temporary overviews if one
+    was given. If the planned overview can't be opened, the source
+    dataset is used instead.
+
+    Parameters
+    ----------
+    zoom : int
+
+    Returns
+    -------
+    DatasetReader
+        The overview, or the source dataset if no overview is planned
+        for the zoom level or it can't be opened.
+
+    """
+    global overview_datasets, overview_plan, overview_path, filename, open_options
+
+    level = overview_plan.get(zoom)
+    if level is None:
+        return open_source()
+
+    if level not in overview_datasets:
+        path = overview_path or filename
+        log.debug("Opening source overview: filename=%r, level=%r", path, level)
+        try:
+            if overview_path is not None:
+                overview_datasets[level] = rasterio.open(path, OVERVIEW_LEVEL=level)
+            else:
+                overview_datasets[level] = rasterio.open(
+                    path, OVERVIEW_LEVEL=level, **open_options
+                )
+        except RasterioIOError as exc:
+            log.warning(
+                "Using full resolution, overview can't be opened: level=%r, error=%r",
+                level,
+                exc,
+            )
+            overview_datasets[level] = None
+
+    return overview_datasets[level] or open_source()
+
+
+def overview_cutline(src, overview):
+    """Transform the worker's cutline to the pixel coordinates of an overview
+
+    The cutline of the warp options is in the pixel coordinates of the
+    full resolution source dataset. The pixels of an overview are those
+    of the source, scaled from the origin.
+
+    Parameters
+    ----------
+    src : DatasetReader
+        The source dataset.
+    overview : DatasetReader
+        An overview of the source, or of a dataset of temporary
+        overviews that has the source's pixels.
+
+    Returns
+    -------
+    str or None
+        WKT of the cutline, or None if the worker has no cutline.
+
+    """
+    global overview_cutlines, warp_options
+
+    cutline = warp_options.get("cutline")
+    if cutline is None:
+        return None
+
+    key = (overview.width, overview.height)
+    if key not in overview_cutlines:
+        overview_cutlines[key] = shapely.wkt.dumps(
+            shapely.affinity.scale(
+                shapely.wkt.loads(cutline),
+                xfact=overview.width / float(src.width),
+                yfact=overview.height / float(src.height),
+                origin=(0, 0),
+            )
+        )
+    return overview_cutlines[key]
+
+
+def open_cached(path, **kwargs):
+    """Open a dataset through the worker's LRU cache
+
+    The least recently used dataset is closed when the cache is full.
+
+    Parameters
+    ----------
+    path : str
+    kwargs : dict
+        Open options of the dataset.
+
+    Returns
+    -------
+    DatasetReader
+
+    """
+    global dataset_cache, dataset_cache_size, dataset_cache_stats
+
+    key = (path, tuple(sorted(kwargs.items())))
+    dataset = dataset_cache.pop(key, None)
+
+    if dataset is not None and not dataset.closed:
+        dataset_cache_stats["hits"] += 1
+    else:
+        dataset_cache_stats["misses"] += 1
+        log.debug("Opening cached dataset: filename=%r", path)
+        dataset = rasterio.open(path, **kwargs)
+
+    dataset_cache[key] = dataset
+
+    while len(dataset_cache) > dataset_cache_size:
+        _, evicted = dataset_cache.popitem(last=False)
+        dataset_cache_stats["evictions"] += 1
+        log.debug("Closing cached dataset: filename=%r", evicted.name)
+        evicted.close()
+
+    return dataset
+
+
+def dataset_cache_info():
+    """Statistics of the worker's cache of open datasets
+
+    Returns
+    -------
+    dict
+        Numbers of hits, misses, and evictions, and the current and
+        maximum sizes of the cache.
+
+    """
+    global dataset_cache, dataset_cache_size, dataset_cache_stats
+
+    return dict(
+        dataset_cache_stats, size=len(dataset_cache), maxsize=dataset_cache_size
+    )
+
+
+def open_mosaic_source(position):
+    """Open an input dataset of the worker's mosaic
+
+    Parameters
+    ----------
+    position : int
+        Position of the dataset among the inputs.
+
+    Returns
+    -------
+    DatasetReader
+        The dataset stays open until it is evicted from the worker's
+        dataset cache, see open_cached.
+
+    """
+    global mosaic_sources, open_options
+
+    return open_cached(mosaic_sources[position].path, **open_options)
+
+
+def close_source():
+    """Close the worker's source datasets and overviews, if open"""
+    global src_dataset, overview_datasets, dataset_cache
+
+    if src_dataset is not None:
+        log.debug("Closing source dataset: filename=%r", src_dataset.name)
+        src_dataset.close()
+        src_dataset = None
+
+    for dataset in overview_datasets.values():
+        if dataset is not None:
+            dataset.close()
+    overview_datasets.clear()
+
+    if dataset_cache:
+        log.debug("Closing cached datasets: stats=%r", dataset_cache_info())
+    for dataset in dataset_cache.values():
+        dataset.close()
+    dataset_cache.clear()
+
+
+def close_shared_buffer():
+    """Detach from the shared memory buffer, if attached"""
+    global shared_buffer
+
+    if shared_buffer is not None:
+        shared_buffer.close()
+        shared_buffer = None
+
+
+def close_pyramid():
+    """Close the worker's connection to the pyramid's MBTiles, if open"""
+    global pyramid_conn
+
+    if pyramid_conn is not None:
+        pyramid_conn.close()
+        pyramid_conn = None
+
+
+def open_shard():
+    """Create the worker's shard in the shard directory, if not yet done
+
+    Returns
+    -------
+    sqlite3.Connection
+
+    """
+    global shard_conn, shard_directory, hash_images
+
+    if shard_conn is None:
+        fd, path = tempfile.mkstemp(
+            suffix=".mbtiles", prefix="shard-", dir=shard_directory
+        )
+        os.close(fd)
+        log.debug("Creating shard: path=%r", path)
+        shard_conn = sqlite3.connect(path)
+        apply_pragmas(shard_conn, SHARD_PRAGMAS)
+        create_tile_tables(shard_conn, deduplicate=hash_images, index=False)
+        shard_conn.commit()
+    return shard_conn
+
+
+def close_shard():
+    """Close the worker's shard, if open"""
+    global shard_conn
+
+    if shard_conn is not None:
+        shard_conn.close()
+        shard_conn = None
+
+
+def write_shard(results):
+    """Write the images of results to the worker's shard
+
+    The results are committed, so that the parent process may merge
+    the shard as soon as the worker is done.
+
+    Parameters
+    ----------
+    results : list of tuple
+        Results of process_tile.
+
+    Returns
+    -------
+    list of tuple
+        The results, with the images replaced by ShardedImage. Empty
+        tiles are returned as is.
+
+    """
+    global hash_images
+
+    conn = open_shard()
+    rows = []
+    images = []
+    for i, result in enumerate(results):
+        tile, contents = result[:2]
+        if contents is None:
+            continue
+
+        # MBTiles have a different origin than Mercantile/tilebelt.
+        tiley = int(math.pow(2, tile.z)) - tile.y - 1
+        if hash_images:
+            images.append((sqlite3.Binary(contents), result[2]))
+            rows.append((tile.z, tile.x, tiley, result[2]))
+        else:
+            rows.append((tile.z, tile.x, tiley, sqlite3.Binary(contents)))
+        results[i] = (tile, ShardedImage(len(contents))) + result[2:]
+
+    if hash_images:
+        conn.executemany(
+            "INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?);", images
+        )
+        conn.executemany(
+            "INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) "
+            "VALUES (?, ?, ?, ?);",
+            rows,
+        )
+    else:
+        conn.executemany(
+            "INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) "
+            "VALUES (?, ?, ?, ?);",
+            rows,
+        )
+    conn.commit()
+    return results
+
+
+def read_child_tiles(tile):
+    """Read the images of a tile's children from the pyramid's MBTiles
+
+    Parameters
+    ----------
+    tile : mercantile.Tile
+
+    Returns
+    -------
+    list of (mercantile.Tile, bytes)
+        Children that are missing from the MBTiles are omitted.
+
+    """
+    global pyramid_conn, pyramid_path
+
+    if pyramid_conn is None:
+        pyramid_conn = sqlite3.connect(pyramid_path)
+
+    children = []
+    cur = pyramid_conn.cursor()
+    for child in mercantile.children(tile):
+        # MBTiles have a different origin than Mercantile/tilebelt.
+        tiley = int(math.pow(2, child.z)) - child.y - 1
+        cur.execute(
+            "SELECT tile_data FROM tiles "
+            "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+            (child.z, child.x, tiley),
+        )
+        # Exhausting the cursor releases the database's shared lock.
+        rows = cur.fetchall()
+        if rows:
+            children.append((child, bytes(rows[0][0])))
+    return children
+
+
+def process_parent_tile(tile):
+    """Build a single MBTiles tile by downsampling its four children
+
+    Parameters
+    ----------
+    tile : mercantile.Tile
+
+    Returns
+    -------
+
+    tile : mercantile.Tile
+        The input tile.
+    bytes : bytearray
+        Image bytes corresponding to the tile.
+
+    """
+    global base_kwds, creation_options, exclude_empty_tiles, pyramid_resampling, encode
+
+    children = read_child_tiles(tile)
+    if not children and exclude_empty_tiles:
+        return tile, None
+
+    ulx, uly = mercantile.xy(*mercantile.ul(tile.x, tile.y, tile.z))
+    lrx, lry = mercantile.xy(*mercantile.ul(tile.x + 1, tile.y + 1, tile.z))
+
+    kwds = base_kwds.copy()
+    kwds.update(**creation_options)
+    kwds["transform"] = transform_from_bounds(
+        ulx, lry, lrx, uly, kwds["width"], kwds["height"]
+    )
+    kwds.pop("src_nodata", None)
+    kwds.pop("dst_nodata", None)
+    count, height, width = kwds["count"], kwds["height"], kwds["width"]
+
+    # The children are mosaicked into an array of twice the tile's
+    # width and height.
+    mosaic = np.zeros((count, 2 * height, 2 * width), dtype=kwds["dtype"])
+
+    warnings.simplefilter("ignore")
+
+    for child, contents in children:
+        col = child.x - 2 * tile.x
+        row = child.y - 2 * tile.y
+        with MemoryFile(contents) as memfile:
+            with memfile.open() as img:
+                num_bands = min(count, img.count)
+                mosaic[
+                    :num_bands,
+                    row * height : (row + 1) * height,
+                    col * width : (col + 1) * width,
+                ] = img.read(
+                    indexes=list(range(1, num_bands + 1)),
+                    out_shape=(num_bands, height, width),
+                )
+
+    log.info("Downsampling tile: tile=%r", tile)
+
+    mosaic_kwds = {
+        "driver": "GTiff",
+        "count": count,
+        "dtype": kwds["dtype"],
+        "height": 2 * height,
+        "width": 2 * width,
+        "crs": TILES_CRS,
+        "transform": transform_from_bounds(
+            ulx, lry, lrx, uly, 2 * width, 2 * height
+        ),
+    }
+
+    # As in _process_tile, a 4th band is alpha and otherwise the tiles'
+    # nodata value is honored.
+    if count == 4:
+        bindexes = [1, 2, 3]
+        alpha = 4
+    else:
+        bindexes = list(range(1, count + 1))
+        alpha = None
+        mosaic_kwds["nodata"] = kwds["nodata"]
+
+    data = _warp_buffer(count, height, width, kwds["dtype"])
+    data.fill(0 if alpha else kwds["nodata"] or 0)
+
+    with MemoryFile() as mosaic_file:
+        with mosaic_file.open(**mosaic_kwds) as mosaic_src:
+            mosaic_src.write(mosaic)
+            reproject(
+                rasterio.band(mosaic_src, bindexes),
+                data,
+                dst_transform=kwds["transform"],
+                dst_crs=kwds["crs"],
+                src_alpha=alpha,
+                dst_alpha=alpha,
+                dst_nodata=None if alpha else kwds["nodata"],
+                resampling=pyramid_resampling,
+            )
+
+    return tile, encode(data, kwds)
+
+
+def process_tile_shared(tile, slot):
+    """Process a single MBTiles tile, writing its image to shared memory
+
+    Parameters
+    ----------
+    tile : mercantile.Tile
+    slot : int
+        Index of the slot in the shared memory buffer reserved for this
+        tile by the parent process.
+
+    Returns
+    -------
+
+    tile : mercantile.Tile
+        The input tile.
+    SharedImage or bytearray
+        Location of the image in the shared memory buffer. Empty tiles
+        and images that are larger than a slot are returned as is.
+    str, optional
+        Image identifier, see process_tile.
+
+    """
+    return _share_result(process_tile(tile), slot)
+
+
+def _share_result(result, slot):
+    """Move the image of a result to a slot of the shared memory buffer"""
+    global shared_buffer, shared_slot_size
+
+    tile, contents = result[:2]
+
+    if contents is None or len(contents) > shared_slot_size:
+        return result
+
+    offset = slot * shared_slot_size
+    shared_buffer.buf[offset : offset + len(contents)] = contents
+    return (tile, SharedImage(slot, len(contents))) + result[2:]
+
+
+def process_tiles_batch(tiles, slots=None):
+    """Process a batch of MBTiles tiles
+
+    Processing adjacent tiles in one task spares the cost of submitting
+    each of them to the worker separately. If the worker warps
+    metatiles, consecutive tiles of the same metatile are warped
+    together, see process_metatile.
+
+    Parameters
+    ----------
+    tiles : list of mercantile.Tile
+    slots : list of int, optional
+        Slots of the shared memory buffer reserved for the tiles, see
+        process_tile_shared. If None, images are returned as is, or
+        written to the worker's shard if it has a shard directory.
+
+    Returns
+    -------
+
+    list of tuple
+        The results of process_tile, process_tile_shared, or
+        write_shard, in the order of the tiles.
+    float
+        The time spent processing the batch, in seconds.
+
+    """
+    global pyramid_path, metatile_size, mosaic_sources, exclude_empty_tiles, shard_directory
+
+    start = time.time()
+
+    # The windows of the batch's tiles are computed at once.
+    if pyramid_path is None and not mosaic_sources and exclude_empty_tiles:
+        _cache_windows(open_source(), tiles)
+
+    if metatile_size > 1 and pyramid_path is None:
+        results = []
+        for group in metatiles(tiles, metatile_size):
+            results.extend(process_metatile(group))
+    else:
+        results = [process_tile(tile) for tile in tiles]
+
+    if slots is not None:
+        results = [_share_result(result, slot) for result, slot in zip(results, slots)]
+    elif shard_directory is not None:
+        results = write_shard(results)
+
+    return results, time.time() - start
+
+
+def image_id(contents):
+    """Identify a tile image by its content
+
+    Parameters
+    ----------
+    contents : bytes
+
+    Returns
+    -------
+    str
+
+    """
+    return hashlib.sha1(contents).hexdigest()
 
 
 def process_tile(tile):
     """Process a single MBTiles tile
 
+    If reading from the worker's source dataset fails, the dataset is
+    reopened and processing of the tile is tried one more time. When the
+    worker is building a pyramid, the tile is made from its children
+    instead of the source dataset.
+
     Parameters
     ----------
     tile : mercantile.Tile
-    warp_options : Mapping
-        GDAL warp options as keyword arguments.
 
     Returns
     -------
@@ -52,89 +726,576 @@ def process_tile(tile):
         The input tile.
     bytes : bytearray
         Image bytes corresponding to the tile.
+    str, optional
+        If the worker hashes images, the identifier of a non-empty
+        tile's image.
 
     """
-    global base_kwds, resampling, filename, open_options, warp_options, creation_options, exclude_empty_tiles
+    global pyramid_path, hash_images, mosaic_sources
+
+    if pyramid_path is not None:
+        tile, contents = process_parent_tile(tile)
+    elif mosaic_sources:
+        try:
+            tile, contents = _process_mosaic_tile(tile)
+        except (RasterioIOError, CPLE_BaseError) as exc:
+            log.warning(
+                "Reopening mosaic sources after error: tile=%r, error=%r", tile, exc
+            )
+            close_source()
+            tile, contents = _process_mosaic_tile(tile)
+    else:
+        try:
+            tile, contents = _process_tile(open_source(), tile, open_overview(tile.z))
+        except (RasterioIOError, CPLE_BaseError) as exc:
+            log.warning(
+                "Reopening source dataset after error: tile=%r, error=%r", tile, exc
+            )
+            close_source()
+            tile, contents = _process_tile(open_source(), tile, open_overview(tile.z))
+
+    if hash_images and contents is not None:
+        return tile, contents, image_id(contents)
+    else:
+        return tile, contents
+
+
+def process_metatile(tiles):
+    """Process tiles of one metatile
+
+    The tiles are warped from the source dataset at once and the
+    result is cut into tiles, which spares reading the source blocks
+    shared by adjacent tiles more than once.
+
+    Parameters
+    ----------
+    tiles : list of mercantile.Tile
+        Tiles of the same zoom level and metatile.
 
-    with rasterio.open(filename, **open_options) as src:
+    Returns
+    -------
+    list of tuple
+        Results as returned by process_tile, in the order of the tiles.
 
-        # Get the bounds of the tile.
-        ulx, uly = mercantile.xy(*mercantile.ul(tile.x, tile.y, tile.z))
-        lrx, lry = mercantile.xy(*mercantile.ul(tile.x + 1, tile.y + 1, tile.z))
+    """
+    global hash_images
 
-        kwds = base_kwds.copy()
-        kwds.update(**creation_options)
-        kwds["transform"] = transform_from_bounds(
-            ulx, lry, lrx, uly, kwds["width"], kwds["height"]
+    try:
+        results = _process_metatile(open_source(), tiles, open_overview(tiles[0].z))
+    except (RasterioIOError, CPLE_BaseError) as exc:
+        log.warning(
+            "Reopening source dataset after error: tiles=%r, error=%r", tiles, exc
         )
-        src_nodata = kwds.pop("src_nodata", None)
-        dst_nodata = kwds.pop("dst_nodata", None)
+        close_source()
+        results = _process_metatile(open_source(), tiles, open_overview(tiles[0].z))
 
-        src_alpha = None
-        dst_alpha = None
-        bindexes = None
+    if hash_images:
+        for i, (tile, contents) in enumerate(results):
+            if contents is not None:
+                results[i] = (tile, contents, image_id(contents))
 
-        if kwds["count"] == 4:
-            bindexes = [1, 2, 3]
-            dst_alpha = 4
+    return results
 
-            if src.count == 4:
-                src_alpha = 4
-            else:
-                kwds["count"] = 4
+
+def source_window(tile, crs, transform):
+    """Window of a source dataset corresponding to a tile
+
+    The window has a small buffer at its edges.
+
+    Parameters
+    ----------
+    tile : mercantile.Tile
+    crs : CRS
+        The source dataset's coordinate reference system.
+    transform : Affine
+        The source dataset's transform.
+
+    Returns
+    -------
+    Window
+
+    Raises
+    ------
+    ValueError
+        If the tile's bounds can't be transformed.
+
+    """
+    ulx, uly = mercantile.xy(*mercantile.ul(tile.x, tile.y, tile.z))
+    lrx, lry = mercantile.xy(*mercantile.ul(tile.x + 1, tile.y + 1, tile.z))
+    west, south, east, north = transform_bounds(TILES_CRS, crs, ulx, lry, lrx, uly)
+    return _padded_window(west, south, east, north, transform)
+
+
+def source_windows(tiles, crs, transform, densify_pts=21):
+    """Windows of a source dataset corresponding to many tiles
+
+    The windows are those of source_window, but the densified edges of
+    the tiles are transformed in a single call, which spares the setup
+    of a coordinate transformation for every tile. Tiles below
+    WINDOWS_MIN_ZOOM are handled by source_window.
+
+    Parameters
+    ----------
+    tiles : list of mercantile.Tile
+    crs : CRS
+        The source dataset's coordinate reference system.
+    transform : Affine
+        The source dataset's transform.
+    densify_pts : int, optional
+        Number of points added to each edge of a tile, as in
+        rasterio.warp.transform_bounds.
+
+    Returns
+    -------
+    list of Window or None
+        None for tiles whose bounds can't be transformed.
+
+    """
+    crs = CRS.from_user_input(crs)
+    windows = [None] * len(tiles)
+
+    # Bounds in geographic coordinates may cross the antimeridian,
+    # which only transform_bounds handles.
+    if crs.is_geographic:
+        batch = []
+    else:
+        batch = [i for i, tile in enumerate(tiles) if tile.z >= WINDOWS_MIN_ZOOM]
+
+    if batch:
+        bounds = np.array(
+            [
+                mercantile.xy(*mercantile.ul(tile.x, tile.y, tile.z))
+                + mercantile.xy(*mercantile.ul(tile.x + 1, tile.y + 1, tile.z))
+                for tile in (tiles[i] for i in batch)
+            ]
+        )
+        left = bounds[:, 0:1]
+        top = bounds[:, 1:2]
+        right = bounds[:, 2:3]
+        bottom = bounds[:, 3:4]
+
+        # Points along the edges of the tiles, as sampled by GDAL's
+        # OCTTransformBounds.
+        side_pts = densify_pts + 1
+        steps = np.arange(side_pts)
+        ones = np.ones(side_pts)
+        delta_x = (right - left) / side_pts
+        delta_y = (top - bottom) / side_pts
+        xs = np.concatenate(
+            [
+                left * ones,
+                left + steps * delta_x,
+                right * ones,
+                right - steps * delta_x,
+            ],
+            axis=1,
+        )
+        ys = np.concatenate(
+            [
+                top - steps * delta_y,
+                bottom * ones,
+                bottom + steps * delta_y,
+                top * ones,
+            ],
+            axis=1,
+        )
+
+        dst_xs, dst_ys = _transform_edges(crs, xs, ys)
+        finite = np.isfinite(dst_xs).all(axis=1) & np.isfinite(dst_ys).all(axis=1)
+
+        for j in np.flatnonzero(finite):
+            windows[batch[j]] = _padded_window(
+                dst_xs[j].min(),
+                dst_ys[j].min(),
+                dst_xs[j].max(),
+                dst_ys[j].max(),
+                transform,
+            )
+
+    # Other tiles, and tiles that could not be transformed at once, are
+    # transformed one at a time.
+    for i, tile in enumerate(tiles):
+        if windows[i] is None:
+            try:
+                windows[i] = source_window(tile, crs, transform)
+            except ValueError:
+                pass
+
+    return windows
+
+
+def _transform_edges(crs, xs, ys):
+    """Transform the edges of tiles from web mercator
+
+    Rows of tiles that can't be transformed are NaN. A failure of the
+    transformation is isolated by transforming halves of the tiles.
+    """
+    try:
+        dst_xs, dst_ys = transform_coords(TILES_CRS, crs, xs.ravel(), ys.ravel())
+    except (CPLE_BaseError, ValueError):
+        if len(xs) == 1:
+            return np.full(xs.shape, np.nan), np.full(ys.shape, np.nan)
+        half = len(xs) // 2
+        upper_xs, upper_ys = _transform_edges(crs, xs[:half], ys[:half])
+        lower_xs, lower_ys = _transform_edges(crs, xs[half:], ys[half:])
+        return (
+            np.concatenate([upper_xs, lower_xs]),
+            np.concatenate([upper_ys, lower_ys]),
+        )
+
+    return np.array(dst_xs).reshape(xs.shape), np.array(dst_ys).reshape(ys.shape)
+
+
+def _padded_window(west, south, east, north, transform):
+    """Window of bounds, with a buffer of one pixel at its edges"""
+    tile_window = window_from_bounds(west, south, east, north, transform=transform)
+    adjusted_tile_window = Window(
+        tile_window.col_off - 1,
+        tile_window.row_off - 1,
+        tile_window.width + 2,
+        tile_window.height + 2,
+    )
+    return adjusted_tile_window.round_offsets().round_shape()
+
+
+def _cache_windows(src, tiles):
+    """Replace the cached windows by those of tiles of the source"""
+    global window_cache
+
+    window_cache.clear()
+    for tile, window in zip(tiles, source_windows(tiles, src.crs, src.transform)):
+        window_cache[(src.name, tile)] = window
+
+
+def _tile_has_data(src, tile, mask_src=None):
+    """Determine whether the window of a tile in the source has data
+
+    The mask of the source is read only if the coverage can't decide,
+    from mask_src, an overview of the source, if given. Tiles whose
+    window can't be determined are assumed to have data.
+    """
+    global coverage, window_cache
+
+    key = (src.name, tile)
+    if key in window_cache:
+        tile_window = window_cache[key]
+    else:
+        try:
+            tile_window = source_window(tile, src.crs, src.transform)
+        except ValueError:
+            tile_window = None
+
+    if tile_window is None:
+        log.info(
+            "Tile %r will not be skipped, even if empty. This is harmless.",
+            tile,
+        )
+        return True
+
+    has_data = None
+    if coverage is not None:
+        has_data = window_has_data(coverage, tile_window)
+    if has_data is None and mask_src is not None and mask_src is not src:
+        has_data = mask_src.read_masks(
+            1, window=_overview_window(tile_window, src, mask_src)
+        ).any()
+    elif has_data is None:
+        has_data = src.read_masks(1, window=tile_window).any()
+    return has_data
+
+
+def _overview_window(window, src, overview):
+    """The window of an overview that contains a window of the source"""
+    xfact = overview.width / float(src.width)
+    yfact = overview.height / float(src.height)
+    col_start = int(math.floor(window.col_off * xfact))
+    row_start = int(math.floor(window.row_off * yfact))
+    col_stop = int(math.ceil((window.col_off + window.width) * xfact))
+    row_stop = int(math.ceil((window.row_off + window.height) * yfact))
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def _tile_kwds(src, tile):
+    """Creation options and warp bands for a tile of the source
+
+    Returns
+    -------
+    kwds : dict
+        Creation options of the tile image.
+    warp_kwds : dict
+        Bands and nodata options of the reprojection.
+
+    """
+    global base_kwds, creation_options
+
+    # Get the bounds of the tile.
+    ulx, uly = mercantile.xy(*mercantile.ul(tile.x, tile.y, tile.z))
+    lrx, lry = mercantile.xy(*mercantile.ul(tile.x + 1, tile.y + 1, tile.z))
+
+    kwds = base_kwds.copy()
+    kwds.update(**creation_options)
+    kwds["transform"] = transform_from_bounds(
+        ulx, lry, lrx, uly, kwds["width"], kwds["height"]
+    )
+    src_nodata = kwds.pop("src_nodata", None)
+    dst_nodata = kwds.pop("dst_nodata", None)
+
+    src_alpha = None
+    dst_alpha = None
+    bindexes = None
+
+    if kwds["count"] == 4:
+        bindexes = [1, 2, 3]
+        dst_alpha = 4
+
+        if src.count == 4:
+            src_alpha = 4
         else:
-            bindexes = list(range(1, kwds["count"] + 1))
-
-        warnings.simplefilter("ignore")
-
-        log.info("Reprojecting tile: tile=%r", tile)
-
-        with MemoryFile() as memfile:
-
-            with memfile.open(**kwds) as tmp:
-
-                # determine window of source raster corresponding to the tile
-                # image, with small buffer at edges
-                try:
-                    west, south, east, north = transform_bounds(
-                        TILES_CRS, src.crs, ulx, lry, lrx, uly
-                    )
-                    tile_window = window_from_bounds(
-                        west, south, east, north, transform=src.transform
-                    )
-                    adjusted_tile_window = Window(
-                        tile_window.col_off - 1,
-                        tile_window.row_off - 1,
-                        tile_window.width + 2,
-                        tile_window.height + 2,
-                    )
-                    tile_window = adjusted_tile_window.round_offsets().round_shape()
-
-                    # if no data in window, skip processing the tile
-                    if (
-                        exclude_empty_tiles
-                        and not src.read_masks(1, window=tile_window).any()
-                    ):
-                        return tile, None
-
-                except ValueError:
-                    log.info(
-                        "Tile %r will not be skipped, even if empty. This is harmless.",
-                        tile,
-                    )
-
-                num_threads = int(warp_options.pop("num_threads", 2))
-
-                reproject(
-                    rasterio.band(src, bindexes),
-                    rasterio.band(tmp, bindexes),
-                    src_nodata=src_nodata,
-                    dst_nodata=dst_nodata,
-                    src_alpha=src_alpha,
-                    dst_alpha=dst_alpha,
-                    num_threads=num_threads,
-                    resampling=resampling,
-                    **warp_options
-                )
+            kwds["count"] = 4
+    else:
+        bindexes = list(range(1, kwds["count"] + 1))
+
+    warp_kwds = {
+        "bindexes": bindexes,
+        "src_nodata": src_nodata,
+        "dst_nodata": dst_nodata,
+        "src_alpha": src_alpha,
+        "dst_alpha": dst_alpha,
+    }
+    return kwds, warp_kwds
+
+
+def _warp_buffer(count, height, width, dtype):
+    """Get the worker's warp destination of a shape and data type
+
+    The destination is a view of the start of one array per data type,
+    which is reallocated only when a larger destination is needed, so
+    the memory kept by the worker is that of its largest destination
+    and not of every shape of metatile. Its content is not initialized.
+    """
+    global warp_buffers
+
+    key = np.dtype(dtype).name
+    size = count * height * width
+    if key not in warp_buffers or warp_buffers[key].size < size:
+        log.debug("Allocating warp destination: dtype=%r, size=%r", key, size)
+        warp_buffers[key] = np.empty(size, dtype=dtype)
+    return warp_buffers[key][:size].reshape(count, height, width)
+
+
+def _warp(src, kwds, bindexes, fill=True, **kwargs):
+    """Reproject bands of the source to a reused array
+
+    Parameters
+    ----------
+    src : DatasetReader
+    kwds : dict
+        Creation options of the destination image, which determine the
+        shape, data type, nodata value, and georeferencing of the array.
+    bindexes : list of int
+        Bands of the source to reproject.
+    fill : bool, optional
+        If False, the array keeps the result of the previous call and
+        only valid pixels of the source are drawn over it.
+    kwargs : dict
+        Nodata, alpha, and other options of the reprojection.
+
+    Returns
+    -------
+    numpy.ndarray
+        The reprojected bands, followed by the alpha band if dst_alpha
+        is given. The array is overwritten by the next call.
+
+    """
+    global resampling, warp_options
+
+    data = _warp_buffer(kwds["count"], kwds["height"], kwds["width"], kwds["dtype"])
+
+    dst_nodata = kwargs.pop("dst_nodata", None)
+    if dst_nodata is None:
+        dst_nodata = kwds.get("nodata")
+    if fill:
+        data.fill(dst_nodata or 0)
+
+    num_threads = int(warp_options.pop("num_threads", 2))
+
+    reproject(
+        rasterio.band(src, bindexes),
+        data,
+        dst_transform=kwds["transform"],
+        dst_crs=kwds["crs"],
+        dst_nodata=dst_nodata,
+        num_threads=num_threads,
+        resampling=resampling,
+        init_dest_nodata=fill,
+        **dict(warp_options, **kwargs)
+    )
+    return data
+
+
+def _process_tile(src, tile, warp_src=None):
+    """Warp and encode a single MBTiles tile
+
+    Parameters
+    ----------
+    src : DatasetReader
+        The worker's open source dataset.
+    tile : mercantile.Tile
+    warp_src : DatasetReader, optional
+        An overview of the source dataset to warp from. The mask of
+        the overview is read to detect empty tiles.
+
+    Returns
+    -------
+
+    tile : mercantile.Tile
+        The input tile.
+    bytes : bytearray
+        Image bytes corresponding to the tile.
+
+    """
+    global exclude_empty_tiles, encode
+
+    kwds, warp_kwds = _tile_kwds(src, tile)
+
+    warnings.simplefilter("ignore")
+
+    # if no data in window, skip processing the tile.
+    if exclude_empty_tiles and not _tile_has_data(src, tile, mask_src=warp_src):
+        return tile, None
+
+    log.info("Reprojecting tile: tile=%r", tile)
+
+    if warp_src is not None and warp_src is not src:
+        cutline = overview_cutline(src, warp_src)
+        if cutline is not None:
+            warp_kwds["cutline"] = cutline
+
+    data = _warp(warp_src or src, kwds, **warp_kwds)
+    return tile, encode(data, kwds)
+
+
+def _process_metatile(src, tiles, warp_src=None):
+    """Warp a block of adjacent tiles at once and encode each tile
+
+    Parameters
+    ----------
+    src : DatasetReader
+        The worker's open source dataset.
+    tiles : list of mercantile.Tile
+        Tiles of the same zoom level.
+    warp_src : DatasetReader, optional
+        An overview of the source dataset to warp from, see
+        _process_tile.
+
+    Returns
+    -------
+    list of tuple
+        The tile and its image bytes, or None if it is empty, in the
+        order of the tiles.
+
+    """
+    global exclude_empty_tiles, encode
+
+    warnings.simplefilter("ignore")
+
+    if exclude_empty_tiles:
+        wanted = [
+            tile for tile in tiles if _tile_has_data(src, tile, mask_src=warp_src)
+        ]
+    else:
+        wanted = list(tiles)
+
+    if not wanted:
+        return [(tile, None) for tile in tiles]
+
+    zoom = wanted[0].z
+    xmin = min(tile.x for tile in wanted)
+    xmax = max(tile.x for tile in wanted)
+    ymin = min(tile.y for tile in wanted)
+    ymax = max(tile.y for tile in wanted)
+
+    kwds, warp_kwds = _tile_kwds(src, wanted[0])
+    width = kwds["width"]
+    height = kwds["height"]
+
+    # The block is the smallest rectangle of tiles that contains the
+    # wanted tiles.
+    ulx, uly = mercantile.xy(*mercantile.ul(xmin, ymin, zoom))
+    lrx, lry = mercantile.xy(*mercantile.ul(xmax + 1, ymax + 1, zoom))
+    block_width = (xmax - xmin + 1) * width
+    block_height = (ymax - ymin + 1) * height
+    block_kwds = dict(
+        kwds,
+        width=block_width,
+        height=block_height,
+        transform=transform_from_bounds(ulx, lry, lrx, uly, block_width, block_height),
+    )
+
+    log.info("Reprojecting metatile: tiles=%r", wanted)
+
+    if warp_src is not None and warp_src is not src:
+        cutline = overview_cutline(src, warp_src)
+        if cutline is not None:
+            warp_kwds["cutline"] = cutline
+
+    data = _warp(warp_src or src, block_kwds, **warp_kwds)
+
+    images = {}
+    for tile in wanted:
+        kwds, _ = _tile_kwds(src, tile)
+        col = (tile.x - xmin) * width
+        row = (tile.y - ymin) * height
+        images[tile] = encode(data[:, row : row + height, col : col + width], kwds)
+
+    return [(tile, images.get(tile)) for tile in tiles]
+
+
+def _process_mosaic_tile(tile):
+    """Warp and encode a single MBTiles tile of a mosaic
+
+    Only the inputs whose footprints intersect the tile are opened.
+    They are warped in their order, each over the previous ones.
+
+    Parameters
+    ----------
+    tile : mercantile.Tile
+
+    Returns
+    -------
+
+    tile : mercantile.Tile
+        The input tile.
+    bytes : bytearray
+        Image bytes corresponding to the tile.
+
+    """
+    global exclude_empty_tiles, encode, mosaic_sources, mosaic_index
+
+    warnings.simplefilter("ignore")
+
+    # Each dataset is warped right after it is opened, so that it may
+    # be evicted from the dataset cache by the next one.
+    data = None
+    count = 0
+    for position in query_sources(mosaic_index, *mercantile.bounds(tile)):
+        src = open_mosaic_source(position)
+        if exclude_empty_tiles and not _tile_has_data(src, tile):
+            continue
+
+        kwds, warp_kwds = _tile_kwds(src, tile)
+        cutline = mosaic_sources[position].cutline
+        if cutline is not None:
+            warp_kwds["cutline"] = cutline
+        data = _warp(src, kwds, fill=(data is None), **warp_kwds)
+        count += 1
+
+    if data is None:
+        if exclude_empty_tiles:
+            return tile, None
+        kwds, warp_kwds = _tile_kwds(open_mosaic_source(0), tile)
+        data = _warp_buffer(kwds["count"], kwds["height"], kwds["width"], kwds["dtype"])
+        data.fill(warp_kwds["dst_nodata"] or kwds.get("nodata") or 0)
 
-            return tile, memfile.read()
+    log.info("Reprojected mosaic tile: tile=%r, sources=%r", tile, count)
+    return tile, encode(data, kwds)
@@ -41,9 +41,13 @@ setup(
         "supermercado",
         "tqdm~=4.0",
     ],
-    extras_require={"test": ["coveralls", "pytest", "pytest-cov"]},
+    extras_require={
+        "pillow": ["Pillow"],
+        "test": ["coveralls", "pytest", "pytest-cov"],
+    },
     entry_points="""
       [rasterio.rio_plugins]
       mbtiles=mbtiles.scripts.cli:mbtiles
+      mbtiles-merge=mbtiles.scripts.cli:merge
       """
       )
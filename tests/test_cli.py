@@ -1,13 +1,20 @@
+import json
+import logging
 import os
 import sqlite3
 import sys
+import tempfile
 import warnings
 
 import click
 from click.testing import CliRunner
+import mercantile
 import pytest
 import rasterio
 from rasterio.rio.main import main_group
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from shapely.geometry import box, mapping
 
 import mbtiles.scripts.cli
 
@@ -393,11 +400,10 @@ def test_appending_export_count(
     assert len(results) == exp_num_tiles
 
 
-@pytest.mark.parametrize("inputfiles", [[], ["a.tif", "b.tif"]])
-def test_input_required(inputfiles):
-    """We require exactly one input file"""
+def test_input_required():
+    """We require at least one input file"""
     runner = CliRunner()
-    result = runner.invoke(main_group, ["mbtiles"] + inputfiles + ["foo.mbtiles"])
+    result = runner.invoke(main_group, ["mbtiles", "foo.mbtiles"])
     assert result.exit_code == 2
 
 
@@ -514,3 +520,1132 @@ def test_covers(tmpdir, data, source, quadkey, zooms, exp_num_results):
     cur.execute("select * from tiles")
     results = cur.fetchall()
     assert len(results) == exp_num_results
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="shared-memory transport requires Python >= 3.8"
+)
+@pytest.mark.parametrize("img_format", ["JPEG", "PNG"])
+def test_shared_memory_transport(tmpdir, data, img_format):
+    """Tiles passed through shared memory are the same as pickled tiles"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    runner = CliRunner()
+    tiles = {}
+    for transport in ["pickle", "shared-memory"]:
+        outputfile = str(tmpdir.join("{}.mbtiles".format(transport)))
+        result = runner.invoke(
+            main_group,
+            [
+                "mbtiles",
+                "--implementation",
+                "cf",
+                "--format",
+                img_format,
+                "--result-transport",
+                transport,
+                inputfile,
+                outputfile,
+            ],
+        )
+        assert result.exit_code == 0
+        conn = sqlite3.connect(outputfile)
+        cur = conn.cursor()
+        cur.execute("select * from tiles")
+        tiles[transport] = sorted(cur.fetchall())
+
+    assert len(tiles["shared-memory"]) == 6
+    assert tiles["shared-memory"] == tiles["pickle"]
+
+
+def test_shared_memory_transport_mp():
+    """The multiprocessing implementation only pickles results"""
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--implementation",
+            "mp",
+            "--result-transport",
+            "shared-memory",
+            "in.tif",
+            "out.mbtiles",
+        ],
+    )
+    assert result.exit_code == 2
+
+
+@pytest.mark.parametrize("filename", ["RGB.byte.tif", "RGBA.byte.tif"])
+@pytest.mark.parametrize(
+    "impl",
+    [
+        pytest.param(
+            "cf",
+            marks=pytest.mark.skipif(
+                sys.version_info < (3, 7),
+                reason="c.f. implementation requires Python >= 3.7",
+            ),
+        ),
+        "mp",
+    ],
+)
+def test_pyramid(tmpdir, data, filename, impl):
+    """Lower zoom levels made from tiles match those warped from the source"""
+    inputfile = str(data.join(filename))
+    runner = CliRunner()
+    tiles = {}
+    for mode in ["warp", "pyramid"]:
+        outputfile = str(tmpdir.join("{}.mbtiles".format(mode)))
+        args = [
+            "mbtiles",
+            "--implementation",
+            impl,
+            "--format",
+            "PNG",
+            "--zoom-levels",
+            "4..8",
+            inputfile,
+            outputfile,
+        ]
+        if mode == "pyramid":
+            args[1:1] = ["--pyramid", "--pyramid-resampling", "bilinear"]
+        result = runner.invoke(main_group, args)
+        assert result.exit_code == 0
+        conn = sqlite3.connect(outputfile)
+        cur = conn.cursor()
+        cur.execute("select zoom_level, tile_column, tile_row from tiles")
+        tiles[mode] = sorted(cur.fetchall())
+
+    assert set(zoom for zoom, _, _ in tiles["pyramid"]) == set(range(4, 9))
+    assert tiles["pyramid"] == tiles["warp"]
+
+
+def test_deduplicate(tmpdir, empty_data):
+    """Identical empty tiles are stored once"""
+    inputfile = empty_data
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        ["mbtiles", "--deduplicate", "--include-empty-tiles", inputfile, outputfile],
+    )
+    assert result.exit_code == 0
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select * from tiles")
+    assert len(cur.fetchall()) == 6
+    cur.execute("select * from images")
+    assert len(cur.fetchall()) == 1
+
+
+@pytest.mark.parametrize(
+    "impl",
+    [
+        pytest.param(
+            "cf",
+            marks=pytest.mark.skipif(
+                sys.version_info < (3, 7),
+                reason="c.f. implementation requires Python >= 3.7",
+            ),
+        ),
+        "mp",
+    ],
+)
+def test_deduplicate_append(tmpdir, data, impl):
+    """Appending to a deduplicated file keeps its layout"""
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    for source, args in [
+        ("rgb-193f513.vrt", ["--deduplicate"]),
+        ("rgb-fa48952.vrt", []),
+    ]:
+        result = runner.invoke(
+            main_group,
+            ["mbtiles", "--implementation", impl, "--zoom-levels", "4..10"]
+            + args
+            + [str(data.join(source)), outputfile],
+        )
+        assert result.exit_code == 0
+
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select * from tiles")
+    assert len(cur.fetchall()) == 70
+    cur.execute("select * from images where tile_id not in (select tile_id from map)")
+    assert len(cur.fetchall()) == 0
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--insert-batch-size", "1"],
+        ["--insert-batch-size", "4"],
+        ["--insert-batch-bytes", "1"],
+        ["--single-transaction"],
+        ["--single-transaction", "--deduplicate"],
+    ],
+)
+def test_insert_batches(tmpdir, data, args):
+    """All tiles are inserted regardless of batching"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(main_group, ["mbtiles"] + args + [inputfile, outputfile])
+    assert result.exit_code == 0
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select * from tiles")
+    assert len(cur.fetchall()) == 6
+
+
+@pytest.mark.parametrize("append", [False, True])
+def test_sqlite_bulk_profile(tmpdir, data, append):
+    """Bulk loading settings are used and persistent ones are restored"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    if append:
+        result = runner.invoke(main_group, ["mbtiles", inputfile, outputfile])
+        assert result.exit_code == 0
+
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--sqlite-profile",
+            "bulk",
+            "--sqlite-pragma",
+            "cache_size=-10000",
+            inputfile,
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 0
+    assert not os.path.exists(outputfile + "-wal")
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("pragma journal_mode")
+    assert cur.fetchone()[0] == "delete"
+    cur.execute("pragma page_size")
+    assert cur.fetchone()[0] == (4096 if append else 32768)
+    cur.execute("select * from tiles")
+    assert len(cur.fetchall()) == 6
+
+
+def test_sqlite_bulk_profile_failure(tmpdir, data):
+    """Persistent settings are restored when an export fails"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(main_group, ["mbtiles", inputfile, outputfile])
+    assert result.exit_code == 0
+
+    # Appending fails after the write-ahead log is set.
+    with mock.patch(
+        "mbtiles.scripts.cli.create_tile_index", side_effect=RuntimeError
+    ) as create_tile_index:
+        result = runner.invoke(
+            main_group,
+            ["mbtiles", "--append", "--sqlite-profile", "bulk", inputfile, outputfile],
+        )
+    assert result.exit_code != 0
+    assert create_tile_index.called
+    assert not os.path.exists(outputfile + "-wal")
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("pragma journal_mode")
+    assert cur.fetchone()[0] == "delete"
+
+
+def test_sqlite_invalid_pragma(tmpdir, data):
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        ["mbtiles", "--sqlite-pragma", "cache_size=1; drop", inputfile, outputfile],
+    )
+    assert result.exit_code == 2
+
+
+@pytest.mark.parametrize(
+    "args,index",
+    [
+        ([], "idx_zcr"),
+        (["--deduplicate"], "map_index"),
+        (["--pyramid", "--zoom-levels", "5..7"], "idx_zcr"),
+    ],
+)
+def test_defer_index(tmpdir, data, args, index):
+    """The unique index of tiles exists after a deferred load"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group, ["mbtiles", "--defer-index"] + args + [inputfile, outputfile]
+    )
+    assert result.exit_code == 0
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select name from sqlite_master where type = 'index'")
+    assert index in [row[0] for row in cur.fetchall()]
+    cur.execute("select * from tiles")
+    assert len(cur.fetchall()) > 0
+
+
+def test_defer_index_interrupted(tmpdir, data):
+    """Appending to a file left without its index replaces tiles"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group, ["mbtiles", "--zoom-levels", "4..10", inputfile, outputfile]
+    )
+    assert result.exit_code == 0
+
+    # As if a run with --defer-index had been interrupted.
+    conn = sqlite3.connect(outputfile)
+    conn.execute("DROP INDEX idx_zcr;")
+    conn.commit()
+    conn.close()
+
+    result = runner.invoke(
+        main_group,
+        ["mbtiles", "--append", "--zoom-levels", "4..10", inputfile, outputfile],
+    )
+    assert result.exit_code == 0
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select count(*) from tiles")
+    assert cur.fetchone()[0] == 70
+    cur.execute("select name from sqlite_master where type = 'index'")
+    assert "idx_zcr" in [row[0] for row in cur.fetchall()]
+
+
+@pytest.mark.parametrize(
+    "minzoom,maxzoom,exp_num_tiles,source",
+    [
+        (4, 10, 70, "RGB.byte.tif"),
+        (4, 10, 12, "rgb-193f513.vrt"),
+        (4, 10, 69, "rgb-fa48952.vrt"),
+    ],
+)
+def test_coverage_index(tmpdir, data, minzoom, maxzoom, exp_num_tiles, source):
+    """Empty tiles are skipped using the coverage index"""
+    inputfile = str(data.join(source))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--coverage-index",
+            "--zoom-levels",
+            "{}..{}".format(minzoom, maxzoom),
+            inputfile,
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 0
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select * from tiles")
+    assert len(cur.fetchall()) == exp_num_tiles
+
+
+@pytest.mark.parametrize(
+    "minzoom,maxzoom,exp_num_tiles,source",
+    [
+        (4, 10, 70, "RGB.byte.tif"),
+        (4, 10, 12, "rgb-193f513.vrt"),
+    ],
+)
+def test_prune_tiles(tmpdir, data, minzoom, maxzoom, exp_num_tiles, source):
+    """Tiles outside the data footprint are pruned without loss"""
+    inputfile = str(data.join(source))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--prune-tiles",
+            "--zoom-levels",
+            "{}..{}".format(minzoom, maxzoom),
+            inputfile,
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 0
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select * from tiles")
+    assert len(cur.fetchall()) == exp_num_tiles
+
+
+@pytest.mark.parametrize("cutline", [False, True])
+def test_tile_order_hilbert(tmpdir, data, rgba_cutline_path, cutline):
+    """Tiles processed in Hilbert order are the same tiles"""
+    inputfile = str(data.join("RGBA.byte.tif"))
+    args = ["mbtiles", "--zoom-levels", "4..10"]
+    if cutline:
+        args += ["--cutline", rgba_cutline_path]
+
+    outputs = []
+    for order in ["rows", "hilbert"]:
+        outputfile = str(tmpdir.join("{}.mbtiles".format(order)))
+        runner = CliRunner()
+        result = runner.invoke(
+            main_group, args + ["--tile-order", order, inputfile, outputfile]
+        )
+        assert result.exit_code == 0
+        conn = sqlite3.connect(outputfile)
+        cur = conn.cursor()
+        cur.execute("select zoom_level, tile_column, tile_row from tiles")
+        outputs.append(sorted(cur.fetchall()))
+
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 7),
+    reason="c.f. implementation requires Python >= 3.7",
+)
+@pytest.mark.parametrize("transport", ["pickle", "shared-memory"])
+@pytest.mark.parametrize("metatile_size", [2, 4])
+def test_metatiles(tmpdir, data, transport, metatile_size):
+    """Tiles cut from metatiles are the same tiles"""
+    if transport == "shared-memory" and sys.version_info < (3, 8):
+        pytest.skip("shared-memory transport requires Python >= 3.8")
+
+    inputfile = str(data.join("RGBA.byte.tif"))
+    runner = CliRunner()
+    keys = []
+    for args in [
+        [],
+        [
+            "--metatile-size",
+            str(metatile_size),
+            "--tile-order",
+            "hilbert",
+            "--result-transport",
+            transport,
+        ],
+    ]:
+        outputfile = str(tmpdir.join("export{}.mbtiles".format(len(keys))))
+        result = runner.invoke(
+            main_group,
+            [
+                "mbtiles",
+                "--implementation",
+                "cf",
+                "--format",
+                "PNG",
+                "--zoom-levels",
+                "4..10",
+            ]
+            + args
+            + [inputfile, outputfile],
+        )
+        assert result.exit_code == 0
+        conn = sqlite3.connect(outputfile)
+        cur = conn.cursor()
+        cur.execute("select zoom_level, tile_column, tile_row from tiles")
+        keys.append(sorted(cur.fetchall()))
+
+    assert keys[0] == keys[1]
+
+
+def test_metatiles_mp(data):
+    """The multiprocessing implementation does not make metatiles"""
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--implementation",
+            "mp",
+            "--metatile-size",
+            "2",
+            str(data.join("RGB.byte.tif")),
+            "out.mbtiles",
+        ],
+    )
+    assert result.exit_code == 2
+
+
+@pytest.mark.parametrize("filename", ["RGB.byte.tif", "RGBA.byte.tif"])
+def test_pillow_encoder(tmpdir, data, filename):
+    """PNG tiles encoded by Pillow have the same pixels as GDAL's"""
+    pytest.importorskip("PIL")
+    inputfile = str(data.join(filename))
+    runner = CliRunner()
+    pixels = []
+    for encoder in ["gdal", "pillow"]:
+        outputfile = str(tmpdir.join("{}.mbtiles".format(encoder)))
+        result = runner.invoke(
+            main_group,
+            [
+                "mbtiles",
+                "--format",
+                "PNG",
+                "--encoder",
+                encoder,
+                "--zoom-levels",
+                "6..8",
+                inputfile,
+                outputfile,
+            ],
+        )
+        assert result.exit_code == 0
+        conn = sqlite3.connect(outputfile)
+        cur = conn.cursor()
+        cur.execute("select zoom_level, tile_column, tile_row, tile_data from tiles")
+        tiles = {}
+        for z, x, y, contents in cur.fetchall():
+            with rasterio.io.MemoryFile(contents) as memfile:
+                with memfile.open() as dataset:
+                    tiles[(z, x, y)] = dataset.read().tolist()
+        pixels.append(tiles)
+
+    assert pixels[0] == pixels[1]
+
+
+def test_pillow_encoder_creation_option(tmpdir, data):
+    """Creation options that Pillow can't honor are rejected"""
+    pytest.importorskip("PIL")
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--format",
+            "PNG",
+            "--encoder",
+            "pillow",
+            "--co",
+            "TILED=YES",
+            str(data.join("RGB.byte.tif")),
+            str(tmpdir.join("export.mbtiles")),
+        ],
+    )
+    assert result.exit_code == 2
+    assert "TILED" in result.output
+
+
+def test_overviews(tmpdir, data):
+    """Tiles warped from overviews are the same tiles"""
+    inputfile = str(tmpdir.join("overviews.tif"))
+    with rasterio.open(str(data.join("RGB.byte.tif"))) as src:
+        with rasterio.open(inputfile, "w", **src.profile) as dst:
+            dst.write(src.read())
+            dst.build_overviews([2, 4, 8, 16])
+
+    runner = CliRunner()
+    keys = []
+    for option in ["--overviews", "--no-overviews"]:
+        outputfile = str(tmpdir.join("export{}.mbtiles".format(option)))
+        result = runner.invoke(
+            main_group,
+            ["mbtiles", option, "--zoom-levels", "4..10", inputfile, outputfile],
+        )
+        assert result.exit_code == 0
+        conn = sqlite3.connect(outputfile)
+        cur = conn.cursor()
+        cur.execute("select zoom_level, tile_column, tile_row from tiles")
+        keys.append(sorted(cur.fetchall()))
+
+    assert len(keys[0]) == 70
+    assert keys[0] == keys[1]
+
+
+def count_opaque_pixels(path):
+    """Count the opaque pixels of the RGBA tiles of an export"""
+    counts = {}
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute("select zoom_level, tile_column, tile_row, tile_data from tiles")
+    for z, x, y, contents in cur.fetchall():
+        with rasterio.io.MemoryFile(bytes(contents)) as memfile:
+            with memfile.open() as src:
+                counts[(z, x, y)] = int((src.read(4) > 0).sum())
+    conn.close()
+    return counts
+
+
+def test_overviews_cutline(tmpdir, data, rgba_cutline_path):
+    """Cutlines are applied at the resolution of the overviews"""
+    inputfile = str(tmpdir.join("overviews.tif"))
+    with rasterio.open(str(data.join("RGB.byte.tif"))) as src:
+        with rasterio.open(inputfile, "w", **src.profile) as dst:
+            dst.write(src.read())
+            dst.build_overviews([2, 4, 8])
+
+    runner = CliRunner()
+    counts = []
+    for option in ["--overviews", "--no-overviews"]:
+        outputfile = str(tmpdir.join("export{}.mbtiles".format(option)))
+        result = runner.invoke(
+            main_group,
+            [
+                "mbtiles",
+                option,
+                "--zoom-levels",
+                "6..9",
+                "--format",
+                "PNG",
+                "--rgba",
+                "--cutline",
+                rgba_cutline_path,
+                inputfile,
+                outputfile,
+            ],
+        )
+        assert result.exit_code == 0
+        counts.append(count_opaque_pixels(outputfile))
+
+    assert sorted(counts[0]) == sorted(counts[1])
+    for key, count in counts[1].items():
+        assert abs(counts[0][key] - count) <= 16
+
+
+def test_temporary_overviews(tmpdir, data, monkeypatch, caplog):
+    """Temporary overviews are deleted after the export"""
+    caplog.set_level(logging.INFO, logger="mbtiles.overviews")
+    scratch = tmpdir.mkdir("scratch")
+    monkeypatch.setattr(tempfile, "tempdir", str(scratch))
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--temporary-overviews",
+            "--zoom-levels",
+            "4..10",
+            inputfile,
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 0
+    assert "Building temporary overviews" in caplog.text
+    assert scratch.listdir() == []
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select count(*) from tiles")
+    assert cur.fetchone()[0] == 70
+
+
+def test_temporary_overviews_cutline(tmpdir, data, rgba_cutline_path):
+    """Cutlines are applied at the resolution of temporary overviews"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    runner = CliRunner()
+    counts = []
+    for option in ["--temporary-overviews", "--no-overviews"]:
+        outputfile = str(tmpdir.join("export{}.mbtiles".format(option)))
+        result = runner.invoke(
+            main_group,
+            [
+                "mbtiles",
+                option,
+                "--zoom-levels",
+                "6..9",
+                "--format",
+                "PNG",
+                "--rgba",
+                "--cutline",
+                rgba_cutline_path,
+                inputfile,
+                outputfile,
+            ],
+        )
+        assert result.exit_code == 0
+        counts.append(count_opaque_pixels(outputfile))
+
+    assert sorted(counts[0]) == sorted(counts[1])
+    for key, count in counts[1].items():
+        assert abs(counts[0][key] - count) <= 16
+
+
+def split_dataset(path, tmpdir):
+    """Write the left and right halves of a dataset"""
+    halves = []
+    with rasterio.open(path) as src:
+        half = src.width // 2
+        for name, window in [
+            ("left.tif", Window(0, 0, half, src.height)),
+            ("right.tif", Window(half, 0, src.width - half, src.height)),
+        ]:
+            profile = dict(
+                src.profile,
+                width=window.width,
+                height=window.height,
+                transform=src.window_transform(window),
+            )
+            halves.append(str(tmpdir.join(name)))
+            with rasterio.open(halves[-1], "w", **profile) as dst:
+                dst.write(src.read(window=window))
+    return halves
+
+
+@pytest.mark.parametrize("impl", ["cf", "mp"])
+@pytest.mark.parametrize("cache_size", ["1", "64"])
+def test_mosaic(tmpdir, data, impl, cache_size):
+    """A mosaic of the halves of a dataset has the dataset's tiles"""
+    inputfiles = split_dataset(str(data.join("RGB.byte.tif")), tmpdir)
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--implementation",
+            impl,
+            "--dataset-cache-size",
+            cache_size,
+            "--zoom-levels",
+            "4..10",
+        ]
+        + inputfiles
+        + [outputfile],
+    )
+    assert result.exit_code == 0
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select count(*) from tiles")
+    assert cur.fetchone()[0] == 70
+
+
+def test_mosaic_band_count(tmpdir, data):
+    """Inputs of a mosaic must have the same number of bands"""
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            str(data.join("RGB.byte.tif")),
+            str(data.join("RGBA.byte.tif")),
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 2
+    assert "same number of bands" in result.output
+
+
+def test_mosaic_coverage_index(tmpdir, data):
+    """Coverage indexes require a single input"""
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--prune-tiles",
+            str(data.join("RGB.byte.tif")),
+            str(data.join("RGB.byte.tif")),
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 2
+
+
+def test_resume(tmpdir, data):
+    """Only missing tiles are made when resuming"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group, ["mbtiles", "--zoom-levels", "4..9", inputfile, outputfile]
+    )
+    assert result.exit_code == 0
+
+    # A stored tile is marked and some are removed.
+    conn = sqlite3.connect(outputfile)
+    conn.execute(
+        "UPDATE tiles SET tile_data = 'marked' "
+        "WHERE zoom_level = 4 AND tile_column = 4 AND tile_row = 9;"
+    )
+    conn.execute("DELETE FROM tiles WHERE zoom_level = 9 AND tile_column % 2 = 0;")
+    conn.commit()
+    conn.close()
+
+    result = runner.invoke(
+        main_group,
+        ["mbtiles", "--resume", "--zoom-levels", "4..10", inputfile, outputfile],
+    )
+    assert result.exit_code == 0
+
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select count(*) from tiles")
+    assert cur.fetchone()[0] == 70
+    cur.execute(
+        "select tile_data from tiles "
+        "where zoom_level = 4 and tile_column = 4 and tile_row = 9"
+    )
+    assert cur.fetchone()[0] == "marked"
+
+
+def test_resume_overwrite(tmpdir, data):
+    """Resuming requires appending"""
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--resume",
+            "--overwrite",
+            str(data.join("RGB.byte.tif")),
+            str(tmpdir.join("export.mbtiles")),
+        ],
+    )
+    assert result.exit_code == 2
+
+
+def write_region(path, west, south, east, north):
+    """Write a GeoJSON region of bounds"""
+    path.write(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "properties": {},
+                        "geometry": mapping(box(west, south, east, north)),
+                    }
+                ],
+            }
+        )
+    )
+    return path
+
+
+def test_changed_region(tmpdir, data):
+    """Only tiles of the changed region are replaced"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group, ["mbtiles", "--zoom-levels", "4..10", inputfile, outputfile]
+    )
+    assert result.exit_code == 0
+
+    conn = sqlite3.connect(outputfile)
+    conn.execute("UPDATE tiles SET tile_data = 'marked';")
+    conn.commit()
+    conn.close()
+
+    # The region is within the tile 10/290/440 (TMS row 583).
+    west, south, east, north = mercantile.bounds(290, 440, 10)
+    west, south, east, north = west + 0.01, south + 0.01, east - 0.01, north - 0.01
+    region = write_region(tmpdir.join("region.geojson"), west, south, east, north)
+
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--changed-region",
+            str(region),
+            "--zoom-levels",
+            "4..10",
+            inputfile,
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 0
+
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute(
+        "select zoom_level, tile_column, tile_row from tiles "
+        "where tile_data != 'marked' order by zoom_level"
+    )
+    assert cur.fetchall() == [
+        (4, 4, 9),
+        (5, 9, 18),
+        (6, 18, 36),
+        (7, 36, 72),
+        (8, 72, 145),
+        (9, 145, 291),
+        (10, 290, 583),
+    ]
+
+
+def test_changed_region_resampling(tmpdir, data):
+    """Tiles whose resampling kernels reach a changed region are replaced"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group, ["mbtiles", "--zoom-levels", "10..10", inputfile, outputfile]
+    )
+    assert result.exit_code == 0
+
+    conn = sqlite3.connect(outputfile)
+    conn.execute("UPDATE tiles SET tile_data = 'marked';")
+    conn.commit()
+    conn.close()
+
+    # The region is within the tile 10/290/440, a few source pixels
+    # from its edges.
+    west, south, east, north = mercantile.bounds(290, 440, 10)
+    region = write_region(
+        tmpdir.join("region.geojson"),
+        west + 0.005,
+        south + 0.005,
+        east - 0.005,
+        north - 0.005,
+    )
+
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--changed-region",
+            str(region),
+            "--resampling",
+            "cubic",
+            "--zoom-levels",
+            "10..10",
+            inputfile,
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 0
+
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select tile_column, tile_row from tiles where tile_data != 'marked'")
+    assert sorted(cur.fetchall()) == [
+        (col, row) for col in range(289, 292) for row in range(582, 585)
+    ]
+
+
+def test_changed_region_covers(tmpdir, data):
+    """Tiles outside the covers quadkeys are kept"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group, ["mbtiles", "--zoom-levels", "4..10", inputfile, outputfile]
+    )
+    assert result.exit_code == 0
+
+    with rasterio.open(inputfile) as src:
+        bounds = transform_bounds(src.crs, "OGC:CRS84", *src.bounds)
+    region = write_region(tmpdir.join("region.geojson"), *bounds)
+
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--changed-region",
+            str(region),
+            "--covers",
+            "0320233",
+            "--covers",
+            "0320320",
+            "--zoom-levels",
+            "4..10",
+            inputfile,
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 0
+
+    conn = sqlite3.connect(outputfile)
+    cur = conn.cursor()
+    cur.execute("select count(*) from tiles")
+    assert cur.fetchone()[0] == 70
+
+
+def test_changed_since(tmpdir, data):
+    """Tiles that became empty are deleted"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    changed = str(tmpdir.join("changed.tif"))
+    with rasterio.open(inputfile) as src:
+        profile = src.profile
+        pixels = src.read()
+    pixels[:, 500:, 600:] = 0
+    with rasterio.open(changed, "w", **profile) as dst:
+        dst.write(pixels)
+
+    runner = CliRunner()
+    expected = str(tmpdir.join("expected.mbtiles"))
+    result = runner.invoke(
+        main_group, ["mbtiles", "--zoom-levels", "4..11", changed, expected]
+    )
+    assert result.exit_code == 0
+
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    result = runner.invoke(
+        main_group, ["mbtiles", "--zoom-levels", "4..11", inputfile, outputfile]
+    )
+    assert result.exit_code == 0
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--changed-since",
+            inputfile,
+            "--zoom-levels",
+            "4..11",
+            changed,
+            outputfile,
+        ],
+    )
+    assert result.exit_code == 0
+
+    tiles = []
+    for path in (expected, outputfile):
+        conn = sqlite3.connect(path)
+        cur = conn.cursor()
+        cur.execute("select * from tiles order by zoom_level, tile_column, tile_row")
+        tiles.append(cur.fetchall())
+    assert len(tiles[1]) == 202
+    assert tiles[0] == tiles[1]
+
+
+def test_changed_since_overwrite(tmpdir, data):
+    """Changed tiles can only be remade in an existing file"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        ["mbtiles", "--overwrite", "--changed-since", inputfile, inputfile, outputfile],
+    )
+    assert result.exit_code == 2
+    assert "--append" in result.output
+
+
+@pytest.mark.parametrize("pyramid", [[], ["--pyramid", "--deduplicate"]])
+def test_sharded_output(tmpdir, data, pyramid):
+    """Merged shards have the tiles of a normal export"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    runner = CliRunner()
+    tiles = []
+    for options in ([], ["--sharded-output", "-j", "2"]):
+        outputfile = str(tmpdir.join("export{}.mbtiles".format(len(tiles))))
+        result = runner.invoke(
+            main_group,
+            ["mbtiles", "--implementation", "cf", "--zoom-levels", "4..10"]
+            + pyramid
+            + options
+            + [inputfile, outputfile],
+        )
+        assert result.exit_code == 0
+        conn = sqlite3.connect(outputfile)
+        cur = conn.cursor()
+        cur.execute("select * from tiles order by zoom_level, tile_column, tile_row")
+        tiles.append(cur.fetchall())
+    assert tiles[1]
+    assert tiles[0] == tiles[1]
+
+
+def test_sharded_output_mp(tmpdir, data):
+    """Sharded output requires the cf implementation"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        ["mbtiles", "--implementation", "mp", "--sharded-output", inputfile, outputfile],
+    )
+    assert result.exit_code == 2
+    assert "concurrent.futures" in result.output
+
+
+def test_partitions(tmpdir, data):
+    """Merged outputs of partitions have the tiles of the export"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group,
+        [
+            "mbtiles",
+            "--partitions",
+            "3",
+            "--zoom-levels",
+            "4..10",
+            inputfile,
+            str(tmpdir.join("export.mbtiles")),
+        ],
+    )
+    assert result.exit_code == 0
+    specs = [json.loads(line) for line in result.output.splitlines()]
+    assert [spec["partition"] for spec in specs] == [0, 1, 2]
+    assert not os.path.exists(str(tmpdir.join("export.mbtiles")))
+
+    for spec in specs:
+        assert spec["output"] == str(
+            tmpdir.join("export-{}.mbtiles".format(spec["partition"]))
+        )
+        args = ["mbtiles", "--zoom-levels", spec["zoom_levels"]]
+        for quadkey in spec["covers"]:
+            args.extend(["--covers", quadkey])
+        result = runner.invoke(main_group, args + [inputfile, spec["output"]])
+        assert result.exit_code == 0
+
+    outputfile = str(tmpdir.join("merged.mbtiles"))
+    result = runner.invoke(
+        mbtiles.scripts.cli.merge, [spec["output"] for spec in specs] + [outputfile]
+    )
+    assert result.exit_code == 0
+
+    expected = str(tmpdir.join("expected.mbtiles"))
+    result = runner.invoke(
+        main_group, ["mbtiles", "--zoom-levels", "4..10", inputfile, expected]
+    )
+    assert result.exit_code == 0
+
+    tiles = []
+    for path in (expected, outputfile):
+        conn = sqlite3.connect(path)
+        cur = conn.cursor()
+        cur.execute("select * from tiles order by zoom_level, tile_column, tile_row")
+        tiles.append(cur.fetchall())
+    assert len(tiles[1]) == 70
+    assert tiles[0] == tiles[1]
+
+    cur.execute("select value from metadata where name = 'bounds'")
+    west, south, east, north = map(float, cur.fetchone()[0].split(","))
+    assert west < -78.898 and south < 23.565 and east > -76.599 and north > 25.550
+
+
+@pytest.mark.parametrize("args", [["--covers", "0320233"], ["--partitions", "2"]])
+def test_pyramid_partitions(tmpdir, data, args):
+    """Pyramids can't be made by partitions of an export"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    outputfile = str(tmpdir.join("export.mbtiles"))
+    runner = CliRunner()
+    result = runner.invoke(
+        main_group, ["mbtiles", "--pyramid"] + args + [inputfile, outputfile]
+    )
+    assert result.exit_code == 2
+    assert "--pyramid" in result.output
+    assert not os.path.exists(outputfile)
+
+
+def test_merge_layout(tmpdir, data):
+    """Merged files must have the same layout"""
+    inputfile = str(data.join("RGB.byte.tif"))
+    runner = CliRunner()
+    outputs = []
+    for options in ([], ["--deduplicate"]):
+        outputs.append(str(tmpdir.join("export{}.mbtiles".format(len(outputs)))))
+        result = runner.invoke(
+            main_group,
+            ["mbtiles", "--zoom-levels", "4..5"] + options + [inputfile, outputs[-1]],
+        )
+        assert result.exit_code == 0
+
+    result = runner.invoke(
+        mbtiles.scripts.cli.merge, outputs + [str(tmpdir.join("merged.mbtiles"))]
+    )
+    assert result.exit_code == 2
+    assert "same layout" in result.output
+    assert not os.path.exists(str(tmpdir.join("merged.mbtiles")))
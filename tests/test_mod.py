@@ -1,8 +1,27 @@
 """Module tests"""
 
+import sqlite3
+import sys
+
+import mercantile
 from mercantile import Tile
 import pytest
+import rasterio
+from rasterio.io import MemoryFile
+import rasterio.transform
+import rasterio.warp
+from rasterio.windows import Window
+from shapely.geometry import box, MultiPolygon, Point
 
+import mbtiles.bitmaps
+import mbtiles.changes
+import mbtiles.coverage
+import mbtiles.db
+import mbtiles.encoders
+import mbtiles.order
+import mbtiles.overviews
+import mbtiles.partitions
+import mbtiles.sources
 import mbtiles.worker
 
 
@@ -29,3 +48,691 @@ def test_process_tile(data, filename, tile):
     assert t.x == tile.x
     assert t.y == tile.y
     assert t.z == tile.z
+
+
+def test_worker_source_reuse(data):
+    """The worker opens its source once and reopens it when closed"""
+    sourcepath = str(data.join("RGB.byte.tif"))
+    mbtiles.worker.init_worker(
+        sourcepath,
+        {
+            "driver": "PNG",
+            "dtype": "uint8",
+            "nodata": 0,
+            "height": 256,
+            "width": 256,
+            "count": 3,
+            "crs": "EPSG:3857",
+        },
+        "nearest",
+        {},
+        {},
+    )
+    src = mbtiles.worker.src_dataset
+    assert not src.closed
+    mbtiles.worker.process_tile(Tile(36, 54, 7))
+    assert mbtiles.worker.src_dataset is src
+
+    mbtiles.worker.close_source()
+    assert src.closed
+    t, contents = mbtiles.worker.process_tile(Tile(36, 54, 7))
+    assert contents is not None
+    assert not mbtiles.worker.src_dataset.closed
+    mbtiles.worker.close_source()
+
+
+@pytest.mark.skipif(
+    "sys.version_info < (3, 7)",
+    reason="c.f. implementation requires Python >= 3.7",
+)
+def test_cf_writer_error():
+    """Errors in the writer thread are raised by process_tiles"""
+    import mbtiles.cf
+
+    def init_mbtiles():
+        raise RuntimeError("lolwut")
+
+    with pytest.raises(RuntimeError):
+        mbtiles.cf.process_tiles(
+            iter([]),
+            init_mbtiles,
+            None,
+            None,
+            num_workers=1,
+            inputfile="does-not-matter.tif",
+            base_kwds={},
+            resampling="nearest",
+        )
+
+
+@pytest.mark.parametrize("max_cells", [100, 10000, 1000000])
+def test_coverage(data, max_cells):
+    """Coverage agrees with the dataset's mask or defers to it"""
+    with rasterio.open(str(data.join("RGBA.byte.tif"))) as src:
+        coverage = mbtiles.coverage.build_coverage(src, max_cells=max_cells)
+        for window in [
+            Window(-10, -10, 20, 20),
+            Window(0, 0, 791, 718),
+            Window(300, 300, 50, 50),
+            Window(700, 600, 200, 200),
+            Window(1000, 1000, 10, 10),
+        ]:
+            has_data = mbtiles.coverage.window_has_data(coverage, window)
+            if has_data is not None:
+                assert has_data == src.read_masks(1, window=window).any()
+
+
+def test_source_window(data):
+    """Window of a tile in the source dataset"""
+    with rasterio.open(str(data.join("RGB.byte.tif"))) as src:
+        window = mbtiles.worker.source_window(Tile(36, 54, 7), src.crs, src.transform)
+        assert src.read_masks(1, window=window).any()
+        window = mbtiles.worker.source_window(Tile(0, 0, 7), src.crs, src.transform)
+        assert not mbtiles.coverage.window_has_data(
+            mbtiles.coverage.build_coverage(src), window
+        )
+
+
+@pytest.mark.parametrize("crs", ["EPSG:32618", "EPSG:4326"])
+def test_source_windows(crs):
+    """Windows of many tiles are those of single tiles"""
+    if crs == "EPSG:4326":
+        transform = rasterio.transform.from_origin(-180.0, 90.0, 0.01, 0.01)
+    else:
+        transform = rasterio.transform.from_origin(100000.0, 4000000.0, 300.0, 300.0)
+    tiles = list(mercantile.tiles(-78.0, 23.0, -76.0, 25.0, zooms=range(2, 9)))
+
+    windows = mbtiles.worker.source_windows(tiles, crs, transform)
+    assert windows == [
+        mbtiles.worker.source_window(tile, crs, transform) for tile in tiles
+    ]
+
+
+def test_process_tiles_batch(data):
+    """A batch of tiles is processed in order"""
+    sourcepath = str(data.join("RGB.byte.tif"))
+    mbtiles.worker.init_worker(
+        sourcepath,
+        {
+            "driver": "PNG",
+            "dtype": "uint8",
+            "nodata": 0,
+            "height": 256,
+            "width": 256,
+            "count": 3,
+            "crs": "EPSG:3857",
+        },
+        "nearest",
+        {},
+        {},
+    )
+    tiles = [Tile(36, 54, 7), Tile(0, 0, 7), Tile(35, 54, 7)]
+    results, elapsed = mbtiles.worker.process_tiles_batch(tiles)
+    assert [result[0] for result in results] == tiles
+    assert results[0][1] is not None
+    assert results[1][1] is None
+    assert elapsed >= 0
+    mbtiles.worker.close_source()
+
+
+@pytest.mark.skipif(
+    "sys.version_info < (3, 7)",
+    reason="c.f. implementation requires Python >= 3.7",
+)
+def test_cf_chunk_size():
+    """Chunks are sized to the time taken by tiles, within bounds"""
+    import mbtiles.cf
+
+    assert mbtiles.cf.chunk_size(None) == mbtiles.cf.INITIAL_CHUNK_SIZE
+    assert mbtiles.cf.chunk_size(0.0) == mbtiles.cf.MAX_CHUNK_SIZE
+    assert mbtiles.cf.chunk_size(1e-6) == mbtiles.cf.MAX_CHUNK_SIZE
+    assert mbtiles.cf.chunk_size(100.0) == mbtiles.cf.MIN_CHUNK_SIZE
+    assert mbtiles.cf.chunk_size(mbtiles.cf.TARGET_TASK_SECONDS / 10) == 10
+
+
+@pytest.mark.skipif(
+    "sys.version_info < (3, 7)",
+    reason="c.f. implementation requires Python >= 3.7",
+)
+def test_cf_tasks_per_worker():
+    """Enough tasks are queued to cover the latency, within bounds"""
+    import mbtiles.cf
+
+    assert mbtiles.cf.tasks_per_worker(None, 0.25) == mbtiles.cf.TASKS_PER_WORKER
+    assert mbtiles.cf.tasks_per_worker(0.001, 0.25) == mbtiles.cf.TASKS_PER_WORKER
+    assert mbtiles.cf.tasks_per_worker(0.5, 0.25) == 3
+    assert mbtiles.cf.tasks_per_worker(0.5, 0.0) == mbtiles.cf.MAX_TASKS_PER_WORKER
+    assert mbtiles.cf.tasks_per_worker(100.0, 0.25) == mbtiles.cf.MAX_TASKS_PER_WORKER
+
+
+@pytest.mark.skipif(
+    "sys.version_info < (3, 7)",
+    reason="c.f. implementation requires Python >= 3.7",
+)
+def test_cf_front_load():
+    """Units of costly and unknown zoom levels are first, in order"""
+    import mbtiles.cf
+
+    units = [[Tile(0, 0, 6)], [Tile(1, 0, 6)], [Tile(0, 0, 5)], [Tile(0, 0, 4)]]
+    assert mbtiles.cf.front_load(units, {4: 0.1, 6: 0.2}) == [
+        [Tile(0, 0, 5)],
+        [Tile(0, 0, 6)],
+        [Tile(1, 0, 6)],
+        [Tile(0, 0, 4)],
+    ]
+
+
+@pytest.mark.parametrize(
+    "bounds",
+    [
+        (-78.96, 23.56, -76.57, 25.55),
+        (-180.0, -85.0, 180.0, 85.0),
+        (170.0, -10.0, -170.0, 10.0),
+    ],
+)
+@pytest.mark.parametrize("zoom", [0, 3, 7])
+def test_hilbert_tiles(bounds, zoom):
+    """Hilbert ordered tiles are those of mercantile.tiles, in order"""
+    tiles = list(mbtiles.order.hilbert_tiles(*bounds, zooms=[zoom]))
+    assert sorted(tiles) == sorted(mercantile.tiles(*bounds, zooms=[zoom]))
+    if bounds[0] < bounds[2]:
+        indexes = [mbtiles.order.hilbert_index(tile) for tile in tiles]
+        assert indexes == sorted(indexes)
+
+
+def test_hilbert_curve():
+    """Consecutive tiles of a zoom level are neighbors"""
+    tiles = list(mbtiles.order.hilbert_tiles(-180.0, -85.0, 180.0, 85.0, 4))
+    assert [mbtiles.order.hilbert_index(tile) for tile in tiles] == list(range(256))
+    for a, b in zip(tiles, tiles[1:]):
+        assert abs(a.x - b.x) + abs(a.y - b.y) == 1
+
+
+def test_metatiles():
+    """Consecutive tiles are grouped by metatile"""
+    tiles = [Tile(0, 0, 2), Tile(1, 0, 2), Tile(2, 0, 2), Tile(1, 1, 2), Tile(0, 0, 3)]
+    assert list(mbtiles.order.metatiles(tiles, 2)) == [
+        [Tile(0, 0, 2), Tile(1, 0, 2)],
+        [Tile(2, 0, 2)],
+        [Tile(1, 1, 2)],
+        [Tile(0, 0, 3)],
+    ]
+
+
+def test_metatiles_rows():
+    """Tiles of mercantile.tiles are grouped in whole blocks"""
+    tiles = list(mercantile.tiles(-180.0, -85.0, 180.0, 85.0, 3))
+    groups = list(mbtiles.order.metatiles(tiles, 2))
+    assert len(groups) == 16
+    assert all(len(group) == 4 for group in groups)
+    assert sorted(tile for group in groups for tile in group) == sorted(tiles)
+
+
+def test_process_metatile(data):
+    """Tiles cut from a metatile match the tiles warped alone"""
+    sourcepath = str(data.join("RGBA.byte.tif"))
+    mbtiles.worker.init_worker(
+        sourcepath,
+        {
+            "driver": "PNG",
+            "dtype": "uint8",
+            "nodata": 0,
+            "height": 256,
+            "width": 256,
+            "count": 4,
+            "crs": "EPSG:3857",
+        },
+        "nearest",
+        {},
+        {},
+    )
+    tiles = [Tile(36, 54, 7), Tile(37, 54, 7), Tile(36, 55, 7), Tile(37, 55, 7)]
+    results = mbtiles.worker.process_metatile(tiles)
+    assert [result[0] for result in results] == tiles
+    for tile, contents in results:
+        expected = mbtiles.worker.process_tile(tile)[1]
+        assert (contents is None) == (expected is None)
+        if contents is not None:
+            with MemoryFile(contents) as a, MemoryFile(expected) as b:
+                with a.open() as dst_a, b.open() as dst_b:
+                    diff = dst_a.read().astype("int") - dst_b.read().astype("int")
+                    assert (diff != 0).mean() < 0.01
+    mbtiles.worker.close_source()
+
+
+def test_warp_buffer_reuse(data):
+    """Tiles of the same shape are warped into the same array"""
+    sourcepath = str(data.join("RGB.byte.tif"))
+    mbtiles.worker.init_worker(
+        sourcepath,
+        {
+            "driver": "PNG",
+            "dtype": "uint8",
+            "nodata": 0,
+            "height": 256,
+            "width": 256,
+            "count": 3,
+            "crs": "EPSG:3857",
+        },
+        "nearest",
+        {},
+        {},
+    )
+    mbtiles.worker.warp_buffers.clear()
+    t, first = mbtiles.worker.process_tile(Tile(36, 54, 7))
+    buffers = dict(mbtiles.worker.warp_buffers)
+    mbtiles.worker.process_tile(Tile(35, 54, 7))
+    assert mbtiles.worker.warp_buffers == buffers
+    assert len(buffers) == 1
+
+    # Reuse of the array does not leak pixels between tiles.
+    t, again = mbtiles.worker.process_tile(Tile(36, 54, 7))
+    assert again == first
+    mbtiles.worker.close_source()
+
+
+def test_warp_buffer_shapes():
+    """Destinations of many shapes are views of one array"""
+    mbtiles.worker.warp_buffers.clear()
+    largest = mbtiles.worker._warp_buffer(4, 512, 512, "uint8")
+    for width, height in [(256, 256), (512, 256), (256, 768), (512, 512)]:
+        data = mbtiles.worker._warp_buffer(4, height, width, "uint8")
+        assert data.shape == (4, height, width)
+        assert data.flags.c_contiguous
+    assert mbtiles.worker._warp_buffer(4, 768, 512, "uint8").size > largest.size
+    assert len(mbtiles.worker.warp_buffers) == 1
+    assert mbtiles.worker.warp_buffers["uint8"].size == 4 * 768 * 512
+
+
+@pytest.mark.parametrize("count", [1, 3, 4])
+def test_pillow_encoder(count):
+    """PNG images encoded by Pillow decode to the same pixels as GDAL's"""
+    pytest.importorskip("PIL")
+    import numpy as np
+
+    data = np.random.RandomState(0).randint(0, 256, (count, 64, 64)).astype("uint8")
+    kwds = {
+        "driver": "PNG",
+        "dtype": "uint8",
+        "nodata": 0,
+        "height": 64,
+        "width": 64,
+        "count": count,
+        "crs": "EPSG:3857",
+    }
+    images = [
+        mbtiles.encoders.encode_gdal(data, kwds),
+        mbtiles.encoders.encode_pillow(data, kwds),
+    ]
+    arrays = []
+    for image in images:
+        with MemoryFile(image) as memfile:
+            with memfile.open() as dataset:
+                arrays.append(dataset.read())
+                assert dataset.nodata == (0 if count != 4 else None)
+
+    assert (arrays[0] == data).all()
+    assert (arrays[1] == data).all()
+
+
+def test_pillow_options():
+    """GDAL creation options are translated or rejected"""
+    assert mbtiles.encoders.pillow_options("JPEG", 3, {"quality": "90"}) == {
+        "quality": 90
+    }
+    assert mbtiles.encoders.pillow_options("WEBP", 4, {"LOSSLESS": "YES"}) == {
+        "quality": 75,
+        "lossless": True,
+    }
+    with pytest.raises(ValueError):
+        mbtiles.encoders.pillow_options("PNG", 3, {"tiled": "YES"})
+    with pytest.raises(ValueError):
+        mbtiles.encoders.pillow_options("JPEG", 4, {})
+
+
+def test_overview_level():
+    """The coarsest overview that is fine enough is chosen"""
+    assert mbtiles.overviews.overview_level([2, 4, 8], 1.5) is None
+    assert mbtiles.overviews.overview_level([2, 4, 8], 2.0) == 0
+    assert mbtiles.overviews.overview_level([2, 4, 8], 7.9) == 1
+    assert mbtiles.overviews.overview_level([2, 4, 8], 100.0) == 2
+    assert mbtiles.overviews.overview_level([], 100.0) is None
+
+
+def test_plan_overviews(tmpdir, data):
+    """Lower zoom levels use coarser overviews"""
+    path = str(tmpdir.join("overviews.tif"))
+    with rasterio.open(str(data.join("RGB.byte.tif"))) as src:
+        profile = src.profile
+        with rasterio.open(path, "w", **profile) as dst:
+            dst.write(src.read())
+            dst.build_overviews([2, 4, 8, 16])
+
+    with rasterio.open(path) as src:
+        bounds = rasterio.warp.transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+        plan = mbtiles.overviews.plan_overviews(src, range(4, 10), 256, *bounds)
+
+    assert plan == {4: 3, 5: 2, 6: 1, 7: 0, 8: None, 9: None}
+
+    with rasterio.open(str(data.join("RGB.byte.tif"))) as src:
+        assert mbtiles.overviews.plan_overviews(src, range(4, 10), 256, *bounds) == {}
+
+
+def test_worker_missing_overview(data):
+    """Workers use the full resolution dataset if an overview is missing"""
+    sourcepath = str(data.join("RGB.byte.tif"))
+    mbtiles.worker.init_worker(
+        sourcepath,
+        {
+            "driver": "PNG",
+            "dtype": "uint8",
+            "nodata": 0,
+            "height": 256,
+            "width": 256,
+            "count": 3,
+            "crs": "EPSG:3857",
+        },
+        "nearest",
+        {},
+        {},
+        overview_levels={7: 5},
+    )
+    t, contents = mbtiles.worker.process_tile(Tile(36, 54, 7))
+    assert contents is not None
+    assert mbtiles.worker.overview_datasets == {5: None}
+    mbtiles.worker.close_source()
+
+
+def test_worker_overview_mask(tmpdir, data):
+    """Empty tiles are detected from the mask of an overview"""
+    path = str(tmpdir.join("overviews.tif"))
+    with rasterio.open(str(data.join("RGB.byte.tif"))) as src:
+        with rasterio.open(path, "w", **src.profile) as dst:
+            dst.write(src.read())
+            dst.build_overviews([2, 4, 8])
+
+    with rasterio.open(path) as src, rasterio.open(path, OVERVIEW_LEVEL=2) as ovr:
+        west, south, east, north = rasterio.warp.transform_bounds(
+            src.crs, "EPSG:4326", *src.bounds
+        )
+        tiles = list(mercantile.tiles(west - 1, south - 1, east + 1, north + 1, [6, 7]))
+        for tile in tiles:
+            has_data = mbtiles.worker._tile_has_data(src, tile)
+            assert mbtiles.worker._tile_has_data(src, tile, mask_src=ovr) == has_data
+        assert any(mbtiles.worker._tile_has_data(src, tile) for tile in tiles)
+
+
+def test_overview_factors():
+    """Temporary overviews are made down to the coarsest zoom level"""
+    assert mbtiles.overviews.overview_factors([0.5, 1.9]) == []
+    assert mbtiles.overviews.overview_factors([0.5, 2.0, 9.5]) == [2, 4, 8]
+    assert mbtiles.overviews.overview_factors([]) == []
+
+
+def test_build_temporary_overviews(tmpdir, data):
+    """Temporary overviews leave the dataset untouched"""
+    sourcepath = str(data.join("RGB.byte.tif"))
+    with rasterio.open(sourcepath) as src:
+        path = mbtiles.overviews.build_temporary_overviews(
+            src, str(tmpdir), [2, 4], "max"
+        )
+
+    with rasterio.open(path) as vrt:
+        assert vrt.overviews(1) == [2, 4]
+    with rasterio.open(sourcepath) as src:
+        assert src.overviews(1) == []
+
+
+def test_query_sources():
+    """Intersecting sources are found in their order"""
+    footprints = [
+        box(0.0, 0.0, 10.0, 10.0),
+        box(20.0, 0.0, 30.0, 10.0),
+        box(5.0, 5.0, 25.0, 15.0),
+    ]
+    index = mbtiles.sources.build_source_index(footprints)
+    assert mbtiles.sources.query_sources(index, 1.0, 1.0, 2.0, 2.0) == [0]
+    assert mbtiles.sources.query_sources(index, 6.0, 6.0, 21.0, 7.0) == [0, 1, 2]
+    assert mbtiles.sources.query_sources(index, 11.0, 1.0, 19.0, 4.0) == []
+
+
+def test_read_sources(data):
+    """Footprints and cutlines of sources are read"""
+    path = str(data.join("RGB.byte.tif"))
+    with rasterio.open(path) as src:
+        bounds = rasterio.warp.transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+
+    sources = mbtiles.sources.read_sources([path, path])
+    assert [source.path for source in sources] == [path, path]
+    assert sources[0].footprint.bounds == pytest.approx(bounds)
+    assert sources[0].cutline is None
+
+    cutline = box(bounds[0], bounds[1], bounds[0] + 0.1, bounds[1] + 0.1)
+    sources = mbtiles.sources.read_sources([path], cutline=cutline)
+    assert sources[0].cutline.startswith("POLYGON")
+
+    away = box(0.0, 0.0, 1.0, 1.0)
+    assert mbtiles.sources.read_sources([path], cutline=away) == []
+
+
+def test_read_sources_band_count(data):
+    """Sources must have the same number of bands"""
+    with pytest.raises(ValueError):
+        mbtiles.sources.read_sources(
+            [str(data.join("RGB.byte.tif")), str(data.join("RGBA.byte.tif"))]
+        )
+
+
+def test_dataset_cache(data):
+    """The least recently used dataset is closed"""
+    rgb = str(data.join("RGB.byte.tif"))
+    rgba = str(data.join("RGBA.byte.tif"))
+    mbtiles.worker.close_source()
+    mbtiles.worker.dataset_cache_size = 2
+    mbtiles.worker.dataset_cache_stats.update(hits=0, misses=0, evictions=0)
+
+    try:
+        first = mbtiles.worker.open_cached(rgb)
+        assert mbtiles.worker.open_cached(rgb) is first
+        mbtiles.worker.open_cached(rgba)
+        mbtiles.worker.open_cached(rgb)
+        mbtiles.worker.open_cached(rgb, sharing=False)
+        assert not first.closed
+        assert mbtiles.worker.open_cached(rgba) is not first
+        assert first.closed
+        assert mbtiles.worker.dataset_cache_info() == {
+            "hits": 2,
+            "misses": 4,
+            "evictions": 2,
+            "size": 2,
+            "maxsize": 2,
+        }
+    finally:
+        mbtiles.worker.close_source()
+        mbtiles.worker.dataset_cache_size = mbtiles.worker.DATASET_CACHE_SIZE
+
+
+def test_tile_bitmap():
+    """Tiles are added to and found in bitmaps"""
+    bitmap = mbtiles.bitmaps.empty_bitmap(3, 12, 5, 7)
+    mbtiles.bitmaps.add_tiles(bitmap, [3, 12, 7], [5, 7, 6])
+    assert bitmap.bits.nbytes == 4
+    assert mbtiles.bitmaps.has_tile(bitmap, 3, 5)
+    assert mbtiles.bitmaps.has_tile(bitmap, 12, 7)
+    assert mbtiles.bitmaps.has_tile(bitmap, 7, 6)
+    assert not mbtiles.bitmaps.has_tile(bitmap, 4, 5)
+    assert not mbtiles.bitmaps.has_tile(bitmap, 2, 5)
+    assert not mbtiles.bitmaps.has_tile(bitmap, 3, 8)
+
+
+@pytest.mark.parametrize("deduplicate", [False, True])
+def test_read_tile_bitmaps(deduplicate):
+    """Stored tiles are read into bitmaps by zoom level"""
+    conn = sqlite3.connect(":memory:")
+    mbtiles.db.create_tile_tables(conn, deduplicate=deduplicate)
+    table = "map" if deduplicate else "tiles"
+    conn.executemany(
+        "INSERT INTO {} VALUES (?, ?, ?, ?);".format(table),
+        [(2, 1, 1, "a"), (2, 3, 2, "a"), (5, 10, 20, "b")],
+    )
+
+    bitmaps = mbtiles.db.read_tile_bitmaps(conn, deduplicate=deduplicate, chunk_size=1)
+    assert sorted(bitmaps) == [2, 5]
+    assert mbtiles.bitmaps.has_tile(bitmaps[2], 1, 1)
+    assert mbtiles.bitmaps.has_tile(bitmaps[2], 3, 2)
+    assert not mbtiles.bitmaps.has_tile(bitmaps[2], 1, 2)
+    assert mbtiles.bitmaps.has_tile(bitmaps[5], 10, 20)
+
+
+def test_read_tile_bitmaps_sparse():
+    """Tiles spread far apart are read into sorted keys"""
+    conn = sqlite3.connect(":memory:")
+    mbtiles.db.create_tile_tables(conn)
+    last16 = (1 << 16) - 1
+    last20 = (1 << 20) - 1
+    conn.executemany(
+        "INSERT INTO tiles VALUES (?, ?, ?, ?);",
+        [
+            (16, 0, 0, "a"),
+            (16, last16, last16, "b"),
+            (20, 0, last20, "c"),
+            (20, last20, 0, "d"),
+            (20, 5, 7, "e"),
+        ],
+    )
+
+    bitmaps = mbtiles.db.read_tile_bitmaps(conn, chunk_size=2)
+    for zoom in [16, 20]:
+        assert isinstance(bitmaps[zoom], mbtiles.bitmaps.TileKeys)
+        assert bitmaps[zoom].keys.nbytes <= 24
+    assert mbtiles.bitmaps.has_tile(bitmaps[16], 0, 0)
+    assert mbtiles.bitmaps.has_tile(bitmaps[16], last16, last16)
+    assert not mbtiles.bitmaps.has_tile(bitmaps[16], last16, 0)
+    assert mbtiles.bitmaps.has_tile(bitmaps[20], 0, last20)
+    assert mbtiles.bitmaps.has_tile(bitmaps[20], last20, 0)
+    assert mbtiles.bitmaps.has_tile(bitmaps[20], 5, 7)
+    assert not mbtiles.bitmaps.has_tile(bitmaps[20], 7, 5)
+    assert not mbtiles.bitmaps.has_tile(bitmaps[20], last20, last20)
+
+
+@pytest.mark.parametrize("deduplicate", [False, True])
+def test_merge_shards(tmpdir, deduplicate):
+    """Tiles of shards are copied, replacing those of the same key"""
+    table = "map" if deduplicate else "tiles"
+    paths = []
+    for name, rows in [("a", [(2, 1, 1, "a"), (2, 1, 2, "b")]), ("b", [(2, 1, 2, "c")])]:
+        paths.append(str(tmpdir.join(name + ".mbtiles")))
+        shard = sqlite3.connect(paths[-1])
+        mbtiles.db.create_tile_tables(shard, deduplicate=deduplicate, index=False)
+        shard.executemany("INSERT INTO {} VALUES (?, ?, ?, ?);".format(table), rows)
+        if deduplicate:
+            shard.executemany(
+                "INSERT INTO images VALUES (?, ?);", [(row[3], row[3]) for row in rows]
+            )
+        shard.commit()
+        shard.close()
+
+    conn = sqlite3.connect(str(tmpdir.join("output.mbtiles")))
+    mbtiles.db.create_tile_tables(conn, deduplicate=deduplicate)
+    assert mbtiles.db.merge_shards(conn, paths, deduplicate=deduplicate) == 3
+    assert conn.execute("SELECT * FROM tiles ORDER BY tile_row;").fetchall() == [
+        (2, 1, 1, "a"),
+        (2, 1, 2, "c"),
+    ]
+    assert conn.execute("PRAGMA database_list;").fetchall()[-1][1] == "main"
+
+
+def test_changed_region(tmpdir, data):
+    """Blocks that differ between versions make the changed region"""
+    path = str(data.join("RGB.byte.tif"))
+    changed = str(tmpdir.join("changed.tif"))
+    with rasterio.open(path) as src:
+        profile = src.profile
+        pixels = src.read()
+    pixels[:, 300:310, 400:410] = 1
+    with rasterio.open(changed, "w", **profile) as dst:
+        dst.write(pixels)
+
+    with rasterio.open(path) as old, rasterio.open(changed) as new:
+        region = mbtiles.changes.changed_region(old, new)
+        x, y = new.xy(305, 405)
+        lng, lat = rasterio.warp.transform(new.crs, "EPSG:4326", [x], [y])
+        assert region.contains(Point(lng[0], lat[0]))
+        assert region.area < box(*new.bounds).area
+
+        assert mbtiles.changes.changed_region(old, old).is_empty
+
+    with rasterio.open(path) as old, rasterio.open(
+        str(data.join("RGBA.byte.tif"))
+    ) as new:
+        with pytest.raises(ValueError):
+            mbtiles.changes.changed_region(old, new)
+
+
+def test_region_tiles():
+    """Tiles of the parts of a region are found"""
+    region = MultiPolygon([box(1.0, 1.0, 2.0, 2.0), box(-2.0, -2.0, -1.0, -1.0)])
+    tiles = mbtiles.changes.region_tiles(region, 8)
+    assert mercantile.tile(1.5, 1.5, 8) in tiles
+    assert mercantile.tile(-1.5, -1.5, 8) in tiles
+    assert mercantile.tile(0.0, 0.0, 8) not in tiles
+    assert mbtiles.changes.region_tiles(box(1.0, 1.0, 2.0, 2.0).buffer(-1.0), 8) == []
+
+
+def test_pad_distance():
+    """Regions are padded by a source pixel and the resampling kernel"""
+    tile_pixel_size = mbtiles.changes.MERCATOR_WIDTH / 256
+    assert mbtiles.changes.pad_distance(20, 256, 10.0) == 10.0
+    assert mbtiles.changes.pad_distance(20, 256, 10.0, "cubic") == 30.0
+    assert mbtiles.changes.pad_distance(20, 256, 10.0, "average") == 20.0
+    assert mbtiles.changes.pad_distance(0, 256, 10.0, "cubic") == pytest.approx(
+        10.0 + 2 * tile_pixel_size
+    )
+
+
+def test_pad_region():
+    """Regions are buffered in Web Mercator"""
+    region = box(1.0, 1.0, 2.0, 2.0)
+    padded = mbtiles.changes.pad_region(region, 1000.0)
+    assert padded.contains(region)
+    assert padded.contains(Point(2.005, 1.5))
+    assert not padded.contains(Point(2.02, 1.5))
+    assert mbtiles.changes.pad_region(region, 0.0) is region
+
+
+def test_in_covers():
+    """Tiles within and containing quadkeys are covered"""
+    covers = [Tile(2, 3, 3), Tile(0, 0, 2)]
+    assert mbtiles.partitions.in_covers(Tile(2, 3, 3), covers)
+    assert mbtiles.partitions.in_covers(Tile(5, 7, 4), covers)
+    assert mbtiles.partitions.in_covers(Tile(0, 0, 1), covers)
+    assert mbtiles.partitions.in_covers(Tile(1, 1, 3), covers)
+    assert not mbtiles.partitions.in_covers(Tile(3, 3, 3), covers)
+    assert not mbtiles.partitions.in_covers(Tile(1, 0, 1), covers)
+
+
+@pytest.mark.parametrize("partitions", [1, 3, 7])
+def test_partition_quadkeys(partitions):
+    """Partitions cover each tile once and are about the same size"""
+    bounds = (-78.95, 23.56, -76.57, 25.55)
+    result = mbtiles.partitions.partition_quadkeys(
+        -78.95, 23.56, -76.57, 25.55, 4, 12, partitions
+    )
+    assert len(result) == partitions
+
+    covers = [
+        [mercantile.quadkey_to_tile(qk) for qk in quadkeys] for quadkeys, _ in result
+    ]
+    for tile in mercantile.tiles(*bounds, zooms=[12]):
+        assert sum(mbtiles.partitions.in_covers(tile, tiles) for tiles in covers) == 1
+
+    counts = [count for _, count in result]
+    assert max(counts) < 1.2 * min(counts)
+
+
+def test_union_bounds():
+    """Bounds metadata are combined"""
+    assert (
+        mbtiles.partitions.union_bounds(["0,1,2,3", "-1.5,2,1,4"])
+        == "-1.500000,1.000000,2.000000,4.000000"
+    )